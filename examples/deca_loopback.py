@@ -8,7 +8,6 @@ import argparse
 import os
 
 from common import StreamPayloadInverter
-from litex.gen.fhdl.utils import get_signals
 from litex.soc.cores.clock import *
 from litex.soc.cores.led import LedChaser
 from litex.soc.integration.builder import *
@@ -20,6 +19,7 @@ from litex_boards.targets.terasic_deca import _CRG
 from migen import *
 from migen.genlib.cdc import AsyncResetSynchronizer
 
+from liteluna.dma import add_usb_dma
 from liteluna.stream import USBStreamer
 from liteluna.ulpi import ULPIInterface, ULPIPHYInterface
 from liteluna.usbbone import add_usbbone
@@ -29,7 +29,12 @@ from liteluna.usbbone import add_usbbone
 
 class BenchSoC(SoCCore):
     def __init__(
-        self, with_usbbone=False, with_jtagbone=False, with_analyzer=False, sys_clk_freq=int(125e6)
+        self,
+        with_usbbone=False,
+        with_usb_dma=False,
+        with_jtagbone=False,
+        with_analyzer=False,
+        sys_clk_freq=int(125e6),
     ):
         platform = terasic_deca.Platform()
 
@@ -52,16 +57,29 @@ class BenchSoC(SoCCore):
             self.add_jtagbone()
 
         # USBbone ----------------------------------------------------------------------------------
-        if False:
-            add_usbbone(self, self.ulpi, with_blinky=True)
+        # self.comb += self.ulpi.reset_n.eq(
+        #     ~(ResetSignal("sys") | (~self.ulpi.reset_n & self.crg.usb_pll.locked))
+        # )
+        self.comb += self.ulpi.reset_n.eq(1)
+        if with_usbbone or with_usb_dma:
+            self.submodules.usb = usb = USBStreamer(
+                platform,
+                self.ulpi,
+                data_width=32,
+                num_endpoints=2 if with_usb_dma else 1,
+                with_blinky=True,
+                with_utmi_la=True,
+            )
+            self.comb += usb.connect.eq(1)
+            add_usbbone(self, usb)
+            # USBbone programs the DMA on endpoint 1, which streams on endpoint 2
+            if with_usb_dma:
+                self.add_ram("usb_dma_ram", 0x40000000, 0x8000)
+                add_usb_dma(self, usb, index=1)
         else:
             self.submodules.usb = usb = USBStreamer(
                 platform, self.ulpi, with_blinky=True, with_utmi_la=True
             )
-            # self.comb += self.ulpi.reset_n.eq(
-            #     ~(ResetSignal("sys") | (~self.ulpi.reset_n & self.crg.usb_pll.locked))
-            # )
-            self.comb += self.ulpi.reset_n.eq(1)
 
             self.submodules.stream_inverter = StreamPayloadInverter()
             self.submodules.pipeline = stream.Pipeline(
@@ -80,32 +98,10 @@ class BenchSoC(SoCCore):
 
         # scope ------------------------------------------------------------------------------------
         if with_analyzer:
-            from litescope import LiteScopeAnalyzer
-
-            # usb_rst = Signal()
-            # self.comb += [
-            #     usb_rst.eq(ResetSignal("usb")),
-            # ]
-            # ulpi_sigs = get_signals(self.ulpi)
-            # ulpi_sigs.remove(self.ulpi.clk)
-
-            analyzer_signals = [
-                self.usb.utmi_la,
-                self.usb.utmi_la_rx_data32,
-                # *ulpi_sigs,
-                # *get_signals(usb, recurse=False),
-                # *get_signals(self.stream_inverter),
-                # *get_signals(usb.stream_to_host),
-                # *get_signals(usb.stream_to_device),
-                # usb_rst,
-                # self.crg.usb_pll.locked,
-            ]
-            self.submodules.analyzer = LiteScopeAnalyzer(
-                analyzer_signals,
-                depth=7750 * 2,
-                clock_domain="usb",
-                register=True,
-                csr_csv="analyzer.csv",
+            from liteluna.analyzer import USBAnalyzer
+
+            self.submodules.analyzer = USBAnalyzer.from_streamer(
+                self.usb, depth=7750 * 2, csr_csv="analyzer.csv"
             )
 
         # LEDs -------------------------------------------------------------------------------------
@@ -124,10 +120,12 @@ def main():
     parser.add_argument("--with-jtagbone", action="store_true", help="Enable JTAGbone")
     parser.add_argument("--with-analyzer", action="store_true", help="Enable litescope")
     parser.add_argument("--with-usbbone", action="store_true", help="Enable USBbone")
+    parser.add_argument("--with-usb-dma", action="store_true", help="Enable USBbone and USB DMA")
     args = parser.parse_args()
 
     soc = BenchSoC(
         with_usbbone=args.with_usbbone,
+        with_usb_dma=args.with_usb_dma,
         with_jtagbone=args.with_jtagbone,
         with_analyzer=args.with_analyzer,
     )
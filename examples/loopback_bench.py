@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2022 Jevin Sweval <jevinsweval@gmail.com>
+# SPDX-License-Identifier: BSD-2-Clause
+
+import argparse
+import asyncio
+import contextlib
+import json
+import platform
+import sys
+import time
+
+from liteluna.host import (
+    PRODUCT_ID,
+    VENDOR_ID,
+    BulkStreamer,
+    EventThread,
+    LoopbackDevice,
+    open_streamer,
+)
+
+SCHEMA_VERSION = 1
+
+# Backends -----------------------------------------------------------------------------------------
+
+
+@contextlib.contextmanager
+def hw_backend(args):
+    import usb1
+
+    with usb1.USBContext() as context:
+        handle = open_streamer(context, args.vid, args.pid)
+        try:
+            yield handle, context
+        finally:
+            handle.close()
+
+
+@contextlib.contextmanager
+def loopback_backend(args):
+    device = LoopbackDevice()
+    yield device, device
+
+
+@contextlib.contextmanager
+def sim_backend(args):
+    from liteluna.sim.device import SimDevice
+
+    with SimDevice(port=args.sim_port) as device:
+        print(f"waiting for a simulation on port {args.sim_port}", file=sys.stderr)
+        device.wait_ready()
+        yield device, device
+
+
+BACKENDS = {
+    "hw": hw_backend,
+    "loopback": loopback_backend,
+    "sim": sim_backend,
+}
+
+# Measurements -------------------------------------------------------------------------------------
+
+
+async def _stream(streamer, total, transfer_size):
+    payload = bytes(range(256)) * (transfer_size // 256) + bytes(range(transfer_size % 256))
+    t0 = time.perf_counter()
+
+    async def send():
+        remaining = total
+        while remaining > 0:
+            chunk = payload[: min(remaining, len(payload))]
+            await streamer.writer.awrite(chunk)
+            remaining -= len(chunk)
+        await streamer.writer.aflush()
+        return time.perf_counter() - t0
+
+    async def receive():
+        received = 0
+        async for view in streamer.reader:
+            received += len(view)
+            if received >= total:
+                break
+        return time.perf_counter() - t0
+
+    return await asyncio.gather(send(), receive())
+
+
+def bench_stream(handle, context, total, transfer_size, queue_depth):
+    streamer = BulkStreamer(handle, context, transfer_size=transfer_size, queue_depth=queue_depth)
+    try:
+        with EventThread(context, interval=0.01):
+            t_out, t_in = asyncio.run(_stream(streamer, total, transfer_size))
+    finally:
+        streamer.close()
+    return {
+        "test": "stream",
+        "transfer_size": transfer_size,
+        "queue_depth": queue_depth,
+        "bytes": total,
+        "out_seconds": t_out,
+        "in_seconds": t_in,
+        "out_MBps": total / t_out / 1e6,
+        "in_MBps": total / t_in / 1e6,
+        "loopback_MBps": total / max(t_out, t_in) / 1e6,
+    }
+
+
+def percentile(sorted_samples, p):
+    i = min(len(sorted_samples) - 1, int(round(p / 100 * (len(sorted_samples) - 1))))
+    return sorted_samples[i]
+
+
+def bench_latency(handle, context, size, samples):
+    transfer_size = max(512, (size + 511) // 512 * 512)
+    streamer = BulkStreamer(handle, context, transfer_size=transfer_size, queue_depth=1)
+    payload = bytes(range(256)) * (size // 256) + bytes(range(size % 256))
+    rtts = []
+    try:
+        for _ in range(samples):
+            t0 = time.perf_counter()
+            streamer.writer.write(payload)
+            received = 0
+            while received < size:
+                received += len(streamer.reader.read())
+            rtts.append(time.perf_counter() - t0)
+    finally:
+        streamer.close()
+    rtts.sort()
+    return {
+        "test": "latency",
+        "size": size,
+        "samples": samples,
+        "p50_us": percentile(rtts, 50) * 1e6,
+        "p90_us": percentile(rtts, 90) * 1e6,
+        "p99_us": percentile(rtts, 99) * 1e6,
+        "max_us": rtts[-1] * 1e6,
+    }
+
+
+# Main ---------------------------------------------------------------------------------------------
+
+
+def int_list(s):
+    return [int(v, 0) for v in s.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LiteLUNA bulk loopback benchmark")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="hw", help="Device backend")
+    parser.add_argument("--vid", type=lambda v: int(v, 0), default=VENDOR_ID, help="USB vendor ID")
+    parser.add_argument(
+        "--pid", type=lambda v: int(v, 0), default=PRODUCT_ID, help="USB product ID"
+    )
+    parser.add_argument("--sim-port", type=int, default=2443, help="Simulation framed-TCP port")
+    parser.add_argument(
+        "--transfer-sizes", type=int_list, default=[4096, 65536, 262144], help="Transfer sizes"
+    )
+    parser.add_argument("--queue-depths", type=int_list, default=[1, 4, 16], help="Queue depths")
+    parser.add_argument("--bytes", type=int, default=64 << 20, help="Bytes per stream run")
+    parser.add_argument("--latency-sizes", type=int_list, default=[4, 512], help="Ping sizes")
+    parser.add_argument("--latency-samples", type=int, default=1000, help="Pings per size")
+    parser.add_argument("--no-stream", action="store_true", help="Skip throughput runs")
+    parser.add_argument("--no-latency", action="store_true", help="Skip latency runs")
+    parser.add_argument("--output", default="-", help="JSON results file (default: stdout)")
+    args = parser.parse_args()
+
+    results = []
+    with BACKENDS[args.backend](args) as (handle, context):
+        if not args.no_stream:
+            for transfer_size in args.transfer_sizes:
+                for queue_depth in args.queue_depths:
+                    r = bench_stream(handle, context, args.bytes, transfer_size, queue_depth)
+                    print(
+                        f"stream size={transfer_size} depth={queue_depth}: "
+                        f"out {r['out_MBps']:.2f} MB/s in {r['in_MBps']:.2f} MB/s "
+                        f"loopback {r['loopback_MBps']:.2f} MB/s",
+                        file=sys.stderr,
+                    )
+                    results.append(r)
+        if not args.no_latency:
+            for size in args.latency_sizes:
+                r = bench_latency(handle, context, size, args.latency_samples)
+                print(
+                    f"latency size={size}: p50 {r['p50_us']:.1f} us p99 {r['p99_us']:.1f} us",
+                    file=sys.stderr,
+                )
+                results.append(r)
+
+    report = {
+        "schema": SCHEMA_VERSION,
+        "backend": args.backend,
+        "timestamp": time.time(),
+        "host": platform.node(),
+        "results": results,
+    }
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,107 @@
 #!/usr/bin/env python3
 
-import random
+import argparse
+import asyncio
+import sys
 import time
 
-import usb1
+from liteluna.host import (
+    PRODUCT_ID,
+    VENDOR_ID,
+    BulkStreamer,
+    EventThread,
+    LoopbackDevice,
+    open_streamer,
+)
+from liteluna.pattern import Pattern, PatternChecker
 
-with usb1.USBContext() as context:
-    handle = context.openByVendorIDAndProductID(
-        0x16D0,
-        0xF3B,
-        skip_on_error=True,
-    )
-    assert handle is not None
-    with handle.claimInterface(0):
-        try:
-            while True:
-                ibuf = handle.bulkRead(1, 512, timeout=30)
-        except:
-            pass
-        print("flushed")
-        i = 0
+
+def flush_in(handle):
+    import usb1
+
+    try:
         while True:
-            obuf = random.randbytes(512)
-            print(f"obuf:     {obuf.hex()}")
-            handle.bulkWrite(1, obuf, timeout=1000)
-            ibuf = handle.bulkRead(1, 512, timeout=1000)
-            print(f"ibuf:     {ibuf.hex()}")
-            # assert ibuf == obuf
-            ibuf_inv = bytes([b ^ 0xFF for b in ibuf])
-            # print(f"ibuf_inv: {ibuf_inv.hex()}")
-            assert ibuf_inv == obuf
-            if i % 1024 == 0:
-                print(".", end="", flush=True)
-            # if i == 12:
-            #     break
-            i += 1
+            handle.bulkRead(1, 512, timeout=30)
+    except usb1.USBErrorTimeout:
+        pass
+
+
+async def run(streamer, args):
+    pattern = Pattern(args.pattern, args.seed)
+    checker = PatternChecker(Pattern(args.pattern, args.seed), invert=not args.no_invert)
+    total = args.bytes or float("inf")
+    t0 = time.perf_counter()
+
+    async def send():
+        sent = 0
+        while sent < total:
+            n = int(min(args.transfer_size, total - sent))
+            await streamer.writer.awrite(pattern.next(n))
+            sent += n
+        await streamer.writer.aflush()
+
+    async def receive():
+        last_report = t0
+        async for view in streamer.reader:
+            if checker.check(view) and args.stop_on_error:
+                break
+            if checker.offset >= total:
+                break
+            now = time.perf_counter()
+            if now - last_report >= args.report_interval:
+                rate = checker.offset / (now - t0) / 1e6
+                print(f"{rate:.2f} MB/s, {checker.summary()}", file=sys.stderr)
+                last_report = now
+
+    sender = asyncio.ensure_future(send())
+    await receive()
+    if not sender.done():
+        sender.cancel()
+    return checker, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LiteLUNA bulk loopback tester")
+    parser.add_argument(
+        "--backend", choices=["hw", "loopback"], default="hw", help="Device backend"
+    )
+    parser.add_argument("--vid", type=lambda v: int(v, 0), default=VENDOR_ID, help="USB vendor ID")
+    parser.add_argument(
+        "--pid", type=lambda v: int(v, 0), default=PRODUCT_ID, help="USB product ID"
+    )
+    parser.add_argument("--pattern", choices=Pattern.KINDS, default="lfsr", help="Data pattern")
+    parser.add_argument("--seed", type=int, default=1, help="Pattern seed")
+    parser.add_argument("--no-invert", action="store_true", help="Gateware echoes data unmodified")
+    parser.add_argument("--bytes", type=int, default=0, help="Bytes to verify (0: forever)")
+    parser.add_argument("--transfer-size", type=int, default=64 * 1024, help="Transfer size")
+    parser.add_argument("--queue-depth", type=int, default=16, help="Transfers in flight")
+    parser.add_argument("--report-interval", type=float, default=1.0, help="Seconds per report")
+    parser.add_argument("--stop-on-error", action="store_true", help="Stop at the first mismatch")
+    args = parser.parse_args()
+
+    if args.backend == "hw":
+        import usb1
+
+        context = usb1.USBContext()
+        handle = open_streamer(context, args.vid, args.pid)
+        flush_in(handle)
+    else:
+        context = handle = LoopbackDevice(invert=not args.no_invert)
+
+    streamer = BulkStreamer(
+        handle, context, transfer_size=args.transfer_size, queue_depth=args.queue_depth
+    )
+    try:
+        with EventThread(context, interval=0.01):
+            checker, elapsed = asyncio.run(run(streamer, args))
+    except KeyboardInterrupt:
+        sys.exit(130)
+    finally:
+        streamer.close()
+
+    print(f"{checker.offset / elapsed / 1e6:.2f} MB/s, {checker.summary()}")
+    sys.exit(0 if checker.ok else 1)
+
+
+if __name__ == "__main__":
+    main()
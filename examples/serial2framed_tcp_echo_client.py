@@ -2,25 +2,33 @@
 
 import socket
 
+from liteluna.sim.framing import FrameDecoder, FrameEncoder
+
 s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 print(s)
 s.connect(("localhost", 2443))
 
+decoder = FrameDecoder()
+encoder = FrameEncoder()
+
 
 def read():
-    sz_buf = s.recv(4)
-    sz = int.from_bytes(sz_buf, "big")
-    return s.recv(sz)
+    while True:
+        frame = decoder.next_frame()
+        if frame is not None:
+            return frame
+        if not decoder.recv_into(s):
+            raise EOFError("peer disconnected")
 
 
 def write(buf):
-    buf = len(buf).to_bytes(4, "big") + buf
-    s.send(buf)
+    encoder.add(buf)
+    encoder.send(s)
 
 
 while True:
     print(":> ", end="")
     ltx = input()
     write(ltx.encode("utf8"))
-    lrx = read().decode("utf8")
+    lrx = str(read(), "utf8")
     print(f"rx: {lrx}")
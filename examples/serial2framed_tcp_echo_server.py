@@ -2,6 +2,8 @@
 
 import socket
 
+from liteluna.sim.framing import FrameDecoder, FrameEncoder
+
 serv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 serv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 serv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
@@ -10,21 +12,27 @@ serv_sock.listen(1)
 
 s, _ = serv_sock.accept()
 
+decoder = FrameDecoder()
+encoder = FrameEncoder()
+
 
 def read():
-    sz_buf = s.recv(4)
-    sz = int.from_bytes(sz_buf, "big")
-    return s.recv(sz)
+    while True:
+        frame = decoder.next_frame()
+        if frame is not None:
+            return frame
+        if not decoder.recv_into(s):
+            raise EOFError("peer disconnected")
 
 
 def write(buf):
-    buf = len(buf).to_bytes(4, "big") + buf
-    s.send(buf)
+    encoder.add(buf)
+    encoder.send(s)
 
 
 while True:
     print(":> ", end="")
     ltx = input()
     write(ltx.encode("utf8"))
-    lrx = read().decode("utf8")
+    lrx = str(read(), "utf8")
     print(f"rx: {lrx}")
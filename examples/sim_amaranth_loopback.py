@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+import time
+
+from liteluna.luna_cores.testbench import DEFAULT_TIME_SCALE, run_simulation
+from liteluna.pattern import Pattern, PatternChecker
+
+
+def make_script(args):
+    async def script(host, model):
+        await host.enumerate(with_strings=False)
+        print(f"high speed after {model.cycle} cycles, enumerated: {sorted(host.endpoints)}")
+
+        pattern = Pattern(args.pattern)
+        checker = PatternChecker(Pattern(args.pattern), invert=True)
+        for _ in range(args.count):
+            await host.bulk_out(args.endpoint, pattern.next(args.size))
+            checker.check(await host.bulk_in(args.endpoint, args.size))
+        print(checker.summary())
+        return checker.ok
+
+    return script
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback USBBulkStreamerDevice under Amaranth")
+    parser.add_argument("--endpoint", type=int, default=1, help="Bulk endpoint number")
+    parser.add_argument("--pattern", choices=Pattern.KINDS, default="lfsr", help="Data pattern")
+    parser.add_argument("--size", type=int, default=512, help="Bytes per bulk transfer")
+    parser.add_argument("--count", type=int, default=2, help="Pattern transfers")
+    parser.add_argument(
+        "--time-scale",
+        type=float,
+        default=DEFAULT_TIME_SCALE,
+        help="Divide USB reset/chirp/idle timing by this",
+    )
+    parser.add_argument("--vcd", help="Write a VCD trace to this file")
+    parser.add_argument("--record", help="Write a binary UTMI trace to this file")
+    parser.add_argument("--trace", action="store_true", help="Print every packet")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    ok = run_simulation(
+        make_script(args),
+        time_scale=args.time_scale,
+        vcd_file=args.vcd,
+        trace_file=args.record,
+        trace=sys.stdout if args.trace else None,
+    )
+    print(f"{'PASS' if ok else 'FAIL'} in {time.perf_counter() - t0:.1f} s")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,8 @@
 # SPDX-License-Identifier: BSD-2-Clause
 
 import argparse
+import contextlib
+import logging
 
 from common import StreamPayloadInverter
 from liteeth.phy.model import LiteEthPHYModel
@@ -20,6 +22,7 @@ from litex.soc.integration.soc_core import *
 from litex.soc.interconnect import stream
 from migen import *
 
+from liteluna.sim.build import SimBuildCache
 from liteluna.stream import USBStreamer
 from liteluna.utmi import SimUTMIStreamFixup, UTMIInterface
 
@@ -86,7 +89,15 @@ def display_signal(mod, sig, name=None, fmt="%b"):
 
 
 class SimSoC(SoCCore):
-    def __init__(self, sys_clk_freq=None, **kwargs):
+    def __init__(
+        self,
+        sys_clk_freq=None,
+        with_etherbone=True,
+        with_stats=False,
+        with_analyzer=False,
+        sim_time_scale=1,
+        **kwargs,
+    ):
         platform = Platform()
         sys_clk_freq = int(sys_clk_freq)
 
@@ -128,8 +139,14 @@ class SimSoC(SoCCore):
         #     usb_sim_phy.sink,
         # )
 
-        self.submodules.fixup = SimUTMIStreamFixup(usb_sim_phy)
-        self.submodules.usb = usb = USBStreamer(platform, self.fixup.utmi, with_utmi_la=True)
+        self.submodules.fixup = SimUTMIStreamFixup(usb_sim_phy, time_scale=sim_time_scale)
+        self.submodules.usb = usb = USBStreamer(
+            platform,
+            self.fixup.utmi,
+            with_utmi_la=True,
+            with_stats=with_stats,
+            sim_time_scale=sim_time_scale,
+        )
 
         self.submodules.stream_inverter = StreamPayloadInverter()
         self.submodules.pipeline = stream.Pipeline(
@@ -141,10 +158,9 @@ class SimSoC(SoCCore):
         self.comb += usb.connect.eq(1)
 
         # Etherbone --------------------------------------------------------------------------------
-        self.submodules.ethphy = LiteEthPHYModel(self.platform.request("eth"))
-        self.add_etherbone(phy=self.ethphy, ip_address="192.168.42.50")
-
-        from litescope import LiteScopeAnalyzer
+        if with_etherbone:
+            self.submodules.ethphy = LiteEthPHYModel(self.platform.request("eth"))
+            self.add_etherbone(phy=self.ethphy, ip_address="192.168.42.50")
 
         self.nclks = nclks = Signal(64)
         self.sync += nclks.eq(nclks + 1)
@@ -173,76 +189,96 @@ class SimSoC(SoCCore):
         # display_signal(self, usb_sim_phy.source.valid)
         # display_signal(self, usb_sim_phy.sink.valid)
 
-        analyzer_signals = list(
-            set(
-                [
-                    # serial2udp_pads,
-                    # self.fixup.utmi,
-                    self.usb.utmi,
-                    self.usb.dev_la,
-                    self.usb.td_la,
-                    self.usb.td_la_speed,
-                    self.usb.td_la_address,
-                    # self.usb.td_la_cnt_dbg,
-                    self.usb.td_la_state,
-                    # self.usb.td_la_rx_data,
-                    # *get_signals(self.fixup, recurse=True),
-                    # *get_signals(usb_sim_phy, recurse=True),
-                ]
+        # Analyzer ---------------------------------------------------------------------------------
+        if with_analyzer:
+            from liteluna.analyzer import USBAnalyzer
+
+            self.submodules.analyzer = USBAnalyzer.from_streamer(
+                usb, depth=4096, csr_csv="analyzer.csv"
             )
-        )
-        # self.submodules.analyzer = LiteScopeAnalyzer(
-        #     analyzer_signals, depth=4096, clock_domain="usb", csr_csv="analyzer.csv"
-        # )
 
 
-#
-# Main ---------------------------------------------------------------------------------------------
+# Sim config ---------------------------------------------------------------------------------------
 
+SYS_CLK_FREQ = 1000000000000 / 16680
+USB_PORT = 2443
 
-def main():
-    parser = argparse.ArgumentParser(description="LiteEth Bench Simulation")
-    parser.add_argument("--opt-level", default="O3", help="Verilator optimization level")
-    parser.add_argument("--debug-soc-gen", action="store_true", help="Don't run simulation")
-    builder_args(parser)
-    soc_core_args(parser)
-    args = parser.parse_args()
-
-    # sys_clk_freq = int(60e6)
-    sys_clk_freq = 1000000000000 / 16680
 
+def get_sim_config(sys_clk_freq=SYS_CLK_FREQ, port=USB_PORT, with_etherbone=True):
     sim_config = SimConfig()
     sim_config.add_clocker("sys_clk", freq_hz=sys_clk_freq)
-    sim_config.add_module("ethernet", "eth", args={"interface": "tap0", "ip": "192.168.42.100"})
-    # sim_config.add_module(
-    #     "serial2framed_tcp", "serial_framed_tcp", args={"port": "2443", "connect_ip": "127.0.0.1"}
-    # )
+    if with_etherbone:
+        sim_config.add_module("ethernet", "eth", args={"interface": "tap0", "ip": "192.168.42.100"})
     sim_config.add_module(
-        "serial2framed_tcp", "serial_framed_tcp", args={"port": "2443", "connect_ip": "127.0.0.1"}
+        "serial2framed_tcp",
+        "serial_framed_tcp",
+        args={"port": str(port), "connect_ip": "127.0.0.1"},
     )
+    return sim_config
 
-    soc_kwargs = soc_core_argdict(args)
-    builder_kwargs = builder_argdict(args)
 
+def get_soc_kwargs(args, sys_clk_freq=SYS_CLK_FREQ):
+    soc_kwargs = soc_core_argdict(args)
     soc_kwargs["sys_clk_freq"] = sys_clk_freq
     soc_kwargs["cpu_type"] = "None"
     soc_kwargs["uart_name"] = "stub"
     soc_kwargs["ident_version"] = True
+    return soc_kwargs
 
+
+# Main ---------------------------------------------------------------------------------------------
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LiteEth Bench Simulation")
+    parser.add_argument("--opt-level", default="O3", help="Verilator optimization level")
+    parser.add_argument("--debug-soc-gen", action="store_true", help="Don't run simulation")
+    parser.add_argument("--port", type=int, default=USB_PORT, help="USB framed-TCP host port")
+    parser.add_argument("--no-etherbone", action="store_true", help="Leave out the Etherbone tap")
+    parser.add_argument("--with-stats", action="store_true", help="Add USB traffic counter CSRs")
+    parser.add_argument(
+        "--with-analyzer", action="store_true", help="Add a USBAnalyzer (see liteluna.capture)"
+    )
+    parser.add_argument(
+        "--time-scale", type=float, default=1, help="Divide USB reset/chirp/idle timing by this"
+    )
+    parser.add_argument(
+        "--reuse-build",
+        action="store_true",
+        help="Skip the Verilator compile if sources are unchanged",
+    )
+    builder_args(parser)
+    soc_core_args(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with_etherbone = not args.no_etherbone
+    sim_config = get_sim_config(port=args.port, with_etherbone=with_etherbone)
+
+    soc_kwargs = get_soc_kwargs(args)
+    builder_kwargs = builder_argdict(args)
     builder_kwargs["csr_csv"] = "csr.csv"
 
-    soc = SimSoC(**soc_kwargs)
+    soc = SimSoC(
+        with_etherbone=with_etherbone,
+        with_stats=args.with_stats,
+        with_analyzer=args.with_analyzer,
+        sim_time_scale=args.time_scale,
+        **soc_kwargs,
+    )
     if not args.debug_soc_gen:
         builder = Builder(soc, **builder_kwargs)
-        for i in range(2):
-            build = i == 0
-            run = i == 1 and builder.compile_gateware
-            builder.build(
-                build=build,
-                run=run,
-                sim_config=sim_config,
-                opt_level=args.opt_level,
-            )
+        build_cache = SimBuildCache(builder.gateware_dir)
+        with build_cache.patch() if args.reuse_build else contextlib.nullcontext():
+            for i in range(2):
+                build = i == 0
+                run = i == 1 and builder.compile_gateware
+                builder.build(
+                    build=build,
+                    run=run,
+                    sim_config=sim_config,
+                    opt_level=args.opt_level,
+                )
 
 
 if __name__ == "__main__":
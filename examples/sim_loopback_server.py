@@ -1,327 +1,71 @@
 #!/usr/bin/env python3
 
-import socket
-import time
-
-from usbip_toolkit.usb import *
-
-DEV_ADDR = 0x2B
-
-serv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-serv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-serv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-serv_sock.bind(("localhost", 2443))
-serv_sock.listen(1)
-
-s, _ = serv_sock.accept()
-
-
-def get_odd(reset=False):
-    get_odd.odd = getattr(get_odd, "odd", False)
-    if reset:
-        get_odd.odd = False
-    odd = get_odd.odd
-    get_odd.odd = not get_odd.odd
-    return odd
-
-
-def read():
-    sz_buf = s.recv(4)
-    sz = int.from_bytes(sz_buf, "big")
-    buf = s.recv(sz)
-    print(f"d2h_raw: {buf.hex(' ')}", flush=True)
-    return buf
-
-
-def write(bufs):
-    if not isinstance(bufs, list):
-        bufs = [bufs]
-    out_buf = b""
-    for buf in bufs:
-        out_buf += len(buf).to_bytes(4, "big") + buf
-        print(f"h2d_raw: {buf.hex(' ')}", flush=True)
-    s.send(out_buf)
-
-
-def sof():
-    sof.num = getattr(sof, "num", 0)
-    num = sof.num
-    sof.num += 1
-    return sof_packet(num)
-
-
-# while True:
-#     rxb = read()
-#     print(f"rx: {rxb.hex()}")
-#     write(rxb)
-
-# time.sleep(7)
-
-# input("Press ANY key\n")
-
-while True:
-    sof1_packet = sof()
-    print(f"sof1_packet: {sof1_packet.hex()}")
-    sof2_packet = sof()
-    print(f"sof2_packet: {sof2_packet.hex()}")
-
-    setup_token = setup_token_packet(0, 0)
-    print(f"setup_token: {setup_token.hex()}")
-
-    setup_data = setup_data_packet(Recip.DEVICE, Dir.OUT, Req.SET_ADDRESS, DEV_ADDR, 0, 0)
-    print(f"setup_data: {setup_data.hex()}")
-
-    write([sof1_packet, sof2_packet, setup_token, setup_data])
-
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-
-    sof3_packet = sof()
-
-    in_token = in_token_packet(0, 0)
-    print(f"in_token: {in_token.hex()}")
-    write([sof3_packet, in_token])
-    # write(in_token)
-
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-    write(ack_packet())
-
-    # time.sleep(10)
-
-    print("get descriptor device")
-    sof4 = sof()
-    setup_token = setup_token_packet(DEV_ADDR, 0)
-    print(f"setup_token: {setup_token.hex()}")
-    setup_data = setup_data_packet(
-        Recip.DEVICE, Dir.IN, Req.GET_DESCRIPTOR, DescType.DEVICE, 0, 0x12
+import argparse
+import contextlib
+import sys
+
+from liteluna.pattern import Pattern, PatternChecker
+from liteluna.sim.pcap import PcapngWriter
+from liteluna.sim.server import DEFAULT_PORT, run_server
+from liteluna.sim.trace import RecordingLink, TraceWriter
+from liteluna.sim.usb_host import USBHost
+
+
+def make_handler(args):
+    async def handler(conn):
+        port = conn.transport.get_extra_info("sockname")[1]
+        with contextlib.ExitStack() as stack:
+            link = conn
+            if args.record:
+                recorder = stack.enter_context(TraceWriter(args.record.format(port=port)))
+                link = RecordingLink(link, recorder)
+            if args.pcap:
+                writer = PcapngWriter(args.pcap.format(port=port), bus_clock=True)
+                link = RecordingLink(link, stack.enter_context(writer))
+            await run(link)
+
+    async def run(conn):
+        host = USBHost(conn, trace=sys.stdout if args.trace else None)
+        await host.enumerate()
+        print(f"enumerated at address {host.address}: {host.strings}")
+        for ep in host.endpoints.values():
+            print(f"  {ep}")
+
+        for obuf in (b"\xaa\x55\x00\xff", b"\xde\xea\xbe\xef"):
+            await host.bulk_out(args.endpoint, obuf)
+            ibuf = await host.bulk_in(args.endpoint, len(obuf))
+            print(f"loopback {obuf.hex()} -> {ibuf.hex()}")
+            assert ibuf == bytes(b ^ 0xFF for b in obuf)
+
+        pattern = Pattern(args.pattern)
+        checker = PatternChecker(Pattern(args.pattern), invert=True)
+        for _ in range(args.count):
+            await host.bulk_out(args.endpoint, pattern.next(args.size))
+            checker.check(await host.bulk_in(args.endpoint, args.size))
+        print(checker.summary())
+
+    return handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Enumerate and exercise a simulated loopback")
+    parser.add_argument("--host", default="localhost", help="Listen address")
+    parser.add_argument("--port", type=int, nargs="+", default=[DEFAULT_PORT], help="Listen ports")
+    parser.add_argument("--endpoint", type=int, default=1, help="Bulk endpoint number")
+    parser.add_argument("--pattern", choices=Pattern.KINDS, default="lfsr", help="Data pattern")
+    parser.add_argument("--size", type=int, default=512, help="Bytes per bulk transfer")
+    parser.add_argument("--count", type=int, default=16, help="Pattern transfers per simulation")
+    parser.add_argument("--trace", action="store_true", help="Print every packet (replayable)")
+    parser.add_argument(
+        "--record", help="Record packets to a binary trace file; {port} expands to the listen port"
     )
-    print(f"setup_data: {setup_data.hex()}")
-    write([sof4, setup_token, setup_data])
-    get_odd(reset=True)
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-
-    in_token = in_token_packet(DEV_ADDR, 0)
-    write(in_token)
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-    write(ack_packet())
-
-    out_token = out_token_packet(DEV_ADDR, 0)
-    print(f"out_token: {out_token.hex()}")
-    out_packet = data_packet(b"", odd=get_odd())
-    print(f"out_packet: {out_packet.hex()}")
-    write([out_token, out_packet])
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-
-    print("get descriptor config probe")
-    setup_token = setup_token_packet(DEV_ADDR, 0)
-    print(f"setup_token: {setup_token.hex()}")
-    setup_data = setup_data_packet(
-        Recip.DEVICE, Dir.IN, Req.GET_DESCRIPTOR, DescType.CONFIGURATION, 0, 9
-    )
-    print(f"setup_data: {setup_data.hex()}")
-    write([sof(), setup_token, setup_data])
-    get_odd(reset=True)
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-
-    in_token = in_token_packet(DEV_ADDR, 0)
-    write(in_token)
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-    write(ack_packet())
-
-    out_token = out_token_packet(DEV_ADDR, 0)
-    print(f"out_token: {out_token.hex()}")
-    out_packet = data_packet(b"", odd=get_odd())
-    print(f"out_packet: {out_packet.hex()}")
-    write([out_token, out_packet])
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-
-    print("get descriptor config full")
-    setup_token = setup_token_packet(DEV_ADDR, 0)
-    print(f"setup_token: {setup_token.hex()}")
-    setup_data = setup_data_packet(
-        Recip.DEVICE, Dir.IN, Req.GET_DESCRIPTOR, DescType.CONFIGURATION, 0, 32
-    )
-    print(f"setup_data: {setup_data.hex()}")
-    write([sof(), setup_token, setup_data])
-    get_odd(reset=True)
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-
-    in_token = in_token_packet(DEV_ADDR, 0)
-    write(in_token)
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-    write(ack_packet())
-
-    out_token = out_token_packet(DEV_ADDR, 0)
-    print(f"out_token: {out_token.hex()}")
-    out_packet = data_packet(b"", odd=get_odd())
-    print(f"out_packet: {out_packet.hex()}")
-    write([out_token, out_packet])
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-
-    print("get string 0")
-    setup_token = setup_token_packet(DEV_ADDR, 0)
-    print(f"setup_token: {setup_token.hex()}")
-    setup_data = setup_data_packet(
-        Recip.DEVICE, Dir.IN, Req.GET_DESCRIPTOR, DescType.STRING | 0, 0, 0xFF
+    parser.add_argument(
+        "--pcap", help="Write packets to a pcapng file for Wireshark; {port} expands likewise"
     )
-    print(f"setup_data: {setup_data.hex()}")
-    write([sof(), setup_token, setup_data])
-    get_odd(reset=True)
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-
-    in_token = in_token_packet(DEV_ADDR, 0)
-    write(in_token)
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-    write(ack_packet())
-
-    out_token = out_token_packet(DEV_ADDR, 0)
-    print(f"out_token: {out_token.hex()}")
-    out_packet = data_packet(b"", odd=get_odd())
-    print(f"out_packet: {out_packet.hex()}")
-    write([out_token, out_packet])
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-
-    print("get string 2")
-    setup_token = setup_token_packet(DEV_ADDR, 0)
-    print(f"setup_token: {setup_token.hex()}")
-    setup_data = setup_data_packet(
-        Recip.DEVICE, Dir.IN, Req.GET_DESCRIPTOR, DescType.STRING | 2, 0x0409, 0xFF
-    )
-    print(f"setup_data: {setup_data.hex()}")
-    write([sof(), setup_token, setup_data])
-    get_odd(reset=True)
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-
-    in_token = in_token_packet(DEV_ADDR, 0)
-    write(in_token)
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-    write(ack_packet())
-
-    out_token = out_token_packet(DEV_ADDR, 0)
-    print(f"out_token: {out_token.hex()}")
-    out_packet = data_packet(b"", odd=get_odd())
-    print(f"out_packet: {out_packet.hex()}")
-    write([out_token, out_packet])
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-
-    print("get string 1")
-    setup_token = setup_token_packet(DEV_ADDR, 0)
-    print(f"setup_token: {setup_token.hex()}")
-    setup_data = setup_data_packet(
-        Recip.DEVICE, Dir.IN, Req.GET_DESCRIPTOR, DescType.STRING | 1, 0x0409, 0xFF
-    )
-    print(f"setup_data: {setup_data.hex()}")
-    write([sof(), setup_token, setup_data])
-    get_odd(reset=True)
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-
-    in_token = in_token_packet(DEV_ADDR, 0)
-    write(in_token)
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-    write(ack_packet())
-
-    out_token = out_token_packet(DEV_ADDR, 0)
-    print(f"out_token: {out_token.hex()}")
-    out_packet = data_packet(b"", odd=get_odd())
-    print(f"out_packet: {out_packet.hex()}")
-    write([out_token, out_packet])
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-
-    print("get string 3")
-    setup_token = setup_token_packet(DEV_ADDR, 0)
-    print(f"setup_token: {setup_token.hex()}")
-    setup_data = setup_data_packet(
-        Recip.DEVICE, Dir.IN, Req.GET_DESCRIPTOR, DescType.STRING | 3, 0x0409, 0xFF
-    )
-    print(f"setup_data: {setup_data.hex()}")
-    write([sof(), setup_token, setup_data])
-    get_odd(reset=True)
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-
-    in_token = in_token_packet(DEV_ADDR, 0)
-    write(in_token)
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-    write(ack_packet())
-
-    out_token = out_token_packet(DEV_ADDR, 0)
-    print(f"out_token: {out_token.hex()}")
-    out_packet = data_packet(b"", odd=get_odd())
-    print(f"out_packet: {out_packet.hex()}")
-    write([out_token, out_packet])
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-
-    print("set configuration")
-    setup_token = setup_token_packet(DEV_ADDR, 0)
-    print(f"setup_token: {setup_token.hex()}")
-    setup_data = setup_data_packet(Recip.DEVICE, Dir.IN, Req.SET_CONFIGURATION, 1, 0, 0)
-    print(f"setup_data: {setup_data.hex()}")
-    write([sof(), setup_token, setup_data])
-    get_odd(reset=True)
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-
-    in_token = in_token_packet(DEV_ADDR, 0)
-    write(in_token)
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-    write(ack_packet())
-
-    print("loopback bulk endpoint test write")
-    out_token = out_token_packet(DEV_ADDR, 1)
-    print(f"out_token: {out_token.hex()}")
-    # FIXME: HACK why isn't the sequence bit right
-    get_odd()
-    out_packet = data_packet(b"\xaa\x55\x00\xff", odd=get_odd())
-    print(f"out_packet: {out_packet.hex()}")
-    write([out_token, out_packet])
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-
-    print("loopback bulk endpoint test read")
-    in_token = in_token_packet(DEV_ADDR, 1)
-    print(f"in_token: {in_token.hex()}")
-    write(in_token)
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-    write(ack_packet())
+    args = parser.parse_args()
 
-    print("loopback bulk endpoint test write 2")
-    out_token = out_token_packet(DEV_ADDR, 1)
-    print(f"out_token: {out_token.hex()}")
-    out_packet = data_packet(b"\xde\xea\xbe\xef", odd=get_odd())
-    print(f"out_packet: {out_packet.hex()}")
-    write([out_token, out_packet])
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
+    run_server(make_handler(args), args.host, args.port)
 
-    print("loopback bulk endpoint test read 2")
-    in_token = in_token_packet(DEV_ADDR, 1)
-    print(f"in_token: {in_token.hex()}")
-    write(in_token)
-    in_buf = read()
-    print(f"in_buf: {in_buf.hex()}")
-    write(ack_packet())
 
-    input("Press ANY key\n")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2022 Jevin Sweval <jevinsweval@gmail.com>
+# SPDX-License-Identifier: BSD-2-Clause
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from liteluna.pattern import Pattern, PatternChecker
+from liteluna.sim.replay import Replayer, open_capture
+from liteluna.sim.server import FramedTCPServer
+from liteluna.sim.usb_host import USBHost
+
+SCHEMA_VERSION = 1
+
+# Stimulus -----------------------------------------------------------------------------------------
+
+
+async def stim_enumerate(conn, result):
+    host = USBHost(conn)
+    await host.enumerate()
+    result["endpoints"] = sorted(host.endpoints)
+    return bool(host.endpoints)
+
+
+async def stim_bulk(conn, result, size, count=16):
+    host = USBHost(conn)
+    await host.enumerate()
+    pattern = Pattern("lfsr", seed=size)
+    checker = PatternChecker(Pattern("lfsr", seed=size), invert=True)
+    for _ in range(count):
+        await host.bulk_out(1, pattern.next(size))
+        checker.check(await host.bulk_in(1, size))
+    result.update(bytes=checker.offset, errors=checker.error_bytes, first_error=checker.first_error)
+    return checker.ok and checker.offset == size * count
+
+
+async def stim_replay(conn, result, path):
+    replayer = Replayer(conn)
+    summary = await replayer.run(open_capture(path))
+    result.update(compared=summary.compared, mismatches=summary.mismatches, retries=summary.retries)
+    return summary.ok
+
+
+def parse_stimulus(spec):
+    kind, _, arg = spec.partition(":")
+    if kind == "enumerate":
+        return stim_enumerate, ()
+    if kind == "bulk":
+        return stim_bulk, tuple(int(v, 0) for v in arg.split(":"))
+    if kind == "replay":
+        return stim_replay, (arg,)
+    raise ValueError(f"unknown stimulus {spec!r}")
+
+
+# Instances ----------------------------------------------------------------------------------------
+
+
+def prepare_instance(gateware_dir, instance_dir, port):
+    # everything but sim_config.js is shared with the build through symlinks
+    os.makedirs(instance_dir, exist_ok=True)
+    for name in os.listdir(gateware_dir):
+        if name == "sim_config.js":
+            continue
+        link = os.path.join(instance_dir, name)
+        if not os.path.lexists(link):
+            os.symlink(os.path.abspath(os.path.join(gateware_dir, name)), link)
+    with open(os.path.join(gateware_dir, "sim_config.js")) as f:
+        config = json.load(f)
+    for module in config:
+        if module.get("module") == "serial2framed_tcp":
+            module["args"]["port"] = str(port)
+    with open(os.path.join(instance_dir, "sim_config.js"), "w") as f:
+        json.dump(config, f, indent=4)
+
+
+async def run_instance_async(job):
+    spec, port, instance_dir, timeout = job["stimulus"], job["port"], job["dir"], job["timeout"]
+    stimulus, stim_args = parse_stimulus(spec)
+    result = {"stimulus": spec, "port": port, "dir": instance_dir, "passed": False}
+    done = asyncio.get_running_loop().create_future()
+
+    async def handler(conn):
+        try:
+            done.set_result(await stimulus(conn, result, *stim_args))
+        except Exception as e:
+            done.set_exception(e)
+
+    t0 = time.perf_counter()
+    async with FramedTCPServer(handler, "127.0.0.1", [port]):
+        with open(os.path.join(instance_dir, "sim.log"), "wb") as log:
+            sim = None
+            try:
+                sim = await asyncio.create_subprocess_exec(
+                    os.path.join(instance_dir, "obj_dir", "Vsim"),
+                    cwd=instance_dir,
+                    stdout=log,
+                    stderr=asyncio.subprocess.STDOUT,
+                )
+                exited = asyncio.ensure_future(sim.wait())
+                await asyncio.wait({done, exited}, timeout=timeout, return_when="FIRST_COMPLETED")
+                if done.done():
+                    result["passed"] = done.result()
+                elif exited.done():
+                    result["error"] = f"simulator exited with {sim.returncode}"
+                else:
+                    result["error"] = f"timed out after {timeout} s"
+            except Exception as e:
+                result["error"] = f"{type(e).__name__}: {e}"
+            finally:
+                if sim is not None:
+                    if sim.returncode is None:
+                        sim.kill()
+                    await exited
+    result["seconds"] = time.perf_counter() - t0
+    return result
+
+
+def run_instance(job):
+    return asyncio.run(run_instance_async(job))
+
+
+# Build --------------------------------------------------------------------------------------------
+
+
+def build(args):
+    from litex.soc.integration.builder import Builder, builder_argdict
+    from sim_loopback import SimSoC, get_sim_config, get_soc_kwargs
+
+    from liteluna.sim.build import SimBuildCache
+
+    soc = SimSoC(with_etherbone=False, sim_time_scale=args.time_scale, **get_soc_kwargs(args))
+    builder = Builder(soc, **builder_argdict(args))
+    with SimBuildCache(builder.gateware_dir).patch():
+        builder.build(
+            build=True,
+            run=False,
+            sim_config=get_sim_config(port=args.base_port, with_etherbone=False),
+            opt_level=args.opt_level,
+        )
+        # run=False stops after writing build_sim.sh, the instances need obj_dir/Vsim
+        compile_sim(builder.gateware_dir)
+    return builder.gateware_dir
+
+
+def compile_sim(gateware_dir, build_name="sim"):
+    from litex.build.sim import verilator
+
+    cwd = os.getcwd()
+    os.chdir(gateware_dir)
+    try:
+        verilator._compile_sim(build_name, verbose=False)
+    finally:
+        os.chdir(cwd)
+
+
+# Main ---------------------------------------------------------------------------------------------
+
+
+def main():
+    from litex.soc.integration.builder import builder_args
+    from litex.soc.integration.soc_core import soc_core_args
+
+    parser = argparse.ArgumentParser(description="Parallel LiteLUNA simulation regressions")
+    parser.add_argument(
+        "stimulus",
+        nargs="*",
+        default=["enumerate", "bulk:4", "bulk:512", "bulk:4096"],
+        help="enumerate, bulk:SIZE[:COUNT] or replay:PATH",
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="Instances per stimulus")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Parallel simulations")
+    parser.add_argument("--base-port", type=int, default=2443, help="First framed-TCP port")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds per simulation")
+    parser.add_argument("--no-build", action="store_true", help="Reuse the existing gateware dir")
+    parser.add_argument(
+        "--time-scale", type=float, default=1, help="Divide USB reset/chirp/idle timing by this"
+    )
+    parser.add_argument("--opt-level", default="O3", help="Verilator optimization level")
+    parser.add_argument("--results", default="regress.json", help="Aggregated JSON results")
+    builder_args(parser)
+    soc_core_args(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.no_build:
+        gateware_dir = os.path.join(args.output_dir or os.path.join("build", "sim"), "gateware")
+    else:
+        gateware_dir = build(args)
+    instances_dir = os.path.join(os.path.dirname(os.path.abspath(gateware_dir)), "instances")
+
+    jobs = []
+    for spec in args.stimulus:
+        parse_stimulus(spec)
+        for _ in range(args.repeat):
+            port = args.base_port + len(jobs)
+            instance_dir = os.path.join(instances_dir, f"{len(jobs):03d}")
+            prepare_instance(gateware_dir, instance_dir, port)
+            jobs.append(
+                {"stimulus": spec, "port": port, "dir": instance_dir, "timeout": args.timeout}
+            )
+
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        results = []
+        for result in pool.map(run_instance, jobs):
+            status = "PASS" if result["passed"] else "FAIL"
+            print(f"{status} {result['stimulus']} ({result['seconds']:.1f} s) {result['dir']}")
+            if "error" in result:
+                print(f"     {result['error']}")
+            results.append(result)
+    elapsed = time.perf_counter() - t0
+
+    passed = sum(result["passed"] for result in results)
+    print(f"{passed}/{len(results)} passed in {elapsed:.1f} s with {args.jobs} jobs")
+    with open(args.results, "w") as f:
+        report = {
+            "schema": SCHEMA_VERSION,
+            "timestamp": time.time(),
+            "jobs": args.jobs,
+            "seconds": elapsed,
+            "passed": passed,
+            "failed": len(results) - passed,
+            "results": results,
+        }
+        json.dump(report, f, indent=2)
+    sys.exit(0 if passed == len(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,70 +1,37 @@
 #!/usr/bin/env python3
 
-import socket
+import argparse
 import sys
-import time
 
-replay_lines = [l.strip() for l in open(sys.argv[1]).readlines()]
+from liteluna.sim.replay import Replayer, open_capture
+from liteluna.sim.server import DEFAULT_PORT, run_server
 
-serv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-serv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-serv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-serv_sock.bind(("localhost", 2443))
-serv_sock.listen(1)
 
-s, _ = serv_sock.accept()
-s.settimeout(10)
+def make_handler(args):
+    async def handler(conn):
+        log = sys.stdout if args.verbose else None
+        replayer = Replayer(conn, timeout=args.timeout, max_retries=args.max_retries, log=log)
+        devices = set(args.device) if args.device else None
+        await replayer.run(open_capture(args.replay, devices))
+        await replayer.drain_extra()
+        print(f"{conn.peer}: {replayer.summary.summary()}")
 
+    return handler
 
-def read():
-    sz_buf = s.recv(4)
-    sz = int.from_bytes(sz_buf, "big")
-    buf = s.recv(sz)
-    if all([b == 0 for b in buf]) and len(buf) > 64:
-        return
-    # print(f"d2h_raw: {buf.hex(' ')}", flush=True)
-    return buf
 
+def main():
+    parser = argparse.ArgumentParser(description="Replay a captured host session to simulations")
+    parser.add_argument("replay", help="h2d/d2h log, liteluna trace, pcapng or Data Center CSV")
+    parser.add_argument("--host", default="localhost", help="Listen address")
+    parser.add_argument("--port", type=int, nargs="+", default=[DEFAULT_PORT], help="Listen ports")
+    parser.add_argument("--device", type=int, nargs="+", help="usbmon device addresses to replay")
+    parser.add_argument("--timeout", type=float, default=10, help="Seconds to wait per response")
+    parser.add_argument("--max-retries", type=int, default=100, help="Resends after a NAK")
+    parser.add_argument("--verbose", action="store_true", help="Print comments and mismatches")
+    args = parser.parse_args()
 
-def write(bufs):
-    if not isinstance(bufs, list):
-        bufs = [bufs]
-    out_buf = b""
-    for buf in bufs:
-        smsg = len(buf).to_bytes(4, "big") + buf
-        out_buf += smsg
-        time.sleep(0.1)
-        s.send(smsg)
-        # print(f"h2d_raw: {buf.hex(' ')}", flush=True)
-    # s.send(out_buf)
+    run_server(make_handler(args), args.host, args.port)
 
 
-for rl in replay_lines:
-    if rl.startswith("#"):
-        print(rl)
-    if rl.startswith("h2d_raw: ") or rl.startswith("h2d: "):
-        hs = rl.removeprefix("h2d_raw: ")
-        hs = hs.removeprefix("h2d: ")
-        obuf = bytes.fromhex(hs)
-        print(f"h2d: {obuf.hex(' ')}")
-        write(obuf)
-    if rl.startswith("d2h_raw: ") or rl.startswith("d2h: "):
-        hs = rl.removeprefix("d2h_raw: ")
-        hs = hs.removeprefix("d2h: ")
-        ibuf_gold = bytes.fromhex(hs)
-        print(f"ibuf expected: {ibuf_gold.hex(' ')}")
-        ibuf = read()
-        print(f"ibuf actual:   {ibuf.hex(' ')}")
-        if ibuf != ibuf_gold:
-            print("MISMATCH")
-
-s.settimeout(1)
-i = 0
-while True:
-    try:
-        ibuf = read()
-        print(f"extra ibuf {i}: {ibuf.hex(' ')}")
-        i += 1
-    except TimeoutError:
-        print("no more leftovers")
-        break
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import argparse
+import time
+
+from litex import RemoteClient
+
+
+def read_stats(bus, prefix="usb_stats"):
+    getattr(bus.regs, f"{prefix}_update").write(1)
+    stats = {}
+    for name in dir(bus.regs):
+        if name.startswith(f"{prefix}_") and name not in (f"{prefix}_update", f"{prefix}_clear"):
+            stats[name.removeprefix(f"{prefix}_")] = getattr(bus.regs, name).read()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read USBStreamer traffic counters over a bridge")
+    parser.add_argument("--csr-csv", default="csr.csv", help="SoC CSV register map")
+    parser.add_argument("--host", default="localhost", help="litex_server address")
+    parser.add_argument("--port", type=int, default=1234, help="litex_server port")
+    parser.add_argument("--prefix", default="usb_stats", help="CSR name prefix of the stats block")
+    parser.add_argument("--clear", action="store_true", help="Zero the counters first")
+    parser.add_argument("--interval", type=float, help="Keep printing rates every N seconds")
+    args = parser.parse_args()
+
+    bus = RemoteClient(host=args.host, port=args.port, csr_csv=args.csr_csv)
+    bus.open()
+    try:
+        if args.clear:
+            getattr(bus.regs, f"{args.prefix}_clear").write(1)
+        previous = read_stats(bus, args.prefix)
+        for name, value in previous.items():
+            print(f"{name:32} {value}")
+        while args.interval:
+            time.sleep(args.interval)
+            stats = read_stats(bus, args.prefix)
+            rates = {
+                name: ((value - previous[name]) & 0xFFFFFFFF) / args.interval
+                for name, value in stats.items()
+                if not name.endswith("_max")
+            }
+            print(", ".join(f"{name} {rate:.0f}/s" for name, rate in rates.items() if rate))
+            previous = stats
+    finally:
+        bus.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,3 @@
-from liteluna import luna_cores, packet, stream, ulpi, usbbone, utmi
+from liteluna import luna_cores, packet, pattern, stats, stream, ulpi, usbbone, utmi
 
 __version__ = "0.1.0"
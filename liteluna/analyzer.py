@@ -0,0 +1,195 @@
+from functools import reduce
+from operator import or_
+
+from litescope import LiteScopeAnalyzer
+from litescope.core import _Mux, _Storage, _SubSampler, _Trigger, core_layout
+from litex.soc.interconnect import stream
+from litex.soc.interconnect.csr import AutoCSR, CSRField, CSRStorage
+from migen import *
+from migen.genlib.cdc import MultiReg
+
+from liteluna.luna_cores.bulk_streamer import NAK_PID
+
+TRIGGER_SOURCES = ["pid", "token", "frame", "nak", "rx_error"]
+
+
+class USBTrigger(Module, AutoCSR):
+    """Decoded USB trigger conditions on a UTMI bus, evaluated in ``cd_usb``.
+
+    ``trigger`` pulses for every event of an enabled source:
+
+    - ``pid``: a packet (either direction) whose PID matches ``pid``/``pid_mask``
+    - ``token``: a token from ``token`` (``TokenDetectorInterface``) matching ``token_pid``,
+      ``address`` and ``endpoint`` with their masks
+    - ``frame``: a SOF whose frame number matches ``frame``/``frame_mask``
+    - ``nak``: the device answers with a NAK
+    - ``rx_error``: the PHY flags a receive error
+
+    A mask bit of 0 is a don't care, so with the reset masks every packet, token or SOF matches.
+    """
+
+    def __init__(self, utmi, token=None, cd="sys", cd_usb="usb"):
+        self.trigger = Signal()
+        self.pid = Signal(4)
+        self.packet_start = Signal()
+
+        self._enable = CSRStorage(
+            fields=[
+                CSRField(name, size=1, description=f"Trigger on ``{name}`` events.")
+                for name in TRIGGER_SOURCES
+            ]
+        )
+        enable = Signal(len(TRIGGER_SOURCES))
+        self._sync_config(self._enable.storage, enable, cd, cd_usb)
+        enable = dict(zip(TRIGGER_SOURCES, enable))
+
+        # packet starts ----------------------------------------------------------------------------
+        rx_active_d = Signal()
+        tx_valid_d = Signal()
+        rx_error_d = Signal()
+        rx_pid_pending = Signal()
+        rx_start = Signal()
+        tx_start = Signal()
+        sync_usb = getattr(self.sync, cd_usb)
+        sync_usb += [
+            rx_active_d.eq(utmi.rx_active),
+            tx_valid_d.eq(utmi.tx_valid),
+            rx_error_d.eq(utmi.rx_error),
+            If(rx_start | ~utmi.rx_active, rx_pid_pending.eq(0)).Elif(
+                ~rx_active_d, rx_pid_pending.eq(1)
+            ),
+        ]
+        # the first byte of a received packet is its PID; chirps are not packets
+        self.comb += [
+            rx_start.eq(utmi.rx_active & utmi.rx_valid & (rx_pid_pending | ~rx_active_d)),
+            tx_start.eq(utmi.tx_valid & ~tx_valid_d & (utmi.op_mode == 0)),
+            self.packet_start.eq(rx_start | tx_start),
+            self.pid.eq(Mux(tx_start, utmi.tx_data[:4], utmi.rx_data[:4])),
+        ]
+
+        # sources ----------------------------------------------------------------------------------
+        hits = {
+            "pid": self.packet_start & self._add_match("pid", self.pid, cd, cd_usb),
+            "nak": tx_start & (utmi.tx_data == NAK_PID),
+            "rx_error": utmi.rx_error & ~rx_error_d,
+        }
+        if token is not None:
+            hits["token"] = (
+                token.new_token
+                & self._add_match("token_pid", token.pid, cd, cd_usb)
+                & self._add_match("address", token.address, cd, cd_usb)
+                & self._add_match("endpoint", token.endpoint, cd, cd_usb)
+            )
+            hits["frame"] = token.new_frame & self._add_match("frame", token.frame, cd, cd_usb)
+        self.comb += self.trigger.eq(
+            reduce(or_, [enable[name] & hit for name, hit in hits.items()])
+        )
+
+    def _add_match(self, name, value, cd, cd_usb):
+        width = len(value)
+        for suffix in ("", "_mask"):
+            storage = CSRStorage(width, name=f"{name}{suffix}")
+            setattr(self, f"_{name}{suffix}", storage)
+            setattr(self, f"{name}{suffix}", Signal(width))
+            self._sync_config(storage.storage, getattr(self, f"{name}{suffix}"), cd, cd_usb)
+        reference, mask = getattr(self, name), getattr(self, f"{name}_mask")
+        return ((value ^ reference) & mask) == 0
+
+    def _sync_config(self, storage, value, cd, cd_usb):
+        # configuration is static while armed, so a MultiReg is enough to cross into cd_usb
+        if cd_usb != cd:
+            self.specials += MultiReg(storage, value, odomain=cd_usb)
+        else:
+            self.comb += value.eq(storage)
+
+
+class USBAnalyzer(LiteScopeAnalyzer):
+    """LiteScope preset for USB traffic on a UTMI bus.
+
+    Only cycles with ``rx_active`` or ``tx_valid`` set (plus the one after, which marks the end
+    of the packet, and trigger cycles) are stored, so idle time and SOF gaps cost no memory. Each
+    sample holds the bus byte (``tx_data`` while ``tx_valid``, else ``rx_data``), the UTMI
+    handshake bits, the ``USBTrigger`` output as ``usb_trigger`` and a free-running
+    ``timestamp`` in ``clock_domain`` cycles that wraps every ``2**timestamp_width`` cycles.
+
+    Arm it on that signal, e.g. ``analyzer.add_rising_edge_trigger("usb_trigger")`` with
+    ``litescope_cli`` or the ``LiteScopeAnalyzerDriver``, after setting up the ``usb_trigger``
+    CSRs.
+    """
+
+    def __init__(
+        self,
+        utmi,
+        token=None,
+        depth=8192,
+        clock_domain="usb",
+        cd="sys",
+        timestamp_width=16,
+        signals=(),
+        register=True,
+        samplerate=1e12,
+        trigger_depth=16,
+        csr_csv="analyzer.csv",
+    ):
+        self.submodules.usb_trigger = usb_trigger = USBTrigger(
+            utmi, token, cd=cd, cd_usb=clock_domain
+        )
+
+        self.data = Signal(8, name="data")
+        # LiteScopeAnalyzer owns self.trigger
+        self.usb_trigger_out = Signal(name="usb_trigger")
+        self.timestamp = Signal(timestamp_width, name="timestamp")
+        self.qualifier = Signal()
+        active = Signal()
+        active_d = Signal()
+        sync = getattr(self.sync, clock_domain)
+        sync += [self.timestamp.eq(self.timestamp + 1), active_d.eq(active)]
+        self.comb += [
+            self.data.eq(Mux(utmi.tx_valid, utmi.tx_data, utmi.rx_data)),
+            self.usb_trigger_out.eq(usb_trigger.trigger),
+            active.eq(utmi.rx_active | utmi.tx_valid),
+            self.qualifier.eq(active | active_d | usb_trigger.trigger),
+        ]
+
+        self.groups = self.format_groups(
+            [
+                self.data,
+                utmi.rx_active,
+                utmi.rx_valid,
+                utmi.rx_error,
+                utmi.tx_valid,
+                utmi.tx_ready,
+                utmi.line_state,
+                self.usb_trigger_out,
+                self.timestamp,
+                *signals,
+            ]
+        )
+        self.depth = depth
+        self.samplerate = int(samplerate)
+        self.data_width = data_width = sum(len(s) for s in self.groups[0])
+        self.csr_csv = csr_csv
+
+        self.cd_scope = ClockDomain()
+        self.comb += self.cd_scope.clk.eq(ClockSignal(clock_domain))
+
+        # LiteScopeAnalyzer ties its group inputs valid, so the same mux -> trigger -> subsampler
+        # -> storage pipeline is built here behind a storage qualifier: samples only advance the
+        # analyzer while the bus is busy
+        self.sink = sink = stream.Endpoint(core_layout(data_width))
+        sample = [sink.valid.eq(self.qualifier), sink.data.eq(Cat(self.groups[0]))]
+        if register:
+            sync += sample
+        else:
+            self.comb += sample
+        self.mux = _Mux(data_width, 1)
+        self.comb += sink.connect(self.mux.sinks[0])
+        self.trigger = _Trigger(data_width, depth=trigger_depth)
+        self.subsampler = _SubSampler(data_width)
+        self.storage = _Storage(data_width, depth)
+        self.pipeline = stream.Pipeline(self.mux, self.trigger, self.subsampler, self.storage)
+
+    @classmethod
+    def from_streamer(cls, usb, **kwargs):
+        """Taps the ``utmi_la``/``td_la`` ports of a ``USBStreamer(with_utmi_la=True)``."""
+        return cls(usb.utmi_la, usb.td_la, **kwargs)
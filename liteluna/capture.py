@@ -0,0 +1,215 @@
+import argparse
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+import usb1
+from litex import RemoteClient
+
+from liteluna.host import USBboneClient
+from liteluna.sim.pcap import PcapngWriter
+
+# rcount is an 8-bit field of the Etherbone record header
+MAX_READS = 255
+USB_FIELDS = ["data", "rx_active", "rx_valid", "rx_error", "tx_valid", "tx_ready", "timestamp"]
+
+CapturedPacket = namedtuple("CapturedPacket", "cycle inbound data rx_error trigger")
+
+
+class AnalyzerLayout:
+    """Sample layout of a LiteScope ``analyzer.csv``: the signals of a group are packed LSB first
+    in the order they were given to the analyzer."""
+
+    def __init__(self, data_width, depth, signals):
+        self.data_width = data_width
+        self.depth = depth
+        self.signals = signals
+
+    @classmethod
+    def from_csv(cls, path, group=0):
+        config = {}
+        signals = {}
+        offset = 0
+        with open(path) as f:
+            for line in f:
+                if line.startswith("#") or not line.strip():
+                    continue
+                kind, index, name, value = line.strip().split(",")
+                if kind == "config":
+                    config[name] = value
+                elif kind == "signal" and int(index) == group:
+                    signals[name] = (offset, int(value))
+                    offset += int(value)
+        return cls(int(config["data_width"]), int(config["depth"]), signals)
+
+    def find(self, name):
+        """Resolves a short name to a signal, which the exported names carry as a suffix."""
+        if name in self.signals:
+            return name
+        matches = [signal for signal in self.signals if signal.endswith(f"_{name}")]
+        if len(matches) != 1:
+            raise KeyError(f"{len(matches)} analyzer signals match {name!r}: {matches}")
+        return matches[0]
+
+    def width(self, name):
+        return self.signals[self.find(name)][1]
+
+    def unpack(self, samples, names=None):
+        """Slices every (or every named) signal out of ``samples``, one row of 32-bit words per
+        sample with the least significant word first, as whole NumPy columns."""
+        words = np.ascontiguousarray(samples, dtype=np.uint64)
+        fields = {}
+        for name in names or self.signals:
+            offset, width = self.signals[self.find(name)]
+            index, shift = divmod(offset, 32)
+            value = words[:, index] >> np.uint64(shift)
+            bits = 32 - shift
+            while bits < width:
+                index += 1
+                value |= words[:, index] << np.uint64(bits)
+                bits += 32
+            if width < 64:
+                value &= np.uint64((1 << width) - 1)
+            fields[name] = value.astype(np.min_scalar_type((1 << width) - 1))
+        return fields
+
+
+# Upload -------------------------------------------------------------------------------------------
+
+
+def read_fixed(bus, addr, count, max_reads=MAX_READS):
+    """Reads ``count`` words from one address (e.g. pops of a CSR FIFO) in fixed bursts of
+    ``max_reads`` from a ``RemoteClient``, or in a single pipelined burst from a
+    ``USBboneClient``."""
+    if not count:
+        return np.empty(0, dtype=np.uint32)
+    if isinstance(bus, USBboneClient):
+        return np.array(bus.read(addr, count, burst="fixed"), dtype=np.uint32)
+    datas = np.empty(count, dtype=np.uint32)
+    for start in range(0, count, max_reads):
+        length = min(max_reads, count - start)
+        datas[start : start + length] = bus.read(addr, length=length, burst="fixed")
+    return datas
+
+
+def upload(bus, layout, prefix="analyzer"):
+    """Drains a finished LiteScope capture; returns one row of 32-bit words per sample, least
+    significant first."""
+    regs = bus.regs
+    if not getattr(regs, f"{prefix}_storage_done").read():
+        raise IOError(f"{prefix} has not finished capturing")
+    level = getattr(regs, f"{prefix}_storage_mem_level").read()
+    # mem_data is a single 32-bit CSR; every read pops one word of a sample, LSW first
+    words = (layout.data_width + 31) // 32
+    mem_data = getattr(regs, f"{prefix}_storage_mem_data")
+    return read_fixed(bus, mem_data.addr, level * words).reshape(level, words)
+
+
+# USB decode ---------------------------------------------------------------------------------------
+
+
+def decode_usb(layout, samples):
+    """Splits ``USBAnalyzer`` samples into ``CapturedPacket``s.
+
+    A packet starts on an active sample that does not directly follow an active sample of the
+    same direction; ``cycle`` is counted from the first sample by unwrapping ``timestamp``, which
+    is only exact for gaps shorter than its wrap. ``trigger`` flags the packet the trigger fired
+    in (or right after, for token and SOF matches).
+    """
+    fields = layout.unpack(samples, USB_FIELDS + ["usb_trigger"])
+    if not len(samples):
+        return []
+    rx_active = fields["rx_active"].astype(bool)
+    tx = fields["tx_valid"].astype(bool)
+    active = rx_active | tx
+
+    timestamp = fields["timestamp"].astype(np.int64)
+    delta = np.diff(timestamp) % (1 << layout.width("timestamp"))
+    cycles = np.concatenate(([0], np.cumsum(delta)))
+
+    continued = np.concatenate(([False], active[:-1] & (tx[1:] == tx[:-1]) & (delta == 1)))
+    start = active & ~continued
+    starts = np.flatnonzero(start)
+    if not len(starts):
+        return []
+    packet = np.cumsum(start) - 1
+    strobe = np.where(tx, fields["tx_ready"], rx_active & fields["rx_valid"]).astype(bool)
+    # samples ahead of the first start belong to a packet already in flight when capture began
+    strobe &= packet >= 0
+    data = fields["data"][strobe].astype(np.uint8).tobytes()
+    bounds = np.searchsorted(packet[strobe], np.arange(len(starts) + 1))
+    rx_error = np.logical_or.reduceat(fields["rx_error"].astype(bool), starts)
+    trigger = np.logical_or.reduceat(fields["usb_trigger"].astype(bool), starts)
+
+    # one tolist() per column keeps the per-packet loop free of NumPy scalars
+    bounds = bounds.tolist()
+    columns = zip(cycles[starts].tolist(), tx[starts].tolist(), rx_error.tolist(), trigger.tolist())
+    return [
+        CapturedPacket(cycle, inbound, data[bounds[i] : bounds[i + 1]], error, triggered)
+        for i, (cycle, inbound, error, triggered) in enumerate(columns)
+    ]
+
+
+def dump(packets, out=sys.stdout, clk_freq=60e6):
+    for packet in packets:
+        flags = "".join(f" {name}" for name in ("rx_error", "trigger") if getattr(packet, name))
+        print(f"# t={packet.cycle / clk_freq:.9f}{flags}", file=out)
+        print(f"{'d2h' if packet.inbound else 'h2d'}_raw: {packet.data.hex(' ')}", file=out)
+
+
+def write_pcapng(packets, path, clk_freq=60e6):
+    with PcapngWriter(path) as writer:
+        for packet in packets:
+            writer.packet(packet.cycle * 1e9 / clk_freq, packet.data, packet.inbound)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload and decode a USBAnalyzer capture")
+    parser.add_argument("--csr-csv", default="csr.csv", help="SoC CSV register map")
+    parser.add_argument("--analyzer-csv", default="analyzer.csv", help="LiteScope layout CSV")
+    parser.add_argument("--host", default="localhost", help="litex_server address")
+    parser.add_argument("--port", type=int, default=1234, help="litex_server port")
+    parser.add_argument("--usb", action="store_true", help="Upload over USBbone, not litex_server")
+    parser.add_argument("--prefix", default="analyzer", help="CSR name prefix of the analyzer")
+    parser.add_argument("--clk-freq", type=float, default=60e6, help="Analyzer clock domain")
+    parser.add_argument("--load", help="Decode samples saved with --save instead of uploading")
+    parser.add_argument("--save", help="Save the raw samples to this .npy file")
+    parser.add_argument("--pcap", help="Write the packets to this pcapng file")
+    parser.add_argument("--quiet", action="store_true", help="Do not print the packets")
+    args = parser.parse_args()
+
+    layout = AnalyzerLayout.from_csv(args.analyzer_csv)
+    start = time.perf_counter()
+    if args.load:
+        samples = np.load(args.load)
+    else:
+        if args.usb:
+            with usb1.USBContext() as context:
+                with USBboneClient.open(context, csr_csv=args.csr_csv) as bus:
+                    samples = upload(bus, layout, args.prefix)
+        else:
+            bus = RemoteClient(host=args.host, port=args.port, csr_csv=args.csr_csv)
+            bus.open()
+            try:
+                samples = upload(bus, layout, args.prefix)
+            finally:
+                bus.close()
+        print(
+            f"uploaded {len(samples)} samples in {time.perf_counter() - start:.3f}s",
+            file=sys.stderr,
+        )
+    if args.save:
+        np.save(args.save, samples)
+
+    start = time.perf_counter()
+    packets = decode_usb(layout, samples)
+    print(f"decoded {len(packets)} packets in {time.perf_counter() - start:.3f}s", file=sys.stderr)
+    if not args.quiet:
+        dump(packets, clk_freq=args.clk_freq)
+    if args.pcap:
+        write_pcapng(packets, args.pcap, args.clk_freq)
+
+
+if __name__ == "__main__":
+    main()
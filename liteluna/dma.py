@@ -0,0 +1,113 @@
+from typing import Union
+
+from litex.soc.cores.dma import WishboneDMAReader, WishboneDMAWriter
+from litex.soc.interconnect import wishbone
+from litex.soc.interconnect.csr_eventmanager import (
+    EventManager,
+    EventSourceProcess,
+    EventSourcePulse,
+)
+from migen import *
+
+from liteluna.stream import USBStreamer
+from liteluna.ulpi import ULPIInterface
+from liteluna.utmi import UTMIInterface
+
+USB_DMA_DATA_WIDTH = 32
+
+
+def add_usb_dma(
+    soc,
+    usb: Union[USBStreamer, ULPIInterface, UTMIInterface],
+    name="usb_dma",
+    index=0,
+    usb_cd="usb",
+    with_reader=True,
+    with_writer=True,
+    with_irq=True,
+    fifo_depth=16,
+    with_blinky=False,
+):
+    """Adds ``{name}_writer`` (bulk OUT to memory) and ``{name}_reader`` (memory to bulk IN) on
+    stream pair ``index`` of ``usb`` as masters of the SoC bus, which converts to the width and
+    protocol (Wishbone, AXI or LiteDRAM) of the memory."""
+    soc.check_if_exists(name)
+    if type(usb) in (ULPIInterface, UTMIInterface):
+        usb_pads = usb
+        usb = USBStreamer(
+            soc.platform,
+            usb_pads,
+            cd_usb=usb_cd,
+            data_width=USB_DMA_DATA_WIDTH,
+            num_endpoints=index + 1,
+            with_blinky=with_blinky,
+        )
+        setattr(soc.submodules, f"{name}_phy", usb)
+        soc.comb += usb.connect.eq(1)
+    elif usb.data_width < USB_DMA_DATA_WIDTH:
+        raise ValueError(f"USB DMA needs a USBStreamer with data_width>={USB_DMA_DATA_WIDTH}")
+
+    dmas = []
+    if with_writer:
+        writer = USBDMAWriter(_dma_bus(soc, usb.data_width))
+        soc.comb += usb.sinks[index].connect(writer.sink, keep={"valid", "ready", "data"})
+        dmas.append(("writer", writer))
+    if with_reader:
+        reader = USBDMAReader(_dma_bus(soc, usb.data_width), fifo_depth=fifo_depth)
+        soc.comb += [
+            reader.source.connect(usb.sources[index], keep={"valid", "ready", "last", "data"}),
+            usb.sources[index].be.eq(2 ** (usb.data_width // 8) - 1),
+        ]
+        dmas.append(("reader", reader))
+    # the SoC's coherent DMA bus if it has one
+    dma_bus = getattr(soc, "dma_bus", soc.bus)
+    for suffix, dma in dmas:
+        setattr(soc.submodules, f"{name}_{suffix}", dma)
+        dma_bus.add_master(name=f"{name}_{suffix}", master=dma.bus)
+        if with_irq and soc.irq.enabled:
+            soc.irq.add(f"{name}_{suffix}", use_loc_if_exists=True)
+
+
+def _dma_bus(soc, data_width):
+    return wishbone.Interface(
+        data_width=data_width, address_width=soc.bus.address_width, addressing="word"
+    )
+
+
+def _add_events(dma, wrap):
+    # done stays set until the DMA is disabled, wrap pulses once per ring buffer pass
+    dma.submodules.ev = ev = EventManager()
+    ev.done = EventSourceProcess(edge="rising", description="The transfer is complete.")
+    ev.wrap = EventSourcePulse(description="The ring buffer wrapped around.")
+    ev.finalize()
+    dma.comb += [ev.done.trigger.eq(dma.done), ev.wrap.trigger.eq(wrap & dma.loop)]
+
+
+class USBDMAWriter(WishboneDMAWriter):
+    """Writes the words of a host to device stream to memory.
+
+    Programmed through the ``WishboneDMAWriter`` CSRs: ``base`` and ``length`` in bytes,
+    ``loop`` to wrap around as a ring buffer, ``enable`` to start (clearing it aborts) and
+    ``done``/``offset`` to follow progress. The stream is held back while disabled or done, so
+    the host's data waits (NAKed) until the next transfer is set up. Packet boundaries are
+    ignored; transfers should be a multiple of the word size.
+    """
+
+    def __init__(self, bus):
+        # the first USB byte is in the least significant lane, which is already little-endian
+        WishboneDMAWriter.__init__(self, bus, endianness="big")
+        self.add_ctrl(ready_on_idle=0)
+        self.add_csr()
+        _add_events(self, self._sink.valid & self._sink.ready & self._sink.last)
+
+
+class USBDMAReader(WishboneDMAReader):
+    """Streams memory to the host, programmed like ``USBDMAWriter``.
+
+    The last word of the buffer (of every pass, in ``loop`` mode) ends the USB transfer.
+    """
+
+    def __init__(self, bus, fifo_depth=16):
+        WishboneDMAReader.__init__(self, bus, endianness="big", fifo_depth=fifo_depth)
+        self.add_csr()
+        _add_events(self, self.sink.valid & self.sink.ready & self.sink.last)
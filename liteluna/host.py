@@ -0,0 +1,753 @@
+import array
+import asyncio
+import collections
+import struct
+import threading
+import time
+
+import usb1
+from litex.tools.remote.csr_builder import CSRBuilder
+
+from liteluna.pattern import INVERT_TABLE
+
+VENDOR_ID = 0x16D0
+PRODUCT_ID = 0x0F3B
+BULK_ENDPOINT_NUMBER = 1
+MAX_PACKET_SIZE = 512
+
+
+class TransferError(IOError):
+    pass
+
+
+def open_streamer(context, vendor_id=VENDOR_ID, product_id=PRODUCT_ID, interface=0, alt_setting=0):
+    """Opens and claims the streamer; ``alt_setting=1`` enables the ``iso_in`` endpoint."""
+    handle = context.openByVendorIDAndProductID(vendor_id, product_id, skip_on_error=True)
+    if handle is None:
+        raise IOError(f"no USB device {vendor_id:04x}:{product_id:04x} found")
+    handle.claimInterface(interface)
+    if alt_setting:
+        handle.setInterfaceAltSetting(interface, alt_setting)
+    return handle
+
+
+class EventThread(threading.Thread):
+    """Pumps libusb events in the background, for use with the asyncio API."""
+
+    def __init__(self, context, interval=0.1):
+        super().__init__(daemon=True)
+        self.context = context
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.context.handleEventsTimeout(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class _TransferRing:
+    # Preallocated transfers and buffers for one endpoint. libusb completes transfers on an
+    # endpoint in submission order, so completions are simply queued.
+
+    def __init__(self, handle, context, endpoint, transfer_size, queue_depth, timeout):
+        self.context = context
+        self.endpoint = endpoint
+        self.transfer_size = transfer_size
+        self.timeout = timeout
+        self.buffers = [bytearray(transfer_size) for _ in range(queue_depth)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+        self.transfers = []
+        for i, view in enumerate(self.views):
+            transfer = handle.getTransfer()
+            transfer.setBulk(
+                endpoint, view, callback=self._on_complete, user_data=i, timeout=timeout
+            )
+            self.transfers.append(transfer)
+        self._completed = collections.deque()
+        self._loop = None
+        self._event = None
+
+    def _on_complete(self, transfer):
+        self._completed.append(transfer)
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._event.set)
+
+    def _wait(self):
+        while not self._completed:
+            self.context.handleEvents()
+        return self._completed.popleft()
+
+    async def _await(self):
+        # events are pumped by an EventThread
+        if self._loop is None:
+            self._event = asyncio.Event()
+            self._loop = asyncio.get_running_loop()
+        while not self._completed:
+            self._event.clear()
+            if self._completed:
+                break
+            await self._event.wait()
+        return self._completed.popleft()
+
+    @staticmethod
+    def _check(transfer, allow_timeout=False):
+        status = transfer.getStatus()
+        if status == usb1.TRANSFER_COMPLETED:
+            return
+        if allow_timeout and status == usb1.TRANSFER_TIMED_OUT:
+            return
+        raise TransferError(f"transfer on endpoint failed with status {status}")
+
+    def close(self):
+        self._loop = None
+        for transfer in self.transfers:
+            if transfer.isSubmitted():
+                transfer.cancel()
+        while any(transfer.isSubmitted() for transfer in self.transfers):
+            self.context.handleEvents()
+        self._completed.clear()
+
+
+class StreamReader(_TransferRing):
+    """Keeps ``queue_depth`` IN transfers in flight.
+
+    ``read()`` returns a memoryview into the transfer's buffer, valid until the next ``read()``;
+    the transfer is resubmitted at that point. A timed out transfer yields an empty view.
+    """
+
+    def __init__(
+        self,
+        handle,
+        context,
+        endpoint=BULK_ENDPOINT_NUMBER,
+        transfer_size=64 * 1024,
+        queue_depth=16,
+        timeout=0,
+    ):
+        assert transfer_size % MAX_PACKET_SIZE == 0
+        super().__init__(handle, context, 0x80 | endpoint, transfer_size, queue_depth, timeout)
+        self._current = None
+        self._started = False
+
+    def _release(self):
+        if self._current is not None:
+            self._current.submit()
+            self._current = None
+        elif not self._started:
+            for transfer in self.transfers:
+                transfer.submit()
+            self._started = True
+
+    def _finish(self, transfer):
+        self._check(transfer, allow_timeout=True)
+        self._current = transfer
+        return self.views[transfer.getUserData()][: transfer.getActualLength()]
+
+    def read(self):
+        self._release()
+        return self._finish(self._wait())
+
+    async def aread(self):
+        self._release()
+        return self._finish(await self._await())
+
+    def run(self, callback):
+        # stops when the callback returns False
+        for view in self:
+            if callback(view) is False:
+                break
+
+    def __iter__(self):
+        while True:
+            yield self.read()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.aread()
+
+
+class StreamWriter(_TransferRing):
+    """Copies data into preallocated transfers and keeps up to ``queue_depth`` of them in flight."""
+
+    def __init__(
+        self,
+        handle,
+        context,
+        endpoint=BULK_ENDPOINT_NUMBER,
+        transfer_size=64 * 1024,
+        queue_depth=16,
+        timeout=0,
+    ):
+        super().__init__(handle, context, endpoint, transfer_size, queue_depth, timeout)
+        self._free = collections.deque(self.transfers)
+
+    def _reclaim(self, transfer):
+        self._check(transfer)
+        self._free.append(transfer)
+
+    def _submit(self, chunk):
+        transfer = self._free.popleft()
+        view = self.views[transfer.getUserData()][: len(chunk)]
+        view[:] = chunk
+        transfer.setBuffer(view)
+        transfer.submit()
+
+    def _chunks(self, data):
+        data = memoryview(data).cast("B")
+        for offset in range(0, len(data), self.transfer_size):
+            yield data[offset : offset + self.transfer_size]
+
+    def write(self, data):
+        for chunk in self._chunks(data):
+            while not self._free:
+                self._reclaim(self._wait())
+            self._submit(chunk)
+
+    async def awrite(self, data):
+        for chunk in self._chunks(data):
+            while not self._free:
+                self._reclaim(await self._await())
+            self._submit(chunk)
+
+    def flush(self):
+        while len(self._free) < len(self.transfers):
+            self._reclaim(self._wait())
+
+    async def aflush(self):
+        while len(self._free) < len(self.transfers):
+            self._reclaim(await self._await())
+
+
+class BulkStreamer:
+    """Reader and writer pair for one bulk endpoint pair of the liteluna bulk streamer."""
+
+    def __init__(
+        self,
+        handle,
+        context,
+        endpoint=BULK_ENDPOINT_NUMBER,
+        transfer_size=64 * 1024,
+        queue_depth=16,
+        timeout=0,
+    ):
+        self.handle = handle
+        self.context = context
+        self.reader = StreamReader(handle, context, endpoint, transfer_size, queue_depth, timeout)
+        self.writer = StreamWriter(handle, context, endpoint, transfer_size, queue_depth, timeout)
+
+    @classmethod
+    def open(cls, context, vendor_id=VENDOR_ID, product_id=PRODUCT_ID, **kwargs):
+        return cls(open_streamer(context, vendor_id, product_id), context, **kwargs)
+
+    def close(self):
+        self.writer.close()
+        self.reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# USBbone -----------------------------------------------------------------------------------------
+
+ETHERBONE_MAGIC = 0x4E6F
+# magic, version and probe flags, address and port sizes, padding
+ETHERBONE_HEADER = struct.Struct(">HBB4x")
+# flags, byte enable, write count, read count, base (or return) address
+ETHERBONE_RECORD = struct.Struct(">BBBBI")
+ETHERBONE_VERSION = 0x10
+ETHERBONE_PROBE = 0x01
+ETHERBONE_PROBE_REPLY = 0x02
+ETHERBONE_SIZES = 0x44
+# one record and both headers fill a bulk packet, as in liteluna.usbbone
+USBBONE_MAX_BURST = (MAX_PACKET_SIZE - ETHERBONE_HEADER.size - ETHERBONE_RECORD.size) // 4
+
+
+def etherbone_record(wcount, rcount, addr, payload):
+    header = ETHERBONE_HEADER.pack(ETHERBONE_MAGIC, ETHERBONE_VERSION, ETHERBONE_SIZES)
+    return header + ETHERBONE_RECORD.pack(0, 0x0F, wcount, rcount, addr) + payload
+
+
+def etherbone_write(addr, datas):
+    return etherbone_record(len(datas), 0, addr, struct.pack(f">{len(datas)}I", *datas))
+
+
+def etherbone_reply(packet):
+    """Returns the big-endian words written by a read reply."""
+    magic, _, _ = ETHERBONE_HEADER.unpack_from(packet)
+    if magic != ETHERBONE_MAGIC:
+        raise TransferError(f"bad Etherbone magic {magic:#06x}")
+    _, _, wcount, _, _ = ETHERBONE_RECORD.unpack_from(packet, ETHERBONE_HEADER.size)
+    offset = ETHERBONE_HEADER.size + ETHERBONE_RECORD.size
+    if len(packet) < offset + 4 * wcount:
+        raise TransferError(f"short Etherbone reply of {len(packet)} bytes")
+    return packet[offset : offset + 4 * wcount]
+
+
+def swap_words(data):
+    """Converts between memory byte order (little-endian words) and Etherbone words."""
+    words = array.array("I")
+    words.frombytes(data)
+    words.byteswap()
+    return words.tobytes()
+
+
+class USBboneClient(CSRBuilder):
+    """Pipelined Wishbone access through a ``LiteLUNAUSBbone``.
+
+    Each bulk packet carries one Etherbone record of up to ``USBBONE_MAX_BURST`` words. A full
+    512-byte packet does not end a transfer, so the full records of a burst are batched into one
+    OUT transfer of up to ``batch_packets`` packets and their replies into one IN transfer, and
+    up to ``queue_depth`` such batches are kept in flight.
+
+    ``read``/``write`` follow ``litex.RemoteClient``, so with ``csr_csv`` the registers are
+    available as ``regs``; ``read_words`` reads any list of addresses and ``read_block``/
+    ``write_block`` move memory-ordered bytes. Writes return once submitted and their errors
+    surface on the next read or ``flush``.
+    """
+
+    def __init__(
+        self,
+        handle,
+        context,
+        csr_csv=None,
+        endpoint=BULK_ENDPOINT_NUMBER,
+        timeout=1000,
+        base_address=0,
+        batch_packets=32,
+        queue_depth=8,
+    ):
+        self.handle = handle
+        self.context = context
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.base_address = base_address
+        self.batch_packets = batch_packets
+        self.queue_depth = queue_depth
+        # packets of the batch being built and (reply length, handler) of its replies
+        self._packets = []
+        self._replies = []
+        self._in_flight = collections.deque()
+        CSRBuilder.__init__(self, comm=self, csr_csv=csr_csv)
+
+    @classmethod
+    def open(cls, context, vendor_id=VENDOR_ID, product_id=PRODUCT_ID, **kwargs):
+        return cls(open_streamer(context, vendor_id, product_id), context, **kwargs)
+
+    # batching
+
+    def _queue(self, packet, handler=None):
+        # a reply is as long as its request: same headers and one word per address
+        self._packets.append(packet)
+        if handler is not None:
+            self._replies.append((len(packet), handler))
+        if len(packet) < MAX_PACKET_SIZE or len(self._packets) == self.batch_packets:
+            self._submit()
+
+    def _submit(self):
+        if not self._packets:
+            return
+        while len(self._in_flight) >= self.queue_depth:
+            self._retire()
+        transfers = []
+        # the IN transfer goes first so the replies never wait for it
+        if self._replies:
+            transfer = self.handle.getTransfer()
+            length = sum(length for length, _ in self._replies)
+            transfer.setBulk(0x80 | self.endpoint, bytearray(length), timeout=self.timeout)
+            transfers.append(transfer)
+        transfer = self.handle.getTransfer()
+        transfer.setBulk(self.endpoint, b"".join(self._packets), timeout=self.timeout)
+        transfers.append(transfer)
+        for transfer in transfers:
+            transfer.submit()
+        self._in_flight.append((transfers, self._replies))
+        self._packets = []
+        self._replies = []
+
+    def _retire(self):
+        transfers, replies = self._in_flight.popleft()
+        for transfer in transfers:
+            while transfer.isSubmitted():
+                self.context.handleEvents()
+        for transfer in transfers:
+            if transfer.getStatus() != usb1.TRANSFER_COMPLETED:
+                raise TransferError(f"USBbone transfer failed with status {transfer.getStatus()}")
+        if replies:
+            data = memoryview(transfers[0].getBuffer())[: transfers[0].getActualLength()]
+            offset = 0
+            for length, handler in replies:
+                if offset + length > len(data):
+                    raise TransferError(f"USBbone reply short by {offset + length - len(data)}")
+                handler(data[offset : offset + length])
+                offset += length
+
+    def flush(self):
+        """Waits for every queued request."""
+        self._submit()
+        while self._in_flight:
+            self._retire()
+
+    def _queue_reads(self, addrs, reply):
+        # addrs are packed big-endian; replies are appended to reply in the same order
+        step = 4 * USBBONE_MAX_BURST
+        for offset in range(0, len(addrs), step):
+            chunk = addrs[offset : offset + step]
+            packet = etherbone_record(0, len(chunk) // 4, 0, chunk)
+            self._queue(packet, lambda data: reply.extend(etherbone_reply(data)))
+
+    def _queue_writes(self, addr, datas):
+        # datas are packed big-endian
+        step = 4 * USBBONE_MAX_BURST
+        for offset in range(0, len(datas), step):
+            chunk = datas[offset : offset + step]
+            self._queue(etherbone_record(len(chunk) // 4, 0, addr + offset, chunk))
+        self._submit()
+
+    # access
+
+    def probe(self):
+        header = ETHERBONE_HEADER.pack(
+            ETHERBONE_MAGIC, ETHERBONE_VERSION | ETHERBONE_PROBE, ETHERBONE_SIZES
+        )
+        flags = []
+        # the gateware depacketizer needs a payload word to forward the packet
+        self._queue(
+            header + bytes(4), lambda data: flags.append(ETHERBONE_HEADER.unpack_from(data)[1])
+        )
+        self.flush()
+        return flags[0] & ETHERBONE_PROBE_REPLY != 0
+
+    def read_words(self, addrs):
+        """Reads a list of addresses, batched like a burst."""
+        addrs = [self.base_address + addr for addr in addrs]
+        reply = bytearray()
+        self._queue_reads(struct.pack(f">{len(addrs)}I", *addrs), reply)
+        self.flush()
+        return list(struct.unpack(f">{len(addrs)}I", reply))
+
+    def read(self, addr, length=None, burst="incr"):
+        step = 4 if burst == "incr" else 0
+        datas = self.read_words([addr + step * i for i in range(length or 1)])
+        return datas[0] if length is None else datas
+
+    def write(self, addr, datas):
+        datas = datas if isinstance(datas, list) else [datas]
+        self._queue_writes(self.base_address + addr, struct.pack(f">{len(datas)}I", *datas))
+
+    @staticmethod
+    def _check_block(addr, size):
+        if addr % 4 or size % 4:
+            raise ValueError(f"block {addr:#x}+{size:#x} is not word aligned")
+
+    def read_block(self, addr, size):
+        """Reads ``size`` bytes of memory from ``addr``."""
+        self._check_block(addr, size)
+        addr += self.base_address
+        reply = bytearray()
+        self._queue_reads(struct.pack(f">{size // 4}I", *range(addr, addr + size, 4)), reply)
+        self.flush()
+        return swap_words(reply)
+
+    def write_block(self, addr, data):
+        """Writes the bytes of ``data`` to memory from ``addr``."""
+        self._check_block(addr, len(data))
+        self._queue_writes(self.base_address + addr, swap_words(data))
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class USBDMAClient:
+    """Moves memory through ``liteluna.dma.add_usb_dma``.
+
+    The DMAs are programmed through ``bus`` (e.g. a ``USBboneClient`` with ``csr_csv``) and the
+    data moves over ``streamer``, a ``BulkStreamer`` on the DMA's endpoint pair.
+    """
+
+    def __init__(self, bus, streamer, prefix="usb_dma", poll_timeout=1.0):
+        self.bus = bus
+        self.streamer = streamer
+        self.prefix = prefix
+        self.poll_timeout = poll_timeout
+
+    def _reg(self, dma, name):
+        return getattr(self.bus.regs, f"{self.prefix}_{dma}_{name}")
+
+    def start(self, dma, base, length, loop=False):
+        """Arms ``dma`` (``"writer"`` or ``"reader"``); ``loop`` makes it a ring buffer."""
+        self._reg(dma, "enable").write(0)
+        self._reg(dma, "base").write(base)
+        self._reg(dma, "length").write(length)
+        self._reg(dma, "loop").write(int(loop))
+        self._reg(dma, "enable").write(1)
+
+    def wait(self, dma):
+        deadline = time.monotonic() + self.poll_timeout
+        while not self._reg(dma, "done").read():
+            if time.monotonic() > deadline:
+                offset = self._reg(dma, "offset").read()
+                raise TransferError(f"{self.prefix}_{dma} stalled at word {offset}")
+
+    def write(self, base, data):
+        self.start("writer", base, len(data))
+        self.streamer.writer.write(data)
+        self.streamer.writer.flush()
+        self.wait("writer")
+
+    def read(self, base, length):
+        self.start("reader", base, length)
+        data = bytearray()
+        while len(data) < length:
+            data += self.streamer.reader.read()
+        self.wait("reader")
+        return bytes(data)
+
+
+# Software devices --------------------------------------------------------------------------------
+
+
+class SoftTransfer:
+    def __init__(self, device):
+        self.device = device
+        self._submitted = False
+        self._status = usb1.TRANSFER_COMPLETED
+        self._actual_length = 0
+        self._offset = 0
+        self._submit_time = 0
+
+    def setBulk(self, endpoint, buffer, callback=None, user_data=None, timeout=0):
+        self._endpoint = endpoint
+        self._buffer = memoryview(buffer)
+        self._callback = callback
+        self._user_data = user_data
+        self._timeout = timeout
+
+    def setBuffer(self, buffer):
+        self._buffer = memoryview(buffer)
+
+    def getBuffer(self):
+        return self._buffer
+
+    def getEndpoint(self):
+        return self._endpoint
+
+    def getUserData(self):
+        return self._user_data
+
+    def getStatus(self):
+        return self._status
+
+    def getActualLength(self):
+        return self._actual_length
+
+    def isSubmitted(self):
+        return self._submitted
+
+    def submit(self):
+        self._submitted = True
+        self._offset = 0
+        self._submit_time = time.monotonic()
+        self.device._submit(self)
+
+    def cancel(self):
+        self.device._cancel(self)
+
+    def _timed_out(self):
+        return self._timeout and time.monotonic() - self._submit_time >= self._timeout / 1000
+
+    def _complete(self, status, actual_length):
+        self._submitted = False
+        self._status = status
+        self._actual_length = actual_length
+
+
+class SoftDevice:
+    """Base for software devices that stand in for a usb1 handle and context at once.
+
+    Submitted transfers sit in ``_pending``; subclasses implement ``_process()``, called with
+    the lock held, which completes some of them and returns those.
+    """
+
+    def __init__(self):
+        self._pending = collections.deque()
+        self._lock = threading.Condition()
+
+    def getTransfer(self):
+        return SoftTransfer(self)
+
+    def claimInterface(self, interface):
+        pass
+
+    def _submit(self, transfer):
+        with self._lock:
+            self._pending.append(transfer)
+            self._lock.notify_all()
+
+    def _cancel(self, transfer):
+        with self._lock:
+            if transfer in self._pending:
+                self._pending.remove(transfer)
+                transfer._complete(usb1.TRANSFER_CANCELLED, transfer._offset)
+                done = [transfer]
+            else:
+                done = []
+        self._callback(done)
+
+    @staticmethod
+    def _callback(transfers):
+        for transfer in transfers:
+            if transfer._callback is not None:
+                transfer._callback(transfer)
+
+    def handleEventsTimeout(self, tv=0):
+        # like libusb, block for up to tv seconds when there is nothing to complete
+        with self._lock:
+            done = self._process()
+            if not done and tv:
+                self._lock.wait(tv)
+                done = self._process()
+        self._callback(done)
+
+    def handleEvents(self):
+        self.handleEventsTimeout()
+
+    def _process(self):
+        raise NotImplementedError
+
+
+class LoopbackDevice(SoftDevice):
+    """Software stand-in for a bulk streamer running the loopback gateware.
+
+    OUT data is queued, inverted like ``StreamPayloadInverter`` if ``invert``, and returned by IN
+    transfers.
+    """
+
+    def __init__(self, invert=True):
+        super().__init__()
+        self.invert = invert
+        self._data = bytearray()
+
+    def _process(self):
+        done = []
+        pending = collections.deque()
+        for transfer in self._pending:
+            if transfer._endpoint & 0x80:
+                pending.append(transfer)
+                continue
+            data = transfer._buffer.tobytes()
+            self._data += data.translate(INVERT_TABLE) if self.invert else data
+            transfer._complete(usb1.TRANSFER_COMPLETED, len(data))
+            done.append(transfer)
+        self._pending = collections.deque()
+        for transfer in pending:
+            if self._data:
+                n = min(len(self._data), len(transfer._buffer))
+                transfer._buffer[:n] = self._data[:n]
+                del self._data[:n]
+                transfer._complete(usb1.TRANSFER_COMPLETED, n)
+                done.append(transfer)
+            elif transfer._timed_out():
+                transfer._complete(usb1.TRANSFER_TIMED_OUT, 0)
+                done.append(transfer)
+            else:
+                self._pending.append(transfer)
+        return done
+
+
+class USBboneDevice(SoftDevice):
+    """Software stand-in for a ``LiteLUNAUSBbone`` in front of ``size`` bytes of memory.
+
+    Every OUT packet is decoded as one Etherbone packet and every reply is returned as its own IN
+    packet, so a full reply continues an IN transfer and a short one ends it, as on the gateware.
+    """
+
+    def __init__(self, size=64 * 1024):
+        super().__init__()
+        self.memory = bytearray(size)
+        self._replies = collections.deque()
+
+    def _word(self, addr):
+        # addresses alias like on a partially decoded bus
+        addr %= len(self.memory)
+        return slice(addr, addr + 4)
+
+    def _execute(self, packet):
+        magic, flags, sizes = ETHERBONE_HEADER.unpack_from(packet)
+        if magic != ETHERBONE_MAGIC:
+            return
+        if flags & ETHERBONE_PROBE:
+            reply = ETHERBONE_HEADER.pack(magic, ETHERBONE_VERSION | ETHERBONE_PROBE_REPLY, sizes)
+            self._replies.append(reply + bytes(len(packet) - len(reply)))
+            return
+        _, _, wcount, rcount, addr = ETHERBONE_RECORD.unpack_from(packet, ETHERBONE_HEADER.size)
+        offset = ETHERBONE_HEADER.size + ETHERBONE_RECORD.size
+        words = struct.unpack_from(f">{wcount + rcount}I", packet, offset)
+        for i, data in enumerate(words[:wcount]):
+            self.memory[self._word(addr + 4 * i)] = data.to_bytes(4, "little")
+        if rcount:
+            datas = []
+            for read_addr in words[wcount:]:
+                datas.append(int.from_bytes(self.memory[self._word(read_addr)], "little"))
+            self._replies.append(etherbone_write(addr, datas))
+
+    def _fill(self, transfer):
+        # returns whether the transfer is done
+        buffer = transfer._buffer
+        while self._replies:
+            reply = self._replies.popleft()
+            end = transfer._offset + len(reply)
+            if end > len(buffer):
+                transfer._complete(usb1.TRANSFER_OVERFLOW, transfer._offset)
+                return True
+            buffer[transfer._offset : end] = reply
+            transfer._offset = end
+            if len(reply) < MAX_PACKET_SIZE or end == len(buffer):
+                transfer._complete(usb1.TRANSFER_COMPLETED, end)
+                return True
+        if transfer._timed_out():
+            transfer._complete(usb1.TRANSFER_TIMED_OUT, transfer._offset)
+            return True
+        return False
+
+    def _process(self):
+        done = []
+        pending = collections.deque()
+        for transfer in self._pending:
+            if transfer._endpoint & 0x80:
+                pending.append(transfer)
+                continue
+            data = transfer._buffer
+            for offset in range(0, len(data), MAX_PACKET_SIZE):
+                self._execute(data[offset : offset + MAX_PACKET_SIZE])
+            transfer._complete(usb1.TRANSFER_COMPLETED, len(data))
+            done.append(transfer)
+        self._pending = collections.deque()
+        for transfer in pending:
+            if self._fill(transfer):
+                done.append(transfer)
+            else:
+                self._pending.append(transfer)
+        return done
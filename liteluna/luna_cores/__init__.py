@@ -1 +1 @@
-from liteluna.luna_cores import bulk_streamer, ulpi, util
+from liteluna.luna_cores import bulk_streamer, cache, ulpi, util
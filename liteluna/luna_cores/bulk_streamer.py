@@ -7,17 +7,34 @@
 # SPDX-License-Identifier: BSD-3-Clause
 
 import amaranth.cli
-from amaranth import Cat, ClockSignal, Elaboratable, Module, ResetSignal, Signal
+from amaranth import (
+    Array,
+    Cat,
+    ClockSignal,
+    Elaboratable,
+    Memory,
+    Module,
+    Mux,
+    ResetSignal,
+    Signal,
+)
 from amaranth.hdl.rec import Direction
 from luna.gateware.interface.ulpi import ULPIInterface
 from luna.gateware.interface.utmi import UTMIInterface
+from luna.gateware.stream import StreamInterface
+from luna.gateware.stream.generator import StreamSerializer
+from luna.gateware.usb.request.control import ControlRequestHandler
+from luna.gateware.usb.stream import USBInStreamInterface
+from luna.gateware.usb.usb2.endpoints.isochronous import USBIsochronousInEndpoint
 from luna.gateware.usb.usb2.packet import (
     InterpacketTimerInterface,
     TokenDetectorInterface,
 )
 from luna.usb2 import USBDevice, USBStreamInEndpoint, USBStreamOutEndpoint
 from usb_protocol.emitters import DeviceDescriptorCollection
+from usb_protocol.types import USBRequestType, USBStandardRequests
 
+from liteluna.luna_cores.cache import VerilogCache, file_digest
 from liteluna.luna_cores.util import get_signals
 
 
@@ -42,34 +59,234 @@ class StandaloneBlinky(Elaboratable):
         return m
 
 
+class IsochronousStreamAdapter(Elaboratable):
+    """Feeds a byte stream to a LUNA isochronous IN endpoint one microframe at a time.
+
+    Two banks of ``frame_size`` bytes are filled alternately. A bank is sent in the next
+    microframe once it is full, or early when ``last`` closes it; a ZLP is sent otherwise.
+    """
+
+    def __init__(self, endpoint, frame_size):
+        self.endpoint = endpoint
+        self.frame_size = frame_size
+        self.stream = StreamInterface()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        ep = self.endpoint
+        stream = self.stream
+        frame_size = self.frame_size
+
+        buffer = Memory(width=8, depth=2 * frame_size)
+        m.submodules.wport = wport = buffer.write_port(domain="usb")
+        m.submodules.rport = rport = buffer.read_port(domain="usb")
+
+        bank_full = Array(Signal(name=f"bank_full{i}") for i in range(2))
+        bank_len = Array(Signal(range(frame_size + 1), name=f"bank_len{i}") for i in range(2))
+        wbank = Signal()
+        waddr = Signal(range(frame_size))
+        rbank = Signal()
+        in_frame = Signal()
+        frame_len = Signal(range(frame_size + 1))
+
+        # stream side
+        m.d.comb += [
+            stream.ready.eq(~bank_full[wbank]),
+            wport.addr.eq(wbank * frame_size + waddr),
+            wport.data.eq(stream.payload),
+            wport.en.eq(stream.valid & stream.ready),
+        ]
+        with m.If(stream.valid & stream.ready):
+            with m.If(stream.last | (waddr == frame_size - 1)):
+                m.d.usb += [
+                    bank_full[wbank].eq(1),
+                    bank_len[wbank].eq(waddr + 1),
+                    waddr.eq(0),
+                    wbank.eq(~wbank),
+                ]
+            with m.Else():
+                m.d.usb += waddr.eq(waddr + 1)
+
+        # endpoint side; the frame length is held while the endpoint is sending
+        m.d.comb += [
+            rport.addr.eq(rbank * frame_size + ep.next_address),
+            ep.value.eq(rport.data),
+            ep.bytes_in_frame.eq(frame_len),
+        ]
+        with m.If(~in_frame):
+            m.d.usb += frame_len.eq(Mux(bank_full[rbank], bank_len[rbank], 0))
+        with m.If(ep.data_requested):
+            m.d.usb += in_frame.eq(1)
+        with m.If(ep.frame_finished):
+            m.d.usb += in_frame.eq(0)
+            with m.If(frame_len != 0):
+                m.d.usb += [
+                    bank_full[rbank].eq(0),
+                    rbank.eq(~rbank),
+                ]
+
+        return m
+
+
+class AlternateSettingRequestHandler(ControlRequestHandler):
+    """SET_INTERFACE and GET_INTERFACE for interface 0.
+
+    LUNA's ``StandardRequestHandler`` has no case for either and STALLs them, which would leave
+    the host stuck in alternate setting 0; it has to skip them (``handles``) for this one to
+    claim them. ``alt_setting`` holds the selected setting.
+    """
+
+    def __init__(self, alt_settings):
+        self.alt_settings = alt_settings
+        self.alt_setting = Signal(range(alt_settings))
+        super().__init__()
+
+    @staticmethod
+    def handles(setup):
+        return (setup.type == USBRequestType.STANDARD) & (
+            (setup.request == USBStandardRequests.GET_INTERFACE)
+            | (setup.request == USBStandardRequests.SET_INTERFACE)
+        )
+
+    def elaborate(self, platform):
+        m = Module()
+
+        interface = self.interface
+        setup = interface.setup
+
+        m.submodules.transmitter = transmitter = StreamSerializer(
+            data_length=1, domain="usb", stream_type=USBInStreamInterface, max_length_width=1
+        )
+
+        new_alt_setting = Signal.like(setup.value)
+        alt_setting_changed = Signal()
+        active_config = Signal.like(interface.active_config)
+        m.d.usb += active_config.eq(interface.active_config)
+        with m.If(alt_setting_changed):
+            m.d.usb += self.alt_setting.eq(new_alt_setting)
+        with m.Elif(active_config != interface.active_config):
+            # a new configuration (or a bus reset) starts in the default setting
+            m.d.usb += self.alt_setting.eq(0)
+
+        m.d.comb += interface.claim.eq(self.handles(setup))
+
+        with m.FSM(domain="usb"):
+            with m.State("IDLE"):
+                m.d.usb += interface.tx_data_pid.eq(1)
+                with m.If(setup.received & self.handles(setup)):
+                    with m.If(setup.index != 0):
+                        m.next = "UNHANDLED"
+                    with m.Elif(setup.request == USBStandardRequests.SET_INTERFACE):
+                        m.next = "SET_INTERFACE"
+                    with m.Else():
+                        m.next = "GET_INTERFACE"
+
+            with m.State("SET_INTERFACE"):
+                self.handle_register_write_request(
+                    m,
+                    new_alt_setting,
+                    alt_setting_changed,
+                    stall_condition=setup.value >= self.alt_settings,
+                )
+
+            with m.State("GET_INTERFACE"):
+                self.handle_simple_data_request(m, transmitter, self.alt_setting)
+
+            with m.State("UNHANDLED"):
+                with m.If(interface.data_requested | interface.status_requested):
+                    m.d.comb += interface.handshakes_out.stall.eq(1)
+                    m.next = "IDLE"
+
+        return m
+
+
+STREAM_PORT_LAYOUT = [("payload", 8), ("valid", 1), ("ready", 1), ("first", 1), ("last", 1)]
+
+# one-cycle usb domain strobes behind the stats_* ports
+STATS_EVENTS = [
+    "rx_packet",
+    "rx_byte",
+    "tx_packet",
+    "tx_byte",
+    "nak",
+    "rx_error",
+    "sof",
+    "bus_reset",
+]
+NAK_PID = 0x5A
+
+
+def stream_port_prefix(direction, index=0):
+    if index == 0:
+        return f"stream_{direction}"
+    return f"stream_{direction}{index}"
+
+
 class USBBulkStreamerDevice(Elaboratable):
     BULK_ENDPOINT_NUMBER = 1
     MAX_BULK_PACKET_SIZE = 512
-
-    def __init__(self, with_utmi=False, with_blinky=False, with_utmi_la=False, data_clock=None):
+    MAX_NUM_ENDPOINTS = 15
+    MAX_ISO_PACKET_SIZE = 1024
+
+    def __init__(
+        self,
+        with_utmi=False,
+        with_blinky=False,
+        with_utmi_la=False,
+        data_clock=None,
+        num_endpoints=1,
+        iso_in=False,
+        iso_packets_per_microframe=3,
+        with_stats=False,
+    ):
+        assert 1 <= num_endpoints <= self.MAX_NUM_ENDPOINTS
+        assert 1 <= iso_packets_per_microframe <= 3
         self.with_utmi = with_utmi
         self.with_blinky = with_blinky
         self.with_utmi_la = with_utmi_la
-
-        self.stream_out_ep = USBStreamOutEndpoint(
-            endpoint_number=self.BULK_ENDPOINT_NUMBER,
-            max_packet_size=self.MAX_BULK_PACKET_SIZE,
-        )
-        self.stream_out_payload = Signal(8)
-        self.stream_out_valid = Signal()
-        self.stream_out_ready = Signal()
-        self.stream_out_first = Signal()
-        self.stream_out_last = Signal()
-
-        self.stream_in_ep = USBStreamInEndpoint(
-            endpoint_number=self.BULK_ENDPOINT_NUMBER,
-            max_packet_size=self.MAX_BULK_PACKET_SIZE,
-        )
-        self.stream_in_payload = Signal(8)
-        self.stream_in_valid = Signal()
-        self.stream_in_ready = Signal()
-        self.stream_in_first = Signal()
-        self.stream_in_last = Signal()
+        self.num_endpoints = num_endpoints
+        self.iso_in = iso_in
+        self.iso_packets_per_microframe = iso_packets_per_microframe
+        self.with_stats = with_stats
+
+        # one OUT/IN pair per endpoint number, starting at BULK_ENDPOINT_NUMBER
+        self.stream_out_eps = []
+        self.stream_in_eps = []
+        for i in range(num_endpoints):
+            self.stream_out_eps.append(
+                USBStreamOutEndpoint(
+                    endpoint_number=self.BULK_ENDPOINT_NUMBER + i,
+                    max_packet_size=self.MAX_BULK_PACKET_SIZE,
+                )
+            )
+            if i == 0 and iso_in:
+                # the first IN endpoint becomes high-bandwidth isochronous
+                self.iso_in_ep = USBIsochronousInEndpoint(
+                    endpoint_number=self.BULK_ENDPOINT_NUMBER,
+                    max_packet_size=self.MAX_ISO_PACKET_SIZE,
+                )
+                self.stream_in_eps.append(
+                    IsochronousStreamAdapter(
+                        self.iso_in_ep,
+                        frame_size=self.MAX_ISO_PACKET_SIZE * iso_packets_per_microframe,
+                    )
+                )
+            else:
+                self.stream_in_eps.append(
+                    USBStreamInEndpoint(
+                        endpoint_number=self.BULK_ENDPOINT_NUMBER + i,
+                        max_packet_size=self.MAX_BULK_PACKET_SIZE,
+                    )
+                )
+            for direction in ("out", "in"):
+                prefix = stream_port_prefix(direction, i)
+                for name, nbit in STREAM_PORT_LAYOUT:
+                    setattr(self, f"{prefix}_{name}", Signal(nbit, name=f"{prefix}_{name}"))
+        self.stream_out_ep = self.stream_out_eps[0]
+        if iso_in:
+            self.alt_setting_handler = AlternateSettingRequestHandler(alt_settings=2)
+        self.stream_in_ep = self.stream_in_eps[0]
 
         if not with_utmi:
             self.ulpi = ULPIInterface()
@@ -114,6 +331,10 @@ class USBBulkStreamerDevice(Elaboratable):
             for name, nbit, _ in InterpacketTimerInterface().layout:
                 setattr(self, f"rxtmr_la_{name}", Signal(nbit, name=f"rxtmr_la_{name}"))
 
+        if with_stats:
+            for name in STATS_EVENTS:
+                setattr(self, f"stats_{name}", Signal(name=f"stats_{name}"))
+
         if with_blinky:
             self.led = Signal()
 
@@ -131,19 +352,42 @@ class USBBulkStreamerDevice(Elaboratable):
             d.bNumConfigurations = 1
 
         with descriptors.ConfigurationDescriptor() as c:
-            with c.InterfaceDescriptor() as i:
-                i.bInterfaceNumber = 0
-
-                with i.EndpointDescriptor() as e:
-                    e.bEndpointAddress = self.BULK_ENDPOINT_NUMBER
-                    e.wMaxPacketSize = self.MAX_BULK_PACKET_SIZE
-
-                with i.EndpointDescriptor() as e:
-                    e.bEndpointAddress = 0x80 | self.BULK_ENDPOINT_NUMBER
-                    e.wMaxPacketSize = self.MAX_BULK_PACKET_SIZE
+            # USB 2.0 5.6.3: the default setting can't reserve isochronous bandwidth, so the
+            # high-bandwidth IN endpoint only exists in alternate setting 1, which the host selects
+            for alt_setting in range(2 if self.iso_in else 1):
+                with c.InterfaceDescriptor() as i:
+                    i.bInterfaceNumber = 0
+                    i.bAlternateSetting = alt_setting
+
+                    for n in range(self.num_endpoints):
+                        with i.EndpointDescriptor() as e:
+                            e.bEndpointAddress = self.BULK_ENDPOINT_NUMBER + n
+                            e.wMaxPacketSize = self.MAX_BULK_PACKET_SIZE
+
+                        if n == 0 and self.iso_in:
+                            if alt_setting == 0:
+                                continue
+                            with i.EndpointDescriptor() as e:
+                                e.bEndpointAddress = 0x80 | self.BULK_ENDPOINT_NUMBER
+                                # isochronous, asynchronous; additional transactions in bits 12:11
+                                e.bmAttributes = 0x05
+                                e.wMaxPacketSize = self.MAX_ISO_PACKET_SIZE | (
+                                    (self.iso_packets_per_microframe - 1) << 11
+                                )
+                                e.bInterval = 1
+                        else:
+                            with i.EndpointDescriptor() as e:
+                                e.bEndpointAddress = 0x80 | (self.BULK_ENDPOINT_NUMBER + n)
+                                e.wMaxPacketSize = self.MAX_BULK_PACKET_SIZE
 
         return descriptors
 
+    def descriptor_contents(self):
+        return [
+            (number, index, bytes(descriptor).hex())
+            for number, index, descriptor in self.create_descriptors()
+        ]
+
     def elaborate(self, platform):
         m = Module()
 
@@ -153,13 +397,21 @@ class USBBulkStreamerDevice(Elaboratable):
             m.submodules.blinky = StandaloneBlinky(self.led)
 
         descriptors = self.create_descriptors()
-        self.usb.add_standard_control_endpoint(descriptors)
-
-        self.usb.add_endpoint(self.stream_out_ep)
-        self.usb.add_endpoint(self.stream_in_ep)
+        if self.iso_in:
+            control_ep = self.usb.add_standard_control_endpoint(
+                descriptors, blacklist=[AlternateSettingRequestHandler.handles]
+            )
+            control_ep.add_request_handler(self.alt_setting_handler)
+        else:
+            self.usb.add_standard_control_endpoint(descriptors)
 
-        stream_out = self.stream_out_ep.stream
-        stream_in = self.stream_in_ep.stream
+        for stream_out_ep, stream_in_ep in zip(self.stream_out_eps, self.stream_in_eps):
+            self.usb.add_endpoint(stream_out_ep)
+            if isinstance(stream_in_ep, IsochronousStreamAdapter):
+                self.usb.add_endpoint(stream_in_ep.endpoint)
+                m.submodules.iso_in_adapter = stream_in_ep
+            else:
+                self.usb.add_endpoint(stream_in_ep)
 
         m.d.comb += [
             self.usb.connect.eq(self.connect),
@@ -192,21 +444,54 @@ class USBBulkStreamerDevice(Elaboratable):
                 m.d.comb += stmt
             m.d.comb += self.utmi.rx_data.eq(self.utmi_rx_data)
 
-        m.d.comb += [
-            self.stream_out_payload.eq(stream_out.payload),
-            self.stream_out_valid.eq(stream_out.valid),
-            stream_out.ready.eq(self.stream_out_ready),
-            self.stream_out_first.eq(stream_out.first),
-            self.stream_out_last.eq(stream_out.last),
-        ]
+        for i in range(self.num_endpoints):
+            stream_out = self.stream_out_eps[i].stream
+            stream_in = self.stream_in_eps[i].stream
+            out_prefix = stream_port_prefix("out", i)
+            in_prefix = stream_port_prefix("in", i)
 
-        m.d.comb += [
-            stream_in.payload.eq(self.stream_in_payload),
-            stream_in.valid.eq(self.stream_in_valid),
-            self.stream_in_ready.eq(stream_in.ready),
-            stream_in.first.eq(self.stream_in_first),
-            stream_in.last.eq(self.stream_in_last),
-        ]
+            m.d.comb += [
+                getattr(self, f"{out_prefix}_payload").eq(stream_out.payload),
+                getattr(self, f"{out_prefix}_valid").eq(stream_out.valid),
+                stream_out.ready.eq(getattr(self, f"{out_prefix}_ready")),
+                getattr(self, f"{out_prefix}_first").eq(stream_out.first),
+                getattr(self, f"{out_prefix}_last").eq(stream_out.last),
+            ]
+
+            m.d.comb += [
+                stream_in.payload.eq(getattr(self, f"{in_prefix}_payload")),
+                stream_in.valid.eq(getattr(self, f"{in_prefix}_valid")),
+                getattr(self, f"{in_prefix}_ready").eq(stream_in.ready),
+                stream_in.first.eq(getattr(self, f"{in_prefix}_first")),
+                stream_in.last.eq(getattr(self, f"{in_prefix}_last")),
+            ]
+
+        if self.with_stats:
+            # everything is seen from LUNA's side of the UTMI bus, so ULPI PHYs count the same
+            utmi = self.usb.utmi
+            rx_active_d = Signal()
+            tx_valid_d = Signal()
+            rx_error_d = Signal()
+            reset_detected_d = Signal()
+            tx_start = Signal()
+            m.d.usb += [
+                rx_active_d.eq(utmi.rx_active),
+                tx_valid_d.eq(utmi.tx_valid),
+                rx_error_d.eq(utmi.rx_error),
+                reset_detected_d.eq(self.usb.reset_detected),
+            ]
+            # chirps are driven in a non-normal op_mode and are not packets
+            m.d.comb += [
+                tx_start.eq(utmi.tx_valid & ~tx_valid_d & (utmi.op_mode == 0)),
+                self.stats_rx_packet.eq(rx_active_d & ~utmi.rx_active),
+                self.stats_rx_byte.eq(utmi.rx_active & utmi.rx_valid),
+                self.stats_tx_packet.eq(tx_start),
+                self.stats_tx_byte.eq(utmi.tx_valid & utmi.tx_ready & (utmi.op_mode == 0)),
+                self.stats_nak.eq(tx_start & (utmi.tx_data == NAK_PID)),
+                self.stats_rx_error.eq(utmi.rx_error & ~rx_error_d),
+                self.stats_sof.eq(self.usb.sof_detected),
+                self.stats_bus_reset.eq(self.usb.reset_detected & ~reset_detected_d),
+            ]
 
         if self.with_utmi_la:
             for name, _, _ in UTMIInterface().layout:
@@ -234,13 +519,24 @@ class USBBulkStreamerDevice(Elaboratable):
 
     @staticmethod
     def get_instance_and_ports(
-        with_utmi=False, with_blinky=False, with_utmi_la=False, data_clock=None
+        with_utmi=False,
+        with_blinky=False,
+        with_utmi_la=False,
+        data_clock=None,
+        num_endpoints=1,
+        iso_in=False,
+        iso_packets_per_microframe=3,
+        with_stats=False,
     ):
         streamer = USBBulkStreamerDevice(
             with_utmi=with_utmi,
             with_blinky=with_blinky,
             with_utmi_la=with_utmi_la,
             data_clock=data_clock,
+            num_endpoints=num_endpoints,
+            iso_in=iso_in,
+            iso_packets_per_microframe=iso_packets_per_microframe,
+            with_stats=with_stats,
         )
         streamer_ports = [
             streamer.connect,
@@ -249,18 +545,12 @@ class USBBulkStreamerDevice(Elaboratable):
             streamer.current_speed,
             streamer.operating_mode,
             streamer.termination_select,
-            streamer.stream_out_payload,
-            streamer.stream_out_valid,
-            streamer.stream_out_ready,
-            streamer.stream_out_first,
-            streamer.stream_out_last,
-            streamer.stream_out_first,
-            streamer.stream_in_payload,
-            streamer.stream_in_valid,
-            streamer.stream_in_ready,
-            streamer.stream_in_first,
-            streamer.stream_in_last,
         ]
+        for i in range(num_endpoints):
+            for direction in ("out", "in"):
+                prefix = stream_port_prefix(direction, i)
+                for name, _ in STREAM_PORT_LAYOUT:
+                    streamer_ports.append(getattr(streamer, f"{prefix}_{name}"))
         if not with_utmi:
             streamer_ports += [
                 streamer.ulpi_data_i,
@@ -292,21 +582,56 @@ class USBBulkStreamerDevice(Elaboratable):
             ]
             for name, _, _ in InterpacketTimerInterface().layout:
                 streamer_ports.append(getattr(streamer, f"rxtmr_la_{name}"))
+        if with_stats:
+            for name in STATS_EVENTS:
+                streamer_ports.append(getattr(streamer, f"stats_{name}"))
         if with_blinky:
             streamer_ports.append(streamer.led)
         return (streamer, streamer_ports)
 
     @staticmethod
-    def emit_verilog(path, with_utmi=False, with_blinky=False, with_utmi_la=False, data_clock=None):
+    def emit_verilog(
+        path,
+        with_utmi=False,
+        with_blinky=False,
+        with_utmi_la=False,
+        data_clock=None,
+        num_endpoints=1,
+        iso_in=False,
+        iso_packets_per_microframe=3,
+        with_stats=False,
+        cache_dir=None,
+        force_regen=False,
+    ):
         streamer, streamer_ports = USBBulkStreamerDevice.get_instance_and_ports(
             with_utmi=with_utmi,
             with_blinky=with_blinky,
             with_utmi_la=with_utmi_la,
             data_clock=data_clock,
+            num_endpoints=num_endpoints,
+            iso_in=iso_in,
+            iso_packets_per_microframe=iso_packets_per_microframe,
+            with_stats=with_stats,
+        )
+        cache = VerilogCache(cache_dir=cache_dir, force=force_regen)
+        cache_key = cache.key(
+            with_utmi=with_utmi,
+            with_blinky=with_blinky,
+            with_utmi_la=with_utmi_la,
+            data_clock=None if data_clock is None else float(data_clock),
+            num_endpoints=num_endpoints,
+            iso_in=iso_in,
+            iso_packets_per_microframe=iso_packets_per_microframe,
+            with_stats=with_stats,
+            descriptors=streamer.descriptor_contents(),
+            generator=file_digest(__file__),
         )
+        if cache.fetch(cache_key, path, name="bulk_streamer"):
+            return
         parser = amaranth.cli.main_parser()
         args = parser.parse_args(["generate", "-t", "v", path])
         amaranth.cli.main_runner(parser, args, streamer, name="bulk_streamer", ports=streamer_ports)
+        cache.store(cache_key, path)
 
 
 if __name__ == "__main__":
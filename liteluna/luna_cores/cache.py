@@ -0,0 +1,87 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from importlib import metadata
+
+logger = logging.getLogger(__name__)
+
+
+def default_cache_dir():
+    cache_dir = os.environ.get("LITELUNA_CACHE_DIR")
+    if cache_dir is not None:
+        return cache_dir
+    xdg_cache_home = os.environ.get(
+        "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")
+    )
+    return os.path.join(xdg_cache_home, "liteluna")
+
+
+def package_version(*names):
+    for name in names:
+        try:
+            return metadata.version(name)
+        except metadata.PackageNotFoundError:
+            pass
+    return None
+
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class VerilogCache:
+    """Content-addressed store of generated Verilog, keyed on generator parameters.
+
+    Setting ``LITELUNA_FORCE_REGEN=1`` in the environment has the same effect as ``force=True``.
+    An empty ``LITELUNA_CACHE_DIR`` disables the cache.
+    """
+
+    def __init__(self, cache_dir=None, force=False):
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        self.cache_dir = cache_dir
+        self.force = force or os.environ.get("LITELUNA_FORCE_REGEN", "0") not in ("", "0")
+
+    @property
+    def enabled(self):
+        return bool(self.cache_dir)
+
+    def key(self, **params):
+        params = dict(
+            params,
+            amaranth=package_version("amaranth"),
+            luna=package_version("luna-usb", "luna"),
+            usb_protocol=package_version("usb-protocol", "usb_protocol"),
+        )
+        blob = json.dumps(params, sort_keys=True, default=str).encode()
+        return hashlib.sha256(blob).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.v")
+
+    def fetch(self, key, path, name="verilog"):
+        if not self.enabled:
+            return False
+        cached = self._path(key)
+        if self.force:
+            logger.info(f"{name} cache: forced regeneration of {path}")
+            return False
+        if not os.path.exists(cached):
+            logger.info(f"{name} cache: miss {key[:16]}, generating {path}")
+            return False
+        logger.info(f"{name} cache: hit {key[:16]}, reusing {cached}")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        shutil.copyfile(cached, path)
+        return True
+
+    def store(self, key, path):
+        if not self.enabled:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cached = self._path(key)
+        tmp = f"{cached}.{os.getpid()}.tmp"
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, cached)
@@ -0,0 +1,285 @@
+import contextlib
+
+from amaranth import Elaboratable, Module
+from amaranth.sim import Settle, Simulator
+from luna.gateware.usb.usb2 import USBSpeed
+
+from liteluna.luna_cores.bulk_streamer import (
+    STREAM_PORT_LAYOUT,
+    USBBulkStreamerDevice,
+    stream_port_prefix,
+)
+from liteluna.sim.trace import TraceWriter
+from liteluna.sim.usb_host import USBHost, USBHostError
+from liteluna.utmi import LineState, check_sim_time_scale
+
+USB_CLK_FREQ = 60e6
+# keeps the 2.5 us reset/chirp detection thresholds at 9 cycles, comfortably above the minimum
+DEFAULT_TIME_SCALE = 16
+
+
+class StreamerLoopbackBench(Elaboratable):
+    """``USBBulkStreamerDevice`` on its UTMI interface, each OUT stream looped back to the IN
+    stream of the same endpoint with the payload inverted (like the Verilator loopback SoC)."""
+
+    def __init__(self, time_scale=DEFAULT_TIME_SCALE, invert=True, **kwargs):
+        self.time_scale = time_scale
+        self.invert = invert
+        self.dut = USBBulkStreamerDevice(
+            with_utmi=True, data_clock=USB_CLK_FREQ * (1 / time_scale), **kwargs
+        )
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.dut = dut = self.dut
+
+        m.d.comb += dut.connect.eq(1)
+        for i in range(dut.num_endpoints):
+            out_prefix = stream_port_prefix("out", i)
+            in_prefix = stream_port_prefix("in", i)
+            for name, _ in STREAM_PORT_LAYOUT:
+                src = getattr(dut, f"{out_prefix}_{name}")
+                dst = getattr(dut, f"{in_prefix}_{name}")
+                if name == "ready":
+                    m.d.comb += src.eq(dst)
+                elif name == "payload" and self.invert:
+                    m.d.comb += dst.eq(~src)
+                else:
+                    m.d.comb += dst.eq(src)
+
+        return m
+
+
+class _Request:
+    def __init__(self, kind, arg=None):
+        self.kind = kind
+        self.arg = arg
+
+    def __await__(self):
+        return (yield self)
+
+
+class UTMIHostModel:
+    """In-process PHY and host for a ``USBBulkStreamerDevice`` built with ``with_utmi=True``.
+
+    Drives the device's ``utmi_*`` ports from an Amaranth simulator process in the ``usb``
+    domain: ``negotiate()`` runs bus reset and the high-speed chirp handshake, ``run(coro)``
+    steps an ``async`` script. The model is also the ``USBHost`` link: the host's ``write`` queues
+    packets, and each ``await read()`` sends them to the device and clocks the simulation until
+    the device answers.
+
+    ``recorder`` (a ``TraceWriter``) gets every packet and line state change, timestamped in
+    cycles.
+    """
+
+    def __init__(
+        self,
+        dut,
+        clk_freq=USB_CLK_FREQ,
+        time_scale=DEFAULT_TIME_SCALE,
+        chirp_pairs=4,
+        interpacket_gap=8,
+        response_timeout=1000,
+        max_cycles=None,
+        recorder=None,
+    ):
+        self.dut = dut
+        self.cycles = check_sim_time_scale(clk_freq, time_scale)
+        self.chirp_pairs = chirp_pairs
+        self.interpacket_gap = interpacket_gap
+        self.response_timeout = response_timeout
+        self.max_cycles = max_cycles
+        self.recorder = recorder
+        self.cycle = 0
+        self.high_speed = False
+        self._idle = 0
+        self._line_state = None
+        self._pending = []
+
+    def _port(self, name):
+        return getattr(self.dut, f"utmi_{name}")
+
+    # link
+
+    def write(self, frames):
+        self._pending.extend(bytes(frame) for frame in frames)
+
+    def read(self):
+        return _Request("read")
+
+    def drain(self):
+        return _Request("drain")
+
+    def delay(self, cycles):
+        return _Request("delay", cycles)
+
+    # clocking
+
+    def _tick(self):
+        yield
+        self.cycle += 1
+        if self.max_cycles is not None and self.cycle > self.max_cycles:
+            raise TimeoutError(f"simulation passed {self.max_cycles} cycles")
+        if self.high_speed:
+            # the idle bus toggles now and then so the device doesn't detect suspend
+            self._idle += 1
+            line_state = LineState.FS_HS_J
+            if self._idle >= self.cycles["toggle"]:
+                self._idle = 0
+                line_state = LineState.FS_HS_K
+            yield from self._set_line_state(line_state)
+
+    def _set_line_state(self, line_state):
+        if line_state != self._line_state:
+            self._line_state = line_state
+            yield self._port("line_state").eq(line_state)
+            if self.recorder is not None:
+                self.recorder.state(self.cycle, line_state=line_state, tx_ready=1)
+
+    def _wait(self, cycles):
+        for _ in range(cycles):
+            yield from self._tick()
+
+    def _wait_for(self, signal, value, timeout, what):
+        for _ in range(timeout):
+            yield Settle()
+            if (yield signal) == value:
+                return
+            yield from self._tick()
+        raise USBHostError(f"timed out after {timeout} cycles waiting for {what}")
+
+    # line
+
+    def negotiate(self):
+        tx_valid = self._port("tx_valid")
+        timeout = 4 * self.cycles["toggle"]
+
+        yield self._port("vbus_valid").eq(1)
+        yield self._port("tx_ready").eq(1)
+        yield from self._set_line_state(LineState.SE0)
+        yield from self._wait(self.cycles["bus_reset"])
+
+        yield from self._set_line_state(LineState.FS_HS_J)
+        yield from self._wait_for(tx_valid, 1, timeout, "the device chirp")
+        yield from self._wait_for(tx_valid, 0, timeout, "the end of the device chirp")
+        for _ in range(self.chirp_pairs):
+            yield from self._set_line_state(LineState.FS_HS_K)
+            yield from self._wait(self.cycles["chirp"])
+            yield from self._set_line_state(LineState.FS_HS_J)
+            yield from self._wait(self.cycles["chirp"])
+
+        self.high_speed = True
+        yield from self._wait_for(
+            self.dut.current_speed, USBSpeed.HIGH, timeout, "high-speed operation"
+        )
+
+    # packets
+
+    def _send(self, packet):
+        rx_data, rx_valid, rx_active = (self._port(n) for n in ("rx_data", "rx_valid", "rx_active"))
+        if self.recorder is not None:
+            self.recorder.rx(self.cycle, packet)
+        yield rx_active.eq(1)
+        yield from self._tick()
+        for byte in packet:
+            yield rx_data.eq(byte)
+            yield rx_valid.eq(1)
+            yield from self._tick()
+        yield rx_valid.eq(0)
+        yield rx_active.eq(0)
+        yield from self._wait(self.interpacket_gap)
+
+    def _send_pending(self):
+        pending, self._pending = self._pending, []
+        for packet in pending:
+            yield from self._send(packet)
+
+    def _receive(self):
+        tx_valid, tx_data = self._port("tx_valid"), self._port("tx_data")
+        yield from self._wait_for(tx_valid, 1, self.response_timeout, "a device packet")
+        start = self.cycle
+        packet = bytearray()
+        while True:
+            yield Settle()
+            if not (yield tx_valid):
+                break
+            packet.append((yield tx_data))
+            yield from self._tick()
+        if self.recorder is not None:
+            self.recorder.tx(start, packet)
+        yield from self._wait(self.interpacket_gap)
+        return bytes(packet)
+
+    # scripts
+
+    def run(self, coro):
+        """Steps ``coro`` (typically built on a ``USBHost`` using this model as its link) and
+        returns its result; exceptions are thrown into it where it awaits."""
+        value, error = None, None
+        while True:
+            try:
+                if error is not None:
+                    request, error = coro.throw(error), None
+                else:
+                    request = coro.send(value)
+            except StopIteration as stop:
+                yield from self._send_pending()
+                return stop.value
+            value = None
+            yield from self._send_pending()
+            try:
+                if request.kind == "read":
+                    value = yield from self._receive()
+                elif request.kind == "delay":
+                    yield from self._wait(request.arg)
+            except USBHostError as e:
+                error = e
+
+
+async def select_alt_setting(host, model, alt_setting=1):
+    """``run_simulation`` script for ``iso_in=True``: enumerates, selects ``alt_setting`` of
+    interface 0 (where the isochronous IN endpoint lives) and returns the host and the setting
+    GET_INTERFACE reads back."""
+    await host.enumerate(with_strings=False)
+    await host.set_interface(0, alt_setting)
+    return host, await host.get_interface(0)
+
+
+def run_simulation(
+    script,
+    time_scale=DEFAULT_TIME_SCALE,
+    vcd_file=None,
+    trace_file=None,
+    max_cycles=None,
+    trace=None,
+    **kwargs,
+):
+    """Simulates a loopback ``USBBulkStreamerDevice`` under Amaranth and runs
+    ``await script(host, model)`` against it once it is in high-speed mode.
+
+    Needs nothing but Amaranth and LUNA: no Verilog, simulator binary or sockets, so independent
+    simulations can run side by side in separate processes. ``trace_file`` records a binary
+    UTMI trace (see ``liteluna.sim.trace``), far smaller than ``vcd_file``.
+    """
+    bench = StreamerLoopbackBench(time_scale=time_scale, **kwargs)
+    recorder = TraceWriter(trace_file, timebase=USB_CLK_FREQ) if trace_file else None
+    model = UTMIHostModel(
+        bench.dut, time_scale=time_scale, max_cycles=max_cycles, recorder=recorder
+    )
+    host = USBHost(model, trace=trace)
+    result = {}
+
+    def process():
+        yield from model.negotiate()
+        result["value"] = yield from model.run(script(host, model))
+
+    sim = Simulator(bench)
+    sim.add_clock(1 / USB_CLK_FREQ, domain="usb")
+    sim.add_sync_process(process, domain="usb")
+    try:
+        with sim.write_vcd(vcd_file) if vcd_file else contextlib.nullcontext():
+            sim.run()
+    finally:
+        if recorder is not None:
+            recorder.close()
+    return result["value"]
@@ -0,0 +1,133 @@
+import functools
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+INVERT_TABLE = bytes(range(255, -1, -1))
+
+LFSR_WIDTH = 16
+LFSR_TAPS = 0xB400  # x^16 + x^14 + x^13 + x^11 + 1, maximal length
+LFSR_PERIOD = (1 << LFSR_WIDTH) - 1
+
+
+@functools.lru_cache(maxsize=None)
+def lfsr_table():
+    # one full period of the Galois LFSR, 8 output bits per byte, LSB first
+    out = bytearray(LFSR_PERIOD)
+    state = 1
+    for i in range(LFSR_PERIOD):
+        byte = 0
+        for bit in range(8):
+            lsb = state & 1
+            byte |= lsb << bit
+            state >>= 1
+            if lsb:
+                state ^= LFSR_TAPS
+        out[i] = byte
+    return bytes(out)
+
+
+@functools.lru_cache(maxsize=None)
+def xor_table(value):
+    return bytes(b ^ value for b in range(256))
+
+
+class Pattern:
+    """Seekable, deterministic byte pattern.
+
+    ``kind`` is ``"counter"`` (byte ``i`` is ``seed + i``) or ``"lfsr"`` (a 16-bit maximal LFSR
+    started ``seed`` bytes in, XORed with the period index so whole-period drops still show up).
+    """
+
+    KINDS = ("counter", "lfsr")
+
+    def __init__(self, kind="lfsr", seed=1):
+        if kind not in self.KINDS:
+            raise ValueError(f"unknown pattern {kind!r}, expected one of {self.KINDS}")
+        self.kind = kind
+        self.seed = seed
+        if kind == "counter":
+            self.period = 256
+            table = bytes(range(256))
+        else:
+            self.period = LFSR_PERIOD
+            table = lfsr_table()
+        self._table = table
+        self.offset = 0
+
+    def generate(self, offset, length):
+        out = bytearray()
+        position = offset + self.seed
+        while len(out) < length:
+            index, start = divmod(position, self.period)
+            chunk = self._table[start : start + min(self.period - start, length - len(out))]
+            if self.kind == "lfsr" and index & 0xFF:
+                chunk = chunk.translate(xor_table(index & 0xFF))
+            out += chunk
+            position += len(chunk)
+        return bytes(out)
+
+    def next(self, length):
+        data = self.generate(self.offset, length)
+        self.offset += length
+        return data
+
+
+class PatternChecker:
+    """Compares a received stream against a ``Pattern``, optionally bit-inverted.
+
+    Matching data costs one ``memcmp``; mismatching batches are counted with NumPy when it is
+    installed and with a byte loop otherwise.
+    """
+
+    def __init__(self, pattern, invert=False):
+        self.pattern = pattern
+        self.invert = invert
+        self.offset = 0
+        self.error_bytes = 0
+        self.error_batches = 0
+        self.first_error = None
+
+    def expected(self, offset, length):
+        data = self.pattern.generate(offset, length)
+        return data.translate(INVERT_TABLE) if self.invert else data
+
+    def check(self, data):
+        expected = self.expected(self.offset, len(data))
+        errors = 0
+        if data != expected:
+            first, errors = self._diff(data, expected)
+            self.error_batches += 1
+            self.error_bytes += errors
+            if self.first_error is None:
+                self.first_error = self.offset + first
+        self.offset += len(data)
+        return errors
+
+    @staticmethod
+    def _diff(data, expected):
+        if np is not None:
+            mismatch = np.frombuffer(data, np.uint8) != np.frombuffer(expected, np.uint8)
+            errors = int(np.count_nonzero(mismatch))
+            return int(np.argmax(mismatch)), errors
+        first = None
+        errors = 0
+        for i, (a, b) in enumerate(zip(bytes(data), expected)):
+            if a != b:
+                errors += 1
+                if first is None:
+                    first = i
+        return first, errors
+
+    @property
+    def ok(self):
+        return self.first_error is None
+
+    def summary(self):
+        s = f"{self.offset} bytes checked, {self.error_bytes} bad bytes"
+        s += f" in {self.error_batches} batches"
+        if self.first_error is not None:
+            s += f", first mismatch at offset {self.first_error}"
+        return s
@@ -0,0 +1 @@
+from liteluna.sim import framing, pcap, replay, server, trace, usb_host
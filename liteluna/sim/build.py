@@ -0,0 +1,105 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+
+from liteluna.luna_cores.cache import package_version
+
+logger = logging.getLogger(__name__)
+
+# sim_config.js is only read at run time, so it may differ between runs of the same binary
+RUNTIME_FILES = ("sim_config.js",)
+# LiteX stamps the generation time (to the second) into the Verilog and its banners
+TIMESTAMP_RE = re.compile(rb"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d")
+OUTPUT_DIRS = ("obj_dir", "modules")
+STAMP = ".liteluna_build.json"
+
+
+def verilator_version():
+    try:
+        return subprocess.run(
+            ["verilator", "--version"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class SimBuildCache:
+    """Reuses a compiled Verilator simulation while its generated sources are unchanged.
+
+    The digest covers every generated file in the gateware directory (Verilog, C++ glue, memory
+    init files and ``build_sim.sh`` with the compile options) minus their generation timestamps,
+    and the LiteX and Verilator versions; the stamp lives in ``obj_dir`` so it disappears with
+    the binary. On a rebuild, ``OBJCACHE=ccache`` is set (when ccache is installed) so
+    Verilator's makefile reuses objects.
+    """
+
+    def __init__(self, gateware_dir, ccache=True):
+        self.gateware_dir = os.path.abspath(gateware_dir)
+        self.ccache = ccache
+
+    def digest(self):
+        h = hashlib.sha256()
+        meta = {"litex": package_version("litex"), "verilator": verilator_version()}
+        h.update(json.dumps(meta, sort_keys=True).encode())
+        for root, dirs, files in os.walk(self.gateware_dir):
+            if root == self.gateware_dir:
+                dirs[:] = [d for d in dirs if d not in OUTPUT_DIRS]
+            dirs.sort()
+            for name in sorted(files):
+                if root == self.gateware_dir and name in RUNTIME_FILES:
+                    continue
+                path = os.path.join(root, name)
+                h.update(os.path.relpath(path, self.gateware_dir).encode() + b"\0")
+                with open(path, "rb") as f:
+                    h.update(hashlib.sha256(TIMESTAMP_RE.sub(b"", f.read())).digest())
+        return h.hexdigest()
+
+    @property
+    def _stamp_path(self):
+        return os.path.join(self.gateware_dir, "obj_dir", STAMP)
+
+    def is_current(self, digest):
+        if not os.path.exists(os.path.join(self.gateware_dir, "obj_dir", "Vsim")):
+            return False
+        if not os.path.isdir(os.path.join(self.gateware_dir, "modules")):
+            return False
+        try:
+            with open(self._stamp_path) as f:
+                return json.load(f)["digest"] == digest
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def write_stamp(self, digest):
+        with open(self._stamp_path, "w") as f:
+            json.dump({"digest": digest}, f)
+
+    @contextlib.contextmanager
+    def patch(self):
+        """Skips LiteX's Verilator compile step (``rm -rf obj_dir`` and ``make``) during a
+        ``builder.build`` when the compiled model is current."""
+        from litex.build.sim import verilator
+
+        original = verilator._compile_sim
+
+        def _compile_sim(*args, **kwargs):
+            # runs in the gateware directory, after build_sim.sh (and its options) was written
+            digest = self.digest()
+            if self.is_current(digest):
+                logger.info(f"sim build: sources unchanged ({digest[:16]}), reusing obj_dir/Vsim")
+                return
+            logger.info(f"sim build: sources changed ({digest[:16]}), compiling")
+            if self.ccache and "OBJCACHE" not in os.environ and shutil.which("ccache"):
+                os.environ["OBJCACHE"] = "ccache"
+            original(*args, **kwargs)
+            self.write_stamp(digest)
+
+        verilator._compile_sim = _compile_sim
+        try:
+            yield self
+        finally:
+            verilator._compile_sim = original
@@ -0,0 +1,145 @@
+import asyncio
+import threading
+import time
+
+import usb1
+
+from liteluna.host import SoftDevice
+from liteluna.sim.server import DEFAULT_PORT, FramedTCPServer
+from liteluna.sim.usb_host import USBHost
+
+
+class SimDevice(SoftDevice):
+    """A simulated bulk streamer behind the usb1 handle/context subset used by ``liteluna.host``.
+
+    A background thread accepts the simulation's framed-TCP connection, enumerates it with
+    ``USBHost`` and then services submitted transfers one packet at a time, alternating between
+    endpoints so a NAKing IN endpoint does not hold up OUT data.
+    """
+
+    def __init__(self, host="localhost", port=DEFAULT_PORT, **host_kwargs):
+        super().__init__()
+        self.address = host
+        self.port = port
+        self.host_kwargs = host_kwargs
+        self.usb_host = None
+        self.error = None
+        self._done = []
+        self._ready = threading.Event()
+        self._loop = asyncio.new_event_loop()
+        self._wake = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def wait_ready(self, timeout=None):
+        if not self._ready.wait(timeout):
+            raise TimeoutError(f"no simulation connected to {self.address}:{self.port}")
+        if self.error is not None:
+            raise self.error
+
+    # background thread
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._wake = asyncio.Event()
+        server = FramedTCPServer(self._handler, self.address, [self.port])
+        try:
+            self._loop.run_until_complete(server.serve_forever())
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._loop.run_until_complete(server.close())
+            self._loop.close()
+
+    async def _handler(self, connection):
+        if self.usb_host is not None:
+            connection.close()
+            return
+        self.usb_host = USBHost(connection, **self.host_kwargs)
+        try:
+            await self.usb_host.enumerate()
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self._ready.set()
+        await self._service()
+
+    async def _service(self):
+        host = self.usb_host
+        while True:
+            with self._lock:
+                heads = {}
+                for transfer in self._pending:
+                    heads.setdefault(transfer._endpoint, transfer)
+                if not heads:
+                    self._wake.clear()
+            if not heads:
+                await self._wake.wait()
+                continue
+            for endpoint, transfer in heads.items():
+                if endpoint & 0x80:
+                    await self._step_in(host, endpoint & 0x7F, transfer)
+                else:
+                    await self._step_out(host, endpoint, transfer)
+            await host.flush()
+
+    async def _step_out(self, host, endpoint, transfer):
+        mps = host.max_packet_size(endpoint, False)
+        chunk = transfer._buffer[transfer._offset : transfer._offset + mps]
+        if not await host.out_transaction(endpoint, chunk, max_naks=1):
+            return
+        with self._lock:
+            transfer._offset += len(chunk)
+            if transfer._offset >= len(transfer._buffer):
+                self._finish(transfer, usb1.TRANSFER_COMPLETED)
+
+    async def _step_in(self, host, endpoint, transfer):
+        mps = host.max_packet_size(endpoint, True)
+        payload = await host.in_transaction(endpoint, max_naks=1)
+        with self._lock:
+            if payload is not None:
+                n = min(len(payload), len(transfer._buffer) - transfer._offset)
+                transfer._buffer[transfer._offset : transfer._offset + n] = payload[:n]
+                transfer._offset += n
+                if len(payload) < mps or transfer._offset >= len(transfer._buffer):
+                    self._finish(transfer, usb1.TRANSFER_COMPLETED)
+            elif transfer._timeout and (
+                time.monotonic() - transfer._submit_time >= transfer._timeout / 1000
+            ):
+                self._finish(transfer, usb1.TRANSFER_TIMED_OUT)
+
+    def _finish(self, transfer, status):
+        # called with the lock held; a cancelled transfer is no longer pending
+        if transfer in self._pending:
+            self._pending.remove(transfer)
+            transfer._complete(status, transfer._offset)
+            self._done.append(transfer)
+            self._lock.notify_all()
+
+    # SoftDevice
+
+    def _submit(self, transfer):
+        super()._submit(transfer)
+        if self._wake is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def _process(self):
+        done, self._done = self._done, []
+        return done
+
+    @staticmethod
+    def _cancel_all():
+        for task in asyncio.all_tasks():
+            task.cancel()
+
+    def close(self):
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._cancel_all)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,131 @@
+import struct
+
+HEADER = struct.Struct(">I")
+
+
+class FrameDecoder:
+    """Length-prefixed frame decoder over preallocated, reused receive buffers.
+
+    Data is received straight into the buffer (``get_buffer``/``buffer_updated``, matching
+    ``asyncio.BufferedProtocol``, or ``recv_into``) and ``next_frame`` returns ``memoryview``
+    slices of it. A returned view stays valid until the following ``next_frame`` call: the two
+    buffers are swapped when the tail runs out, and a fresh one is only allocated when that
+    would happen twice between ``next_frame`` calls.
+    """
+
+    def __init__(self, size=1 << 20, min_read=64 * 1024):
+        self.size = size
+        self.min_read = min_read
+        self._buffers = [bytearray(size), bytearray(size)]
+        self._buffer = self._buffers[0]
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._swapped = False
+        self._held = False
+
+    @property
+    def pending(self):
+        return self._end - self._start
+
+    def _compact(self, need):
+        pending = self.pending
+        size = max(self.size, pending + need)
+        if self._swapped or len(self._buffers[1]) < size:
+            spare = bytearray(size)
+        else:
+            spare = self._buffers[1]
+        spare[:pending] = self._view[self._start : self._end]
+        self._buffers = [spare, self._buffer]
+        self._buffer = spare
+        self._view = memoryview(spare)
+        self._start = 0
+        self._end = pending
+        self._swapped = True
+
+    def get_buffer(self, sizehint=-1):
+        need = max(sizehint, self.min_read)
+        if len(self._buffer) - self._end < need:
+            if self._start == self._end and not self._held:
+                self._start = self._end = 0
+            if len(self._buffer) - self._end < need:
+                self._compact(need)
+        return self._view[self._end :]
+
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+
+    def recv_into(self, sock):
+        n = sock.recv_into(self.get_buffer())
+        self.buffer_updated(n)
+        return n
+
+    def next_frame(self):
+        # the previously returned frame is released here
+        self._swapped = False
+        self._held = False
+        if self.pending < HEADER.size:
+            return None
+        (length,) = HEADER.unpack_from(self._buffer, self._start)
+        start = self._start + HEADER.size
+        end = start + length
+        if end > self._end:
+            if end - self._start > len(self._buffer) - self.min_read:
+                # make room for frames larger than the buffer
+                self._compact(end - self._end)
+            return None
+        self._start = end
+        self._held = True
+        return self._view[start:end]
+
+    def frames(self):
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+
+class FrameEncoder:
+    """Packs frames back to back into one reused buffer, so a batch goes out in one syscall."""
+
+    def __init__(self, size=64 * 1024):
+        self._buffer = bytearray(size)
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def _reserve(self, n):
+        if self._length + n > len(self._buffer):
+            self._buffer.extend(bytes(max(n, len(self._buffer))))
+
+    def add(self, frame):
+        n = len(frame)
+        self._reserve(HEADER.size + n)
+        HEADER.pack_into(self._buffer, self._length, n)
+        start = self._length + HEADER.size
+        self._buffer[start : start + n] = frame
+        self._length = start + n
+
+    def extend(self, frames):
+        for frame in frames:
+            self.add(frame)
+
+    def view(self):
+        return memoryview(self._buffer)[: self._length]
+
+    def clear(self):
+        self._length = 0
+
+    def detach(self):
+        # hand the packed bytes to someone who keeps them (e.g. a transport write buffer)
+        data = self.view()
+        self._buffer = bytearray(len(self._buffer))
+        self._length = 0
+        return data
+
+    def send(self, sock):
+        with self.view() as view:
+            sock.sendall(view)
+        self.clear()
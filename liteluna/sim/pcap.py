@@ -0,0 +1,112 @@
+import argparse
+import struct
+
+from liteluna.sim.replay import LINKTYPE_USB_2_0, open_capture
+from liteluna.sim.usb_host import PID
+
+SHB = struct.Struct("<IIIHHqI")
+# block type, length, linktype, reserved, snaplen, if_tsresol option (10^-9 s), end of options
+IDB = struct.Struct("<IIHHIHHB3xII")
+# block type, length, interface, timestamp high/low, captured and original length
+EPB_HEADER = struct.Struct("<IIIIIII")
+# epb_flags option, end of options, block length
+EPB_TRAILER = struct.Struct("<HHIII")
+EPB_INBOUND = 1
+EPB_OUTBOUND = 2
+
+MICROFRAME_NS = 125_000
+HS_BIT_NS = 1 / 0.48
+# SYNC, EOP and the minimum inter-packet gap, in bits on a high-speed bus
+PACKET_OVERHEAD_BITS = 32 + 8 + 88
+
+
+class BusClock:
+    """Derives timestamps from the traffic itself: every SOF starts a 125 us microframe and
+    packets inside it are spaced by their length on a 480 Mbit/s bus, so runs of a slow
+    simulation line up with hardware captures."""
+
+    def __init__(self):
+        self.microframes = 0
+        self.offset_ns = 0.0
+
+    def stamp(self, packet):
+        if packet and packet[0] == PID.SOF:
+            self.microframes += 1
+            self.offset_ns = 0.0
+        timestamp = self.microframes * MICROFRAME_NS + int(self.offset_ns)
+        self.offset_ns += (len(packet) * 8 + PACKET_OVERHEAD_BITS) * HS_BIT_NS
+        return timestamp
+
+
+class PcapngWriter:
+    """Streams raw USB packets (PID first) to a pcapng file with the ``LINKTYPE_USB_2_0`` link
+    type, nanosecond timestamps and the direction in each packet's ``epb_flags``.
+
+    Implements the ``rx``/``tx`` recorder interface of ``RecordingLink``; with ``bus_clock`` the
+    link's timestamps are replaced by ``BusClock`` ones. Writes go through a large buffer.
+    """
+
+    def __init__(self, path, bus_clock=False, buffering=1 << 20, snaplen=0xFFFF):
+        self.file = open(path, "wb", buffering=buffering)
+        self.bus_clock = BusClock() if bus_clock else None
+        self.packets = 0
+        self.file.write(SHB.pack(0x0A0D0D0A, SHB.size, 0x1A2B3C4D, 1, 0, -1, SHB.size))
+        self.file.write(IDB.pack(1, IDB.size, LINKTYPE_USB_2_0, 0, snaplen, 9, 1, 9, 0, IDB.size))
+
+    def packet(self, timestamp_ns, data, inbound):
+        data = memoryview(data).cast("B")
+        if self.bus_clock is not None:
+            timestamp_ns = self.bus_clock.stamp(data)
+        padding = -len(data) % 4
+        length = EPB_HEADER.size + len(data) + padding + EPB_TRAILER.size
+        timestamp_ns = int(timestamp_ns)
+        self.file.write(
+            EPB_HEADER.pack(
+                6, length, 0, timestamp_ns >> 32, timestamp_ns & 0xFFFFFFFF, len(data), len(data)
+            )
+        )
+        self.file.write(data)
+        flags = EPB_INBOUND if inbound else EPB_OUTBOUND
+        self.file.write(bytes(padding) + EPB_TRAILER.pack(2, 4, flags, 0, length))
+        self.packets += 1
+
+    def rx(self, timestamp, data):
+        self.packet(timestamp, data, inbound=False)
+
+    def tx(self, timestamp, data):
+        self.packet(timestamp, data, inbound=True)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def convert(src, dst):
+    """Writes the packets of a text log or liteluna trace to pcapng, timed by ``BusClock``."""
+    with PcapngWriter(dst, bus_clock=True) as writer:
+        for kind, value in open_capture(src):
+            if kind == "h2d":
+                writer.rx(0, value)
+            elif kind == "d2h":
+                writer.tx(0, value)
+        return writer.packets
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a packet log or trace to pcapng")
+    parser.add_argument("src", help="h2d/d2h log or liteluna trace")
+    parser.add_argument("dst", help="pcapng file to write")
+    args = parser.parse_args()
+    print(f"{convert(args.src, args.dst)} packets written to {args.dst}")
+
+
+if __name__ == "__main__":
+    main()
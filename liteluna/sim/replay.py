@@ -0,0 +1,442 @@
+import asyncio
+import csv
+import struct
+from collections import namedtuple
+
+from liteluna.sim.trace import MAGIC as TRACE_MAGIC
+from liteluna.sim.trace import RecordKind, TraceReader
+from liteluna.sim.usb_host import (
+    PID,
+    DescriptorType,
+    Endpoint,
+    Request,
+    StallError,
+    USBHost,
+    USBHostError,
+    iter_descriptors,
+)
+
+PCAPNG_MAGIC = b"\x0a\x0d\x0d\x0a"
+TDC_MAGIC = b"TPDC"
+
+LINKTYPE_USB_LINUX = 189
+LINKTYPE_USB_LINUX_MMAPPED = 220
+LINKTYPE_USB_2_0 = 288
+
+# usbmon packet header: id, type, xfer_type, epnum, devnum, busnum, flag_setup, flag_data,
+# ts_sec, ts_usec, status, length, len_cap, setup
+USBMON_HEADER = struct.Struct("<QBBBBHbbqiiII8s")
+USBMON_HEADER_SIZE = {LINKTYPE_USB_LINUX: 48, LINKTYPE_USB_LINUX_MMAPPED: 64}
+USBMON_XFER_TYPES = ("isochronous", "interrupt", "control", "bulk")
+ENOENT = -2
+EPIPE = -32
+
+# the root hub always has address 1 on its bus
+ROOT_HUB_ADDRESS = 1
+
+Transfer = namedtuple(
+    "Transfer", "timestamp device endpoint transfer_type setup data length expected status"
+)
+
+
+# Text logs ----------------------------------------------------------------------------------------
+
+
+def parse_text_log(path):
+    """Yields ``("comment", line)``, ``("h2d", packet)`` and ``("d2h", packet)`` from a
+    ``h2d_raw:``/``d2h_raw:`` log one line at a time."""
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#"):
+                yield "comment", line
+                continue
+            for kind in ("h2d", "d2h"):
+                for prefix in (f"{kind}_raw: ", f"{kind}: "):
+                    if line.startswith(prefix):
+                        yield kind, bytes.fromhex(line.removeprefix(prefix))
+                        break
+
+
+def parse_trace(path):
+    with TraceReader(path) as reader:
+        for record in reader.packets():
+            yield "h2d" if record.kind == RecordKind.RX else "d2h", bytes(record.data)
+            record.data.release()
+
+
+# Undirected packet streams ------------------------------------------------------------------------
+
+
+class PacketDirections:
+    """Tags raw packets (PID byte first) as ``h2d`` or ``d2h`` from the token before them: data
+    follows the direction of its token and the handshake goes the other way."""
+
+    def __init__(self):
+        self.data_from_host = True
+
+    def __call__(self, packet):
+        pid = packet[0]
+        if pid in (PID.SETUP, PID.OUT, PID.PING):
+            self.data_from_host = True
+            return "h2d"
+        if pid == PID.IN:
+            self.data_from_host = False
+            return "h2d"
+        if pid == PID.SOF:
+            return "h2d"
+        if pid in (PID.DATA0, PID.DATA1, PID.DATA2, PID.MDATA):
+            return "h2d" if self.data_from_host else "d2h"
+        return "d2h" if self.data_from_host else "h2d"
+
+
+def packet_directions(packets):
+    direction = PacketDirections()
+    for packet in packets:
+        if packet:
+            yield direction(packet), packet
+
+
+def _csv_packets(path):
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            record = (row.get("Record") or "").strip().lower()
+            data = (row.get("Data") or "").strip()
+            if record.endswith("packet") and data:
+                yield bytes.fromhex(data)
+
+
+def parse_tdc_csv(path):
+    """Packets from a Total Phase Data Center CSV export (packet-level ``Data`` column)."""
+    return packet_directions(_csv_packets(path))
+
+
+# pcapng -------------------------------------------------------------------------------------------
+
+
+def iter_pcapng(path):
+    """Yields ``(linktype, timestamp, data, flags)`` for every packet block, reading one block at
+    a time. ``timestamp`` is in seconds, ``flags`` is the ``epb_flags`` option or ``None``."""
+    with open(path, "rb") as f:
+        endian = "<"
+        interfaces = []
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return
+            if header[:4] == PCAPNG_MAGIC:
+                # section header: the byte order magic decides how everything after it is read
+                bom = f.read(4)
+                endian = "<" if bom == b"\x4d\x3c\x2b\x1a" else ">"
+                (length,) = struct.unpack(endian + "I", header[4:])
+                f.seek(length - 12, 1)
+                interfaces = []
+                continue
+            block_type, length = struct.unpack(endian + "II", header)
+            body = f.read(length - 8)
+            if len(body) < length - 8:
+                return
+            if block_type == 1:
+                linktype, _, _ = struct.unpack_from(endian + "HHI", body)
+                resolution = 1e-6
+                for code, value in _options(body[8:-4], endian):
+                    if code == 9 and value:
+                        tsresol = value[0]
+                        resolution = 2.0 ** -(tsresol & 0x7F) if tsresol & 0x80 else 10.0**-tsresol
+                interfaces.append((linktype, resolution))
+            elif block_type == 6:
+                interface, ts_high, ts_low, captured, _ = struct.unpack_from(endian + "IIIII", body)
+                linktype, resolution = interfaces[interface]
+                timestamp = ((ts_high << 32) | ts_low) * resolution
+                flags = None
+                for code, value in _options(body[20 + captured + (-captured % 4) : -4], endian):
+                    if code == 2 and len(value) == 4:
+                        (flags,) = struct.unpack(endian + "I", value)
+                yield linktype, timestamp, body[20 : 20 + captured], flags
+            elif block_type == 3 and interfaces:
+                (captured,) = struct.unpack_from(endian + "I", body)
+                yield interfaces[0][0], None, body[4 : 4 + captured], None
+
+
+def _options(options, endian):
+    offset = 0
+    while offset + 4 <= len(options):
+        code, length = struct.unpack_from(endian + "HH", options, offset)
+        if code == 0:
+            break
+        yield code, options[offset + 4 : offset + 4 + length]
+        offset += 4 + ((length + 3) & ~3)
+
+
+def parse_pcapng(path, devices=None):
+    """Events from a pcapng capture.
+
+    ``LINKTYPE_USB_2_0`` packets become ``h2d``/``d2h`` events, by their ``epb_flags`` direction
+    when recorded. usbmon URBs become ``transfer`` events carrying a ``Transfer``, emitted when
+    the URB completes; only ``devices`` (addresses) are kept, by default everything but root
+    hubs.
+    """
+    pending = {}
+    direction = PacketDirections()
+    for linktype, timestamp, data, flags in iter_pcapng(path):
+        if linktype == LINKTYPE_USB_2_0 and data:
+            # prefer the recorded direction (epb_flags bits 1:0) over inferring it
+            if flags is not None and flags & 3:
+                yield ("d2h" if flags & 3 == 1 else "h2d"), data
+            else:
+                yield direction(data), data
+        elif linktype in USBMON_HEADER_SIZE:
+            transfer = _usbmon_urb(pending, linktype, timestamp, data, devices)
+            if transfer is not None:
+                yield "transfer", transfer
+
+
+def _usbmon_urb(pending, linktype, timestamp, data, devices):
+    (
+        urb_id,
+        event,
+        xfer_type,
+        epnum,
+        devnum,
+        busnum,
+        flag_setup,
+        _,
+        _,
+        _,
+        status,
+        length,
+        captured,
+        setup,
+    ) = USBMON_HEADER.unpack_from(data)
+    if devices is None:
+        if devnum == ROOT_HUB_ADDRESS:
+            return None
+    elif devnum not in devices:
+        return None
+    payload = data[USBMON_HEADER_SIZE[linktype] :][:captured]
+    key = (busnum, urb_id)
+    if event == ord("S"):
+        pending[key] = Transfer(
+            timestamp,
+            devnum,
+            epnum,
+            USBMON_XFER_TYPES[xfer_type],
+            setup if flag_setup == 0 else None,
+            payload if not epnum & 0x80 else b"",
+            length,
+            None,
+            None,
+        )
+        return None
+    submit = pending.pop(key, None)
+    if submit is None:
+        return None
+    expected = payload if epnum & 0x80 else None
+    return submit._replace(expected=expected, status=status)
+
+
+# Capture files ------------------------------------------------------------------------------------
+
+
+def open_capture(path, devices=None):
+    """Lazily parses a text log, liteluna trace, pcapng capture or Data Center CSV export."""
+    with open(path, "rb") as f:
+        magic = f.read(8)
+    if magic[:4] == PCAPNG_MAGIC:
+        return parse_pcapng(path, devices)
+    if magic == TRACE_MAGIC:
+        return parse_trace(path)
+    if magic[:4] == TDC_MAGIC:
+        raise ValueError(
+            f"{path}: Total Phase .tdc captures use an undocumented compressed format; export "
+            "the packets from Data Center as CSV and replay that"
+        )
+    if path.endswith(".csv"):
+        return parse_tdc_csv(path)
+    return parse_text_log(path)
+
+
+# Summary ------------------------------------------------------------------------------------------
+
+
+class ReplaySummary:
+    """Running comparison of expected and actual device responses."""
+
+    def __init__(self, max_examples=10):
+        self.max_examples = max_examples
+        self.compared = 0
+        self.mismatches = 0
+        self.retries = 0
+        self.skipped = 0
+        self.extra = 0
+        self.examples = []
+
+    def check(self, what, expected, actual):
+        self.compared += 1
+        if expected == actual:
+            return True
+        self.mismatches += 1
+        if len(self.examples) < self.max_examples:
+            self.examples.append((self.compared, what, expected, actual))
+        return False
+
+    @property
+    def ok(self):
+        return self.mismatches == 0 and self.extra == 0
+
+    def summary(self):
+        s = f"{self.compared} responses compared, {self.mismatches} mismatches"
+        if self.retries:
+            s += f", {self.retries} NAK retries"
+        if self.skipped:
+            s += f", {self.skipped} transfers skipped"
+        if self.extra:
+            s += f", {self.extra} unexpected frames"
+        for index, what, expected, actual in self.examples:
+            s += f"\n  #{index} {what}: expected {_format(expected)}, got {_format(actual)}"
+        return s
+
+
+def _format(value):
+    if isinstance(value, tuple):
+        return ", ".join(_format(v) for v in value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex(" ") or "(empty)"
+    return repr(value)
+
+
+# Replay -------------------------------------------------------------------------------------------
+
+
+async def read_frame(link, timeout):
+    while True:
+        frame = await asyncio.wait_for(link.read(), timeout)
+        # idle line filler from the PHY model
+        if not (len(frame) > 64 and not any(frame)):
+            return bytes(frame)
+
+
+class Replayer:
+    """Replays capture events to a device on ``link`` (see ``open_capture``).
+
+    Packets go out as soon as the previous response they depend on has arrived: consecutive
+    ``h2d`` packets are written together and each expected ``d2h`` packet is awaited, then
+    compared. A NAK where the capture had an answer resends the last batch, up to
+    ``max_retries`` times. usbmon transfers are reissued through a ``USBHost``.
+    """
+
+    def __init__(self, link, timeout=10, max_retries=100, summary=None, log=None):
+        self.link = link
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.summary = summary if summary is not None else ReplaySummary()
+        self.log = log
+        self.host = None
+        self._batch = []
+        self._last_batch = []
+
+    def _print(self, message):
+        if self.log is not None:
+            print(message, file=self.log)
+
+    async def _send(self):
+        if self._batch:
+            self.link.write(self._batch)
+            drain = getattr(self.link, "drain", None)
+            if drain is not None:
+                await drain()
+            self._last_batch, self._batch = self._batch, []
+
+    async def _expect(self, expected):
+        await self._send()
+        actual = await read_frame(self.link, self.timeout)
+        retries = 0
+        while (
+            actual[:1] == bytes([PID.NAK])
+            and expected[:1] != bytes([PID.NAK])
+            and retries < self.max_retries
+        ):
+            retries += 1
+            self.summary.retries += 1
+            self.link.write(self._last_batch)
+            actual = await read_frame(self.link, self.timeout)
+        if not self.summary.check("packet", expected, actual):
+            self._print(f"MISMATCH expected {expected.hex(' ')}, got {actual.hex(' ')}")
+
+    async def _transfer(self, transfer):
+        if self.host is None:
+            self.host = USBHost(self.link, with_sof=False)
+        host = self.host
+        if transfer.status == ENOENT or transfer.transfer_type == "isochronous":
+            # cancelled URBs never reached the bus in a form we can reproduce
+            self.summary.skipped += 1
+            return
+        if transfer.device and transfer.device != host.address:
+            # the host controller sets addresses itself, so usbmon never shows SET_ADDRESS
+            await host.control_transfer(0x00, Request.SET_ADDRESS, transfer.device)
+        endpoint = transfer.endpoint & 0x7F
+        is_in = bool(transfer.endpoint & 0x80)
+        try:
+            if transfer.transfer_type == "control":
+                request_type, request, value, index, length = struct.unpack(
+                    "<BBHHH", transfer.setup
+                )
+                data = length if request_type & 0x80 else transfer.data
+                actual = await host.control_transfer(request_type, request, value, index, data)
+                if request_type & 0x80:
+                    self._learn(request, value, actual)
+                else:
+                    actual = None
+            elif is_in:
+                actual = await host.bulk_in(endpoint, transfer.length)
+            else:
+                await host.bulk_out(endpoint, transfer.data)
+                actual = None
+            status = 0
+        except StallError:
+            actual, status = None, EPIPE
+        what = f"{transfer.transfer_type} {transfer.endpoint:#04x}"
+        if not self.summary.check(what, (transfer.status, transfer.expected), (status, actual)):
+            self._print(
+                f"MISMATCH {what}: expected {_format(transfer.expected)}, got {_format(actual)}"
+            )
+
+    def _learn(self, request, value, data):
+        # keep the host's view of the device in step with what the capture enumerated
+        if request != Request.GET_DESCRIPTOR:
+            return
+        if value >> 8 == DescriptorType.DEVICE and len(data) >= 8:
+            self.host.ep0_max_packet_size = data[7]
+        elif value >> 8 == DescriptorType.CONFIGURATION:
+            for descriptor_type, descriptor in iter_descriptors(data):
+                if descriptor_type == DescriptorType.ENDPOINT and len(descriptor) >= 7:
+                    ep = Endpoint(descriptor)
+                    self.host.endpoints[ep.address] = ep
+
+    async def run(self, events):
+        for kind, value in events:
+            if kind == "comment":
+                self._print(value)
+            elif kind == "h2d":
+                self._batch.append(value)
+            elif kind == "d2h":
+                await self._expect(value)
+            elif kind == "transfer":
+                await self._send()
+                try:
+                    await asyncio.wait_for(self._transfer(value), self.timeout)
+                except (USBHostError, asyncio.TimeoutError) as e:
+                    self.summary.check(f"transfer {value.endpoint:#04x}", value.expected, e)
+        await self._send()
+        return self.summary
+
+    async def drain_extra(self, timeout=1):
+        """Counts frames the device sent that the capture did not expect."""
+        while True:
+            try:
+                frame = await read_frame(self.link, timeout)
+            except asyncio.TimeoutError:
+                return self.summary.extra
+            self.summary.extra += 1
+            self._print(f"extra frame: {frame.hex(' ')}")
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+
+from liteluna.sim.framing import FrameDecoder, FrameEncoder
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 2443
+
+
+class ConnectionClosed(EOFError):
+    pass
+
+
+class FramedConnection(asyncio.BufferedProtocol):
+    """One serial2framed_tcp peer: 4-byte big-endian length prefix, then the frame.
+
+    ``read()`` returns a ``memoryview`` into the receive buffer that stays valid until the next
+    ``read()``.
+    """
+
+    def __init__(self, max_pending=4 << 20):
+        self.max_pending = max_pending
+        self.transport = None
+        self.peer = None
+        self._decoder = FrameDecoder()
+        self._encoder = FrameEncoder()
+        self._paused = False
+        self._eof = False
+        loop = asyncio.get_running_loop()
+        self._connected = loop.create_future()
+        self._closed = loop.create_future()
+        self._readable = asyncio.Event()
+        self._can_write = asyncio.Event()
+        self._can_write.set()
+
+    # asyncio.BufferedProtocol
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info("peername")
+        self._connected.set_result(None)
+
+    def get_buffer(self, sizehint):
+        return self._decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self._decoder.buffer_updated(nbytes)
+        self._readable.set()
+        if self._decoder.pending >= self.max_pending and not self._paused:
+            self.transport.pause_reading()
+            self._paused = True
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        if not self._closed.done():
+            self._closed.set_result(exc)
+        self._eof = True
+        self._readable.set()
+        self._can_write.set()
+
+    def pause_writing(self):
+        self._can_write.clear()
+
+    def resume_writing(self):
+        self._can_write.set()
+
+    # frame API
+
+    async def read(self):
+        while True:
+            frame = self._decoder.next_frame()
+            if frame is not None:
+                break
+            if self._eof:
+                raise ConnectionClosed(f"{self.peer} disconnected")
+            if self._paused:
+                self.transport.resume_reading()
+                self._paused = False
+            self._readable.clear()
+            await self._readable.wait()
+        return frame
+
+    def write(self, frames):
+        # the whole batch is packed into one buffer and handed over in a single send
+        if isinstance(frames, (bytes, bytearray, memoryview)):
+            frames = [frames]
+        encoder = self._encoder
+        encoder.extend(frames)
+        self.transport.write(encoder.view())
+        if self.transport.get_write_buffer_size():
+            # the transport may still reference the buffer
+            encoder.detach()
+        else:
+            encoder.clear()
+
+    async def drain(self):
+        if self.transport.is_closing():
+            raise ConnectionClosed(f"{self.peer} disconnected")
+        await self._can_write.wait()
+
+    def close(self):
+        self.transport.close()
+
+    async def wait_closed(self):
+        await asyncio.shield(self._closed)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.read()
+        except ConnectionClosed:
+            raise StopAsyncIteration
+
+
+class FramedTCPServer:
+    """Serves framed-TCP simulations, one ``handler(connection)`` task per connection.
+
+    Any number of simulations may connect to each of ``ports``; every connection is handled
+    independently, so one host process can drive a whole farm of Verilator instances.
+    """
+
+    def __init__(self, handler, host="localhost", ports=(DEFAULT_PORT,), max_pending=4 << 20):
+        self.handler = handler
+        self.host = host
+        self.ports = list(ports)
+        self.max_pending = max_pending
+        self.connections = set()
+        self._servers = []
+        self._tasks = set()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for port in self.ports:
+            server = await loop.create_server(
+                self._protocol, self.host, port, reuse_address=True, reuse_port=True
+            )
+            self._servers.append(server)
+            logger.info(f"listening on {self.host}:{port}")
+
+    def _protocol(self):
+        connection = FramedConnection(self.max_pending)
+        task = asyncio.get_running_loop().create_task(self._serve(connection))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return connection
+
+    async def _serve(self, connection):
+        await connection._connected
+        self.connections.add(connection)
+        logger.info(f"connection from {connection.peer}")
+        try:
+            await self.handler(connection)
+        except ConnectionClosed:
+            pass
+        except Exception:
+            logger.exception(f"handler for {connection.peer} failed")
+        finally:
+            self.connections.discard(connection)
+            connection.close()
+            logger.info(f"connection from {connection.peer} closed")
+
+    async def serve_forever(self):
+        if not self._servers:
+            await self.start()
+        await asyncio.gather(*(server.serve_forever() for server in self._servers))
+
+    async def close(self):
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+def run_server(handler, host="localhost", ports=(DEFAULT_PORT,)):
+    async def main():
+        await FramedTCPServer(handler, host, ports).serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,214 @@
+import argparse
+import mmap
+import struct
+import sys
+import time
+from collections import namedtuple
+from enum import IntEnum
+
+MAGIC = b"LLTRACE\0"
+VERSION = 1
+# magic, version, reserved, timestamp ticks per second
+FILE_HEADER = struct.Struct("<8sHHd")
+# kind, flags, length, timestamp
+RECORD_HEADER = struct.Struct("<BBHQ")
+MAX_PAYLOAD = 0xFFFF
+
+
+class RecordKind(IntEnum):
+    RX = 1  # host to device, as seen on the UTMI rx_data bus
+    TX = 2  # device to host, on tx_data
+    STATE = 3  # UTMI status change, flags as below
+
+
+# STATE flags: line_state in bits 1:0, then one bit per strobe
+LINE_STATE_MASK = 0x03
+RX_ACTIVE = 0x04
+RX_VALID = 0x08
+TX_VALID = 0x10
+TX_READY = 0x20
+
+
+def state_flags(line_state=0, rx_active=0, rx_valid=0, tx_valid=0, tx_ready=0):
+    return (
+        (line_state & LINE_STATE_MASK)
+        | (RX_ACTIVE if rx_active else 0)
+        | (RX_VALID if rx_valid else 0)
+        | (TX_VALID if tx_valid else 0)
+        | (TX_READY if tx_ready else 0)
+    )
+
+
+TraceRecord = namedtuple("TraceRecord", "kind flags timestamp data")
+
+
+class TraceWriter:
+    """Appends records to a compact binary UTMI trace.
+
+    The file is a 20-byte header followed by 12-byte record headers, each followed by its
+    payload; timestamps are in ``timebase`` ticks per second (USB clock cycles for the Amaranth
+    bench, nanoseconds for framed-TCP links). Reopening an existing trace appends to it.
+    """
+
+    def __init__(self, path, timebase=1e9, buffering=1 << 20):
+        self.file = open(path, "ab", buffering=buffering)
+        if self.file.tell() == 0:
+            self.file.write(FILE_HEADER.pack(MAGIC, VERSION, 0, timebase))
+            self.timebase = timebase
+        else:
+            with open(path, "rb") as f:
+                self.timebase = _read_header(f.read(FILE_HEADER.size), path)
+        self.records = 0
+
+    def record(self, kind, timestamp, data=b"", flags=0):
+        data = memoryview(data)
+        if len(data) > MAX_PAYLOAD:
+            raise ValueError(f"{len(data)} byte record does not fit a trace record")
+        self.file.write(RECORD_HEADER.pack(kind, flags, len(data), timestamp))
+        if data:
+            self.file.write(data)
+        self.records += 1
+
+    def rx(self, timestamp, data):
+        self.record(RecordKind.RX, timestamp, data)
+
+    def tx(self, timestamp, data):
+        self.record(RecordKind.TX, timestamp, data)
+
+    def state(self, timestamp, **signals):
+        self.record(RecordKind.STATE, timestamp, flags=state_flags(**signals))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _read_header(header, path):
+    if len(header) < FILE_HEADER.size:
+        raise ValueError(f"{path}: truncated trace header")
+    magic, version, _, timebase = FILE_HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError(f"{path}: not a liteluna trace")
+    if version != VERSION:
+        raise ValueError(f"{path}: unsupported trace version {version}")
+    return timebase
+
+
+class TraceReader:
+    """Memory-maps a trace and yields its records lazily.
+
+    Record payloads are ``memoryview`` slices of the mapping, so nothing is copied or parsed
+    ahead of the iterator; the mapping is unmapped once they are released. A record cut short
+    by a writer that died mid-write ends the iteration.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.timebase = _read_header(f.read(FILE_HEADER.size), path)
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+    def __iter__(self):
+        view = self._view
+        offset = FILE_HEADER.size
+        end = len(view)
+        while offset + RECORD_HEADER.size <= end:
+            kind, flags, length, timestamp = RECORD_HEADER.unpack_from(view, offset)
+            offset += RECORD_HEADER.size
+            if offset + length > end:
+                return
+            yield TraceRecord(kind, flags, timestamp, view[offset : offset + length])
+            offset += length
+
+    def packets(self):
+        for record in self:
+            if record.kind in (RecordKind.RX, RecordKind.TX):
+                yield record
+
+    def seconds(self, timestamp):
+        return timestamp / self.timebase
+
+    def close(self):
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # payload views still alive keep the mapping until they are collected
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RecordingLink:
+    """Wraps a ``USBHost`` link (``write(frames)``/``async read()``) and records every packet.
+
+    ``recorder`` needs ``rx(timestamp, data)`` and ``tx(timestamp, data)``, like ``TraceWriter``;
+    ``clock`` returns the timestamp and defaults to nanoseconds since the link was created.
+    """
+
+    def __init__(self, link, recorder, clock=None):
+        self.link = link
+        self.recorder = recorder
+        if clock is None:
+            t0 = time.perf_counter_ns()
+
+            def clock():
+                return time.perf_counter_ns() - t0
+
+        self.clock = clock
+
+    def write(self, frames):
+        frames = list(frames)
+        timestamp = self.clock()
+        for frame in frames:
+            self.recorder.rx(timestamp, frame)
+        self.link.write(frames)
+
+    async def read(self):
+        frame = await self.link.read()
+        self.recorder.tx(self.clock(), frame)
+        return frame
+
+    def __getattr__(self, name):
+        # drain(), close() etc. go straight to the wrapped link
+        return getattr(self.link, name)
+
+
+# Dump ---------------------------------------------------------------------------------------------
+
+
+def dump(path, out=sys.stdout, with_state=False):
+    with TraceReader(path) as reader:
+        for kind, flags, timestamp, data in reader:
+            if kind == RecordKind.RX:
+                print(f"h2d_raw: {data.hex(' ')}", file=out)
+            elif kind == RecordKind.TX:
+                print(f"d2h_raw: {data.hex(' ')}", file=out)
+            elif with_state:
+                print(f"# t={reader.seconds(timestamp):.9f} state {flags:#04x}", file=out)
+            data.release()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print a liteluna trace in replay log format")
+    parser.add_argument("trace", help="Trace file")
+    parser.add_argument("--state", action="store_true", help="Include UTMI state changes")
+    args = parser.parse_args()
+    dump(args.trace, with_state=args.state)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,414 @@
+import struct
+from enum import IntEnum
+
+DEFAULT_ADDRESS = 0x2B
+
+
+class PID(IntEnum):
+    OUT = 0xE1
+    IN = 0x69
+    SOF = 0xA5
+    SETUP = 0x2D
+    DATA0 = 0xC3
+    DATA1 = 0x4B
+    DATA2 = 0x87
+    MDATA = 0x0F
+    ACK = 0xD2
+    NAK = 0x5A
+    STALL = 0x1E
+    NYET = 0x96
+    PING = 0xB4
+
+
+DATA_PIDS = (PID.DATA0, PID.DATA1, PID.DATA2, PID.MDATA)
+
+
+class Request(IntEnum):
+    GET_STATUS = 0
+    CLEAR_FEATURE = 1
+    SET_FEATURE = 3
+    SET_ADDRESS = 5
+    GET_DESCRIPTOR = 6
+    SET_DESCRIPTOR = 7
+    GET_CONFIGURATION = 8
+    SET_CONFIGURATION = 9
+    GET_INTERFACE = 10
+    SET_INTERFACE = 11
+
+
+class DescriptorType(IntEnum):
+    DEVICE = 1
+    CONFIGURATION = 2
+    STRING = 3
+    INTERFACE = 4
+    ENDPOINT = 5
+
+
+class USBHostError(IOError):
+    pass
+
+
+class StallError(USBHostError):
+    pass
+
+
+class NakLimitError(USBHostError):
+    pass
+
+
+# Packets ------------------------------------------------------------------------------------------
+
+
+def crc5(value, nbits=11):
+    crc = 0x1F
+    for i in range(nbits):
+        if (crc ^ (value >> i)) & 1:
+            crc = (crc >> 1) ^ 0x14
+        else:
+            crc >>= 1
+    return crc ^ 0x1F
+
+
+def _crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC16_TABLE = _crc16_table()
+
+
+def crc16(data):
+    crc = 0xFFFF
+    for byte in data:
+        crc = (crc >> 8) ^ _CRC16_TABLE[(crc ^ byte) & 0xFF]
+    return crc ^ 0xFFFF
+
+
+def token_packet(pid, address, endpoint):
+    value = (address & 0x7F) | ((endpoint & 0xF) << 7)
+    return struct.pack("<BH", pid, value | (crc5(value) << 11))
+
+
+def sof_packet(frame_number):
+    value = frame_number & 0x7FF
+    return struct.pack("<BH", PID.SOF, value | (crc5(value) << 11))
+
+
+def data_packet(pid, payload=b""):
+    return bytes([pid]) + bytes(payload) + struct.pack("<H", crc16(payload))
+
+
+def handshake_packet(pid):
+    return bytes([pid])
+
+
+def setup_packet(request_type, request, value, index, length):
+    return struct.pack("<BBHHH", request_type, request, value, index, length)
+
+
+def parse_packet(packet):
+    """Returns ``(pid, payload)``; data packet CRCs are checked and stripped."""
+    if not packet:
+        raise USBHostError("empty packet")
+    pid = packet[0]
+    if (pid >> 4) != (~pid & 0xF):
+        raise USBHostError(f"bad PID byte {pid:#04x}")
+    pid = PID(pid)
+    payload = bytes(packet[1:])
+    if pid in DATA_PIDS:
+        if len(payload) < 2 or crc16(payload[:-2]) != struct.unpack("<H", payload[-2:])[0]:
+            raise USBHostError(f"bad CRC16 in {bytes(packet).hex(' ')}")
+        payload = payload[:-2]
+    return pid, payload
+
+
+# Descriptors --------------------------------------------------------------------------------------
+
+
+def iter_descriptors(data):
+    offset = 0
+    while offset + 2 <= len(data):
+        length = data[offset]
+        if length < 2:
+            break
+        yield data[offset + 1], data[offset : offset + length]
+        offset += length
+
+
+class Endpoint:
+    def __init__(self, descriptor):
+        self.address = descriptor[2]
+        self.attributes = descriptor[3]
+        w_max_packet_size = struct.unpack_from("<H", descriptor, 4)[0]
+        self.max_packet_size = w_max_packet_size & 0x7FF
+        self.packets_per_microframe = ((w_max_packet_size >> 11) & 3) + 1
+        self.interval = descriptor[6]
+
+    @property
+    def number(self):
+        return self.address & 0xF
+
+    @property
+    def is_in(self):
+        return bool(self.address & 0x80)
+
+    @property
+    def transfer_type(self):
+        return ("control", "isochronous", "bulk", "interrupt")[self.attributes & 3]
+
+    def __repr__(self):
+        return (
+            f"Endpoint({self.address:#04x}, {self.transfer_type}, "
+            f"max_packet_size={self.max_packet_size})"
+        )
+
+
+# Host ---------------------------------------------------------------------------------------------
+
+
+class USBHost:
+    """Host controller model driving a simulated device over a framed-TCP link.
+
+    ``link`` needs ``write(frames)`` and ``async read()`` (see ``FramedConnection``); each frame is
+    one USB packet, PID first. Handshakes that need no reply (the ACK after IN data) are queued
+    and go out in the same write as the next token, so a stream of transactions costs one write
+    and one read per packet.
+    """
+
+    def __init__(self, link, address=DEFAULT_ADDRESS, with_sof=True, max_naks=None, trace=None):
+        self.link = link
+        self.target_address = address
+        self.with_sof = with_sof
+        self.max_naks = max_naks
+        self.trace = trace
+        self.address = 0
+        self.frame_number = 0
+        self.ep0_max_packet_size = 64
+        self.device_descriptor = None
+        self.configuration_descriptor = None
+        self.strings = {}
+        self.endpoints = {}
+        self._toggles = {}
+        self._queued = []
+
+    # link
+
+    def _queue(self, *packets):
+        self._queued.extend(packets)
+
+    def _flush(self):
+        if self._queued:
+            if self.trace is not None:
+                for packet in self._queued:
+                    print(f"h2d_raw: {bytes(packet).hex(' ')}", file=self.trace)
+            self.link.write(self._queued)
+            self._queued = []
+
+    async def _receive(self):
+        self._flush()
+        while True:
+            packet = await self.link.read()
+            # long all-zero frames are line idle filler from the PHY model
+            if len(packet) > 64 and not any(packet):
+                continue
+            if self.trace is not None:
+                print(f"d2h_raw: {bytes(packet).hex(' ')}", file=self.trace)
+            return parse_packet(packet)
+
+    async def flush(self):
+        self._flush()
+        drain = getattr(self.link, "drain", None)
+        if drain is not None:
+            await drain()
+
+    def sof(self):
+        self._queue(sof_packet(self.frame_number))
+        self.frame_number = (self.frame_number + 1) & 0x7FF
+
+    def _start(self):
+        if self.with_sof:
+            self.sof()
+
+    # data toggles
+
+    def _toggle(self, endpoint, is_in):
+        return self._toggles.get((self.address, endpoint, is_in), 0)
+
+    def _set_toggle(self, endpoint, is_in, value):
+        self._toggles[(self.address, endpoint, is_in)] = value
+
+    def reset_toggles(self):
+        # after SET_CONFIGURATION/SET_INTERFACE every non-control endpoint restarts at DATA0
+        for key in list(self._toggles):
+            if key[0] == self.address and key[1] != 0:
+                del self._toggles[key]
+
+    # transactions
+
+    def _check_handshake(self, pid, endpoint):
+        if pid == PID.STALL:
+            raise StallError(f"endpoint {endpoint} stalled")
+        if pid not in (PID.ACK, PID.NAK, PID.NYET):
+            raise USBHostError(f"unexpected {pid.name} from endpoint {endpoint}")
+
+    async def setup_transaction(self, setup):
+        self._queue(token_packet(PID.SETUP, self.address, 0), data_packet(PID.DATA0, setup))
+        pid, _ = await self._receive()
+        if pid != PID.ACK:
+            raise USBHostError(f"SETUP answered with {pid.name}")
+        self._set_toggle(0, True, 1)
+        self._set_toggle(0, False, 1)
+
+    async def out_transaction(self, endpoint, data, max_naks=None):
+        """Sends one data packet; returns False if the device NAKed it ``max_naks`` times."""
+        max_naks = self.max_naks if max_naks is None else max_naks
+        naks = 0
+        while True:
+            toggle = self._toggle(endpoint, False)
+            data_pid = PID.DATA1 if toggle else PID.DATA0
+            self._queue(token_packet(PID.OUT, self.address, endpoint), data_packet(data_pid, data))
+            pid, _ = await self._receive()
+            self._check_handshake(pid, endpoint)
+            if pid != PID.NAK:
+                self._set_toggle(endpoint, False, toggle ^ 1)
+                return True
+            naks += 1
+            if max_naks is not None and naks >= max_naks:
+                return False
+
+    async def in_transaction(self, endpoint, max_naks=None):
+        """Receives one data packet; returns None if the device NAKed ``max_naks`` times."""
+        max_naks = self.max_naks if max_naks is None else max_naks
+        naks = 0
+        while True:
+            self._queue(token_packet(PID.IN, self.address, endpoint))
+            pid, payload = await self._receive()
+            if pid in DATA_PIDS:
+                self._queue(handshake_packet(PID.ACK))
+                toggle = self._toggle(endpoint, True)
+                if pid == (PID.DATA1 if toggle else PID.DATA0):
+                    self._set_toggle(endpoint, True, toggle ^ 1)
+                    return payload
+                # our ACK was lost and the device retransmitted
+                continue
+            self._check_handshake(pid, endpoint)
+            naks += 1
+            if max_naks is not None and naks >= max_naks:
+                return None
+
+    # transfers
+
+    @staticmethod
+    def _nak_limit(result, endpoint):
+        if result is None or result is False:
+            raise NakLimitError(f"endpoint {endpoint} kept NAKing")
+        return result
+
+    async def control_transfer(self, request_type, request, value=0, index=0, data=None):
+        """``data`` is the wLength to read for IN requests, or the bytes to send for OUT."""
+        is_in = bool(request_type & 0x80)
+        if is_in:
+            length = data or 0
+        else:
+            data = bytes(data or b"")
+            length = len(data)
+        self._start()
+        await self.setup_transaction(setup_packet(request_type, request, value, index, length))
+        mps = self.ep0_max_packet_size
+        result = bytearray()
+        if is_in:
+            while len(result) < length:
+                payload = self._nak_limit(await self.in_transaction(0), 0)
+                result += payload
+                if len(payload) < mps:
+                    break
+            self._nak_limit(await self.out_transaction(0, b""), 0)
+        else:
+            for offset in range(0, length, mps):
+                self._nak_limit(await self.out_transaction(0, data[offset : offset + mps]), 0)
+            if self._nak_limit(await self.in_transaction(0), 0) != b"":
+                raise USBHostError("non-empty status stage")
+        await self.flush()
+        if request == Request.SET_ADDRESS and request_type == 0:
+            self.address = value
+        if (request, request_type) in ((Request.SET_CONFIGURATION, 0), (Request.SET_INTERFACE, 1)):
+            self.reset_toggles()
+        return bytes(result) if is_in else length
+
+    async def bulk_out(self, endpoint, data, zlp=False):
+        mps = self.max_packet_size(endpoint, False)
+        data = memoryview(data).cast("B")
+        self._start()
+        for offset in range(0, len(data), mps):
+            self._nak_limit(
+                await self.out_transaction(endpoint, data[offset : offset + mps]), endpoint
+            )
+        if zlp and (not data or len(data) % mps == 0):
+            self._nak_limit(await self.out_transaction(endpoint, b""), endpoint)
+        await self.flush()
+        return len(data)
+
+    async def bulk_in(self, endpoint, length, max_naks=None):
+        """Reads until ``length`` bytes or a short packet; stops early after ``max_naks`` NAKs."""
+        mps = self.max_packet_size(endpoint, True)
+        result = bytearray()
+        self._start()
+        while len(result) < length:
+            payload = await self.in_transaction(endpoint, max_naks)
+            if payload is None:
+                break
+            result += payload
+            if len(payload) < mps:
+                break
+        await self.flush()
+        return bytes(result)
+
+    def max_packet_size(self, endpoint, is_in):
+        ep = self.endpoints.get(endpoint | (0x80 if is_in else 0))
+        return 512 if ep is None else ep.max_packet_size
+
+    # enumeration
+
+    async def get_descriptor(self, descriptor_type, index=0, length=0xFF, language=0):
+        return await self.control_transfer(
+            0x80, Request.GET_DESCRIPTOR, (descriptor_type << 8) | index, language, length
+        )
+
+    async def get_string(self, index, language=0x0409):
+        data = await self.get_descriptor(DescriptorType.STRING, index, 0xFF, language)
+        return data[2 : data[0]].decode("utf-16-le")
+
+    async def enumerate(self, configuration=1, with_strings=True):
+        self.address = 0
+        self.device_descriptor = await self.get_descriptor(DescriptorType.DEVICE, length=8)
+        self.ep0_max_packet_size = self.device_descriptor[7]
+        await self.control_transfer(0x00, Request.SET_ADDRESS, self.target_address)
+        self.device_descriptor = await self.get_descriptor(DescriptorType.DEVICE, length=18)
+        header = await self.get_descriptor(DescriptorType.CONFIGURATION, length=9)
+        total_length = struct.unpack_from("<H", header, 2)[0]
+        self.configuration_descriptor = await self.get_descriptor(
+            DescriptorType.CONFIGURATION, length=total_length
+        )
+        self.endpoints = {}
+        for descriptor_type, descriptor in iter_descriptors(self.configuration_descriptor):
+            if descriptor_type == DescriptorType.ENDPOINT:
+                ep = Endpoint(descriptor)
+                self.endpoints[ep.address] = ep
+        if with_strings:
+            languages = await self.get_descriptor(DescriptorType.STRING, 0)
+            language = struct.unpack_from("<H", languages, 2)[0] if len(languages) >= 4 else 0
+            for index in self.device_descriptor[14:17]:
+                if index:
+                    self.strings[index] = await self.get_string(index, language)
+        await self.control_transfer(0x00, Request.SET_CONFIGURATION, configuration)
+
+    async def set_interface(self, interface, alt_setting):
+        await self.control_transfer(0x01, Request.SET_INTERFACE, alt_setting, interface)
+
+    async def get_interface(self, interface):
+        return (await self.control_transfer(0x81, Request.GET_INTERFACE, 0, interface, 1))[0]
@@ -0,0 +1,82 @@
+from litex.soc.interconnect.csr import CSR, AutoCSR, CSRStatus
+from migen import *
+from migen.genlib.cdc import GrayCounter, GrayDecoder, MultiReg, PulseSynchronizer
+
+from liteluna.luna_cores.bulk_streamer import STATS_EVENTS
+
+
+class StreamLevelMonitor(Module):
+    """Occupancy of a stream crossing from ``cd_write`` to ``cd_read``, in ``cd_write``.
+
+    Elements written are counted against a Gray-coded copy of the read count, so the level can
+    only overestimate what the FIFO holds.
+    """
+
+    def __init__(self, sink, source, cd_write, cd_read, width=16):
+        self.level = Signal(width)
+
+        written = Signal(width)
+        read_sync = Signal(width)
+        self.submodules.read_count = read_count = ClockDomainsRenamer(cd_read)(GrayCounter(width))
+        self.submodules.decoder = decoder = GrayDecoder(width)
+        self.specials += MultiReg(read_count.q, read_sync, odomain=cd_write)
+        self.comb += [
+            read_count.ce.eq(source.valid & source.ready),
+            decoder.i.eq(read_sync),
+            self.level.eq(written - decoder.o),
+        ]
+        sync = getattr(self.sync, cd_write)
+        sync += If(sink.valid & sink.ready, written.eq(written + 1))
+
+
+class USBStreamerStats(Module, AutoCSR):
+    """Always-on USB traffic counters and FIFO high-water marks.
+
+    ``events`` are the ``stats_*`` strobes of the LUNA core (see ``STATS_EVENTS``), counted in
+    ``cd_usb``. ``levels`` are ``(name, signal, domain)`` occupancies whose maximum is tracked.
+    Writing ``update`` snapshots every counter and mark into the status registers (they settle a
+    few ``cd_usb`` cycles later, long before a bus master can read them); ``clear`` zeroes them.
+    """
+
+    def __init__(self, events, levels=(), cd="sys", cd_usb="usb", width=32):
+        self._update = CSR()
+        self._clear = CSR()
+
+        update = {cd: self._update.re}
+        clear = {cd: self._clear.re}
+        if cd_usb != cd:
+            for name, pulses in (("update", update), ("clear", clear)):
+                ps = PulseSynchronizer(cd, cd_usb)
+                setattr(self.submodules, f"{name}_ps", ps)
+                self.comb += ps.i.eq(pulses[cd])
+                pulses[cd_usb] = ps.o
+
+        # counters -------------------------------------------------------------------------------
+        sync_usb = getattr(self.sync, cd_usb)
+        for name in STATS_EVENTS:
+            counter = Signal(width)
+            sync_usb += If(clear[cd_usb], counter.eq(0)).Elif(
+                getattr(events, name), counter.eq(counter + 1)
+            )
+            self._add_status(f"{name}s", counter, width, cd, cd_usb, update)
+
+        # high-water marks -----------------------------------------------------------------------
+        for name, level, domain in levels:
+            high_water = Signal(len(level))
+            sync = getattr(self.sync, domain)
+            sync += If(clear[domain], high_water.eq(0)).Elif(
+                level > high_water, high_water.eq(level)
+            )
+            self._add_status(f"{name}_max", high_water, len(level), cd, domain, update)
+
+    def _add_status(self, name, value, width, cd, domain, update):
+        # the snapshot only changes on update, so it can cross into cd through a MultiReg
+        status = CSRStatus(width, name=name)
+        setattr(self, f"_{name}", status)
+        snapshot = Signal(width)
+        sync = getattr(self.sync, domain)
+        sync += If(update[domain], snapshot.eq(value))
+        if domain != cd:
+            self.specials += MultiReg(snapshot, status.status, odomain=cd)
+        else:
+            self.comb += status.status.eq(snapshot)
@@ -2,17 +2,245 @@ import os
 
 from litex.soc.cores.clock.common import ClockFrequency
 from litex.soc.interconnect import stream
+from litex.soc.interconnect.csr import AutoCSR
 from migen import *
+from migen.genlib.cdc import PulseSynchronizer
+from migen.genlib.misc import WaitTimer
 from migen.genlib.record import DIR_M_TO_S, DIR_S_TO_M, Record
 
 from liteluna.device import USBDeviceLAInterface
 from liteluna.luna_cores import bulk_streamer
 from liteluna.packet import InterpacketTimerInterface, TokenDetectorInterface
+from liteluna.stats import StreamLevelMonitor, USBStreamerStats
 from liteluna.ulpi import ULPIInterface, ULPIPHYInterface
 from liteluna.utmi import UTMIInterface
 
 
-class USBStreamer(Module):
+def stream_layout(data_width):
+    if data_width == 8:
+        return [("data", 8)]
+    return [("data", data_width), ("be", data_width // 8)]
+
+
+class StreamBytePacker(Module):
+    """Packs a byte stream into words, first byte in the least significant lane.
+
+    A word is emitted once all lanes are filled or on ``last``; ``be`` marks the valid lanes.
+    """
+
+    def __init__(self, data_width):
+        assert data_width % 8 == 0 and data_width > 8
+        ratio = data_width // 8
+        self.sink = sink = stream.Endpoint([("data", 8)])
+        self.source = source = stream.Endpoint(stream_layout(data_width))
+
+        lane = Signal(max=ratio)
+        lane_cases = {}
+        for i in range(ratio):
+            lane_cases[i] = [source.data[8 * i : 8 * (i + 1)].eq(sink.data)]
+            if i == 0:
+                lane_cases[i] += [source.be.eq(1), source.first.eq(sink.first)]
+            else:
+                lane_cases[i] += [source.be[i].eq(1)]
+
+        self.comb += sink.ready.eq(~source.valid | source.ready)
+        self.sync += [
+            If(source.valid & source.ready, source.valid.eq(0)),
+            If(
+                sink.valid & sink.ready,
+                Case(lane, lane_cases),
+                source.last.eq(sink.last),
+                If(
+                    sink.last | (lane == ratio - 1),
+                    lane.eq(0),
+                    source.valid.eq(1),
+                ).Else(lane.eq(lane + 1)),
+            ),
+        ]
+
+
+class StreamByteUnpacker(Module):
+    """Splits words back into a byte stream, skipping lanes whose ``be`` bit is clear."""
+
+    def __init__(self, data_width):
+        assert data_width % 8 == 0 and data_width > 8
+        ratio = data_width // 8
+        self.sink = sink = stream.Endpoint(stream_layout(data_width))
+        self.source = source = stream.Endpoint([("data", 8)])
+
+        lane = Signal(max=ratio)
+        be_remaining = Signal(ratio)
+        lane_valid = Signal()
+        last_lane = Signal()
+        lanes = Array(sink.data[8 * i : 8 * (i + 1)] for i in range(ratio))
+        self.comb += [
+            be_remaining.eq(sink.be >> lane),
+            lane_valid.eq(be_remaining[0]),
+            last_lane.eq(be_remaining[1:] == 0),
+            source.valid.eq(sink.valid & lane_valid),
+            source.data.eq(lanes[lane]),
+            source.first.eq(sink.first & (lane == 0)),
+            source.last.eq(sink.last & last_lane),
+            sink.ready.eq(last_lane & (source.ready | ~lane_valid)),
+        ]
+        self.sync += If(
+            sink.valid & (source.ready | ~lane_valid),
+            If(last_lane, lane.eq(0)).Else(lane.eq(lane + 1)),
+        )
+
+
+class StreamFlusher(Module):
+    """Holds back the newest element so that ``last`` can still be forced onto it.
+
+    The held element is released when the next one arrives, when it already carries ``last`` or
+    when ``release`` is asserted. ``flush``, or ``timeout`` idle cycles, release it with ``last``.
+    """
+
+    def __init__(self, layout, timeout=None):
+        self.sink = sink = stream.Endpoint(layout)
+        self.source = source = stream.Endpoint(layout)
+        self.flush = Signal()
+        self.release = Signal()
+        self.pending = Signal()
+
+        held = stream.Endpoint(layout)
+        do_flush = Signal()
+        if timeout is not None:
+            self.submodules.timer = timer = WaitTimer(timeout)
+            self.comb += [
+                timer.wait.eq(held.valid & ~sink.valid),
+                do_flush.eq(self.flush | timer.done),
+            ]
+        else:
+            self.comb += do_flush.eq(self.flush)
+
+        self.comb += [
+            self.pending.eq(held.valid),
+            source.valid.eq(held.valid & (sink.valid | held.last | self.release | do_flush)),
+            source.payload.eq(held.payload),
+            source.first.eq(held.first),
+            source.last.eq(held.last | do_flush),
+            sink.ready.eq(~held.valid | (source.valid & source.ready)),
+        ]
+        self.sync += [
+            If(source.valid & source.ready, held.valid.eq(0)),
+            If(
+                sink.valid & sink.ready,
+                held.valid.eq(1),
+                held.payload.eq(sink.payload),
+                held.first.eq(sink.first),
+                held.last.eq(sink.last),
+            ),
+        ]
+
+
+class StreamPacketBuffer(Module):
+    """Store-and-forward FIFO that only releases complete USB packets.
+
+    A packet is complete after ``max_packet_size`` elements, on ``last``, or when ``flush`` (or
+    ``timeout`` idle cycles) closes it. ``level`` counts buffered elements, ``packets`` complete
+    packets waiting to be read.
+    """
+
+    def __init__(self, layout, max_packet_size=512, depth=2, timeout=None):
+        self.sink = sink = stream.Endpoint(layout)
+        self.source = source = stream.Endpoint(layout)
+        self.flush = Signal()
+
+        fifo_depth = max_packet_size * depth
+        self.level = Signal(max=fifo_depth + 2)
+        self.packets = Signal(max=fifo_depth + 1)
+
+        self.submodules.flusher = flusher = StreamFlusher(layout, timeout=timeout)
+        self.submodules.fifo = fifo = stream.SyncFIFO(layout, fifo_depth, buffered=True)
+
+        # both sides count elements into the current packet so they agree on its boundaries
+        wr_count = Signal(max=max_packet_size)
+        rd_count = Signal(max=max_packet_size)
+        wr_eop = Signal()
+        rd_eop = Signal()
+        self.comb += [
+            sink.connect(flusher.sink),
+            flusher.flush.eq(self.flush),
+            flusher.release.eq(wr_count == max_packet_size - 1),
+            flusher.source.connect(fifo.sink),
+            wr_eop.eq(
+                fifo.sink.valid
+                & fifo.sink.ready
+                & (fifo.sink.last | (wr_count == max_packet_size - 1))
+            ),
+            rd_eop.eq(
+                fifo.source.valid
+                & fifo.source.ready
+                & (fifo.source.last | (rd_count == max_packet_size - 1))
+            ),
+            fifo.source.connect(source, omit={"valid", "ready"}),
+            source.valid.eq(fifo.source.valid & (self.packets != 0)),
+            fifo.source.ready.eq(source.ready & (self.packets != 0)),
+            self.level.eq(fifo.level + flusher.pending),
+        ]
+        self.sync += [
+            If(
+                fifo.sink.valid & fifo.sink.ready,
+                If(wr_eop, wr_count.eq(0)).Else(wr_count.eq(wr_count + 1)),
+            ),
+            If(
+                fifo.source.valid & fifo.source.ready,
+                If(rd_eop, rd_count.eq(0)).Else(rd_count.eq(rd_count + 1)),
+            ),
+            If(wr_eop & ~rd_eop, self.packets.eq(self.packets + 1)).Elif(
+                ~wr_eop & rd_eop, self.packets.eq(self.packets - 1)
+            ),
+        ]
+
+
+class StreamTransferFramer(Module):
+    """Decides which ``last`` flags reach a LUNA bulk IN endpoint, which ends the packet on
+    ``last`` and follows a full packet ending in ``last`` with a ZLP. Sizes count elements.
+
+    ``last`` on a full packet is dropped unless ``zlp``, so the transfer simply continues.
+    ``max_transfer_length`` (a multiple of ``max_packet_size``) is the host's read size: a read
+    completes once it is full, so ``last`` on its final packet is always dropped, and the host
+    never sees a stray ZLP. ``timeout`` idle cycles end a packet left partial, through a
+    ``StreamFlusher``.
+    """
+
+    def __init__(
+        self, layout, max_packet_size=512, max_transfer_length=None, zlp=True, timeout=None
+    ):
+        self.sink = sink = stream.Endpoint(layout)
+        self.source = source = stream.Endpoint(layout)
+
+        if timeout is not None:
+            self.submodules.flusher = flusher = StreamFlusher(layout, timeout=timeout)
+            self.comb += sink.connect(flusher.sink)
+            sink = flusher.source
+
+        count = Signal(max=max_packet_size)
+        packet_end = Signal()
+        transfer_end = Signal()
+        self.comb += [
+            sink.connect(source, omit={"last"}),
+            packet_end.eq(count == max_packet_size - 1),
+            source.last.eq(sink.last & (~packet_end | (zlp & ~transfer_end))),
+        ]
+        if max_transfer_length is not None:
+            assert max_transfer_length % max_packet_size == 0
+            packets = Signal(max=max_transfer_length // max_packet_size)
+            self.comb += transfer_end.eq(
+                packet_end & (packets == max_transfer_length // max_packet_size - 1)
+            )
+            self.sync += If(
+                source.valid & source.ready & packet_end,
+                If(source.last | transfer_end, packets.eq(0)).Else(packets.eq(packets + 1)),
+            ).Elif(source.valid & source.ready & source.last, packets.eq(0))
+        self.sync += If(
+            source.valid & source.ready,
+            If(source.last | packet_end, count.eq(0)).Else(count.eq(count + 1)),
+        )
+
+
+class USBStreamer(Module, AutoCSR):
     def __init__(
         self,
         platform,
@@ -20,14 +248,36 @@ class USBStreamer(Module):
         cd="sys",
         cd_usb="usb",
         cdc_fifo_depth=None,
+        data_width=8,
+        num_endpoints=1,
+        packet_fifo=False,
+        packet_fifo_depth=2,
+        packet_fifo_timeout=None,
+        zlp=True,
+        max_transfer_length=None,
+        flush_timeout=None,
+        iso_in=False,
+        iso_packets_per_microframe=3,
         with_blinky=False,
         with_utmi_la=False,
+        with_stats=False,
+        sim_time_scale=1,
+        verilog_cache_dir=None,
+        force_verilog_regen=False,
     ):
         self.platform = platform
         self.with_utmi = with_utmi = hasattr(pads, "rx_data")
         self.with_blinky = with_blinky
         self.with_utmi_la = with_utmi_la
+        self.with_stats = with_stats
+        # LUNA derives its reset/chirp/suspend timers from data_clock; claiming a slower clock
+        # shrinks them to match a time-scaled SimUTMIStreamFixup
+        self.sim_time_scale = sim_time_scale
         self.data_clock = ClockFrequency(cd_usb)
+        if sim_time_scale != 1:
+            self.data_clock = self.data_clock * (1 / sim_time_scale)
+        self.verilog_cache_dir = verilog_cache_dir
+        self.force_verilog_regen = force_verilog_regen
 
         self.inverted_reset = None
         if not set(["rst", "reset"]).isdisjoint(set(dir(pads))):
@@ -65,27 +315,43 @@ class USBStreamer(Module):
                 else:
                     self.comb += getattr(pads, name).eq(getattr(utmi, name))
 
-        self.sink_usb = s2d_usb = stream.Endpoint([("data", 8)])
-        self.source_usb = s2h_usb = stream.Endpoint([("data", 8)])
-        self.sink = stream.Endpoint([("data", 8)])
-        self.source = stream.Endpoint([("data", 8)])
-        if cd != cd_usb:
-            # host to fpga
-            self.submodules.sink_cdc = stream.ClockDomainCrossing(
-                self.sink_usb.payload.layout, cd_from=cd_usb, cd_to=cd, depth=cdc_fifo_depth
-            )
-            self.submodules.sink_pipeline = stream.Pipeline(self.sink_usb, self.sink_cdc, self.sink)
-
-            # fpga to host
-            self.submodules.source_cdc = stream.ClockDomainCrossing(
-                self.source_usb.payload.layout, cd_from=cd, cd_to=cd_usb, depth=cdc_fifo_depth
-            )
-            self.submodules.source_pipeline = stream.Pipeline(
-                self.source, self.source_cdc, self.source_usb
-            )
-        else:
-            self.sink = self.sink_usb
-            self.source = self.source_usb
+        self.data_width = data_width
+        self.num_endpoints = num_endpoints
+        self.zlp = zlp
+        self.max_transfer_length = max_transfer_length
+        self.iso_in = iso_in
+        self.iso_packets_per_microframe = iso_packets_per_microframe
+        self.sinks_usb = []
+        self.sources_usb = []
+        self.sinks = []
+        self.sources = []
+        self.source_packet_buffers = []
+        self.source_flushes = []
+        self.sink_cdcs = []
+        self.source_cdcs = []
+        for i in range(num_endpoints):
+            self.add_stream_pair(i, cd, cd_usb, cdc_fifo_depth)
+            # the isochronous adapter already buffers whole microframes
+            if packet_fifo and not (iso_in and i == 0):
+                self.add_source_packet_buffer(
+                    i, cd, cd_usb, depth=packet_fifo_depth, timeout=packet_fifo_timeout
+                )
+            framed = not zlp or max_transfer_length is not None or flush_timeout is not None
+            if framed and not (iso_in and i == 0):
+                self.add_source_framer(
+                    i,
+                    cd_usb,
+                    max_transfer_length=max_transfer_length,
+                    zlp=zlp,
+                    timeout=flush_timeout,
+                )
+        self.sink_usb, self.source_usb = self.sinks_usb[0], self.sources_usb[0]
+        self.sink, self.source = self.sinks[0], self.sources[0]
+        if packet_fifo and not iso_in:
+            # occupancy of the first pair, in the usb domain
+            self.source_flush = self.source_flushes[0]
+            self.source_level = self.source_packet_buffers[0].level
+            self.source_packets = self.source_packet_buffers[0].packets
 
         self.connect = Signal()
         self.reset_detected = Signal()
@@ -103,17 +369,24 @@ class USBStreamer(Module):
             "o_current_speed": self.current_speed,
             "o_operating_mode": self.operating_mode,
             "o_termination_select": self.termination_select,
-            "o_stream_out_payload": s2d_usb.payload.data,
-            "o_stream_out_valid": s2d_usb.valid,
-            "i_stream_out_ready": s2d_usb.ready,
-            "o_stream_out_first": s2d_usb.first,
-            "o_stream_out_last": s2d_usb.last,
-            "i_stream_in_payload": s2h_usb.payload.data,
-            "i_stream_in_valid": s2h_usb.valid,
-            "o_stream_in_ready": s2h_usb.ready,
-            "i_stream_in_first": s2h_usb.first,
-            "i_stream_in_last": s2h_usb.last,
         }
+        for i, (s2d_usb, s2h_usb) in enumerate(zip(self.sinks_usb, self.sources_usb)):
+            out_prefix = bulk_streamer.stream_port_prefix("out", i)
+            in_prefix = bulk_streamer.stream_port_prefix("in", i)
+            port_map.update(
+                {
+                    f"o_{out_prefix}_payload": s2d_usb.payload.data,
+                    f"o_{out_prefix}_valid": s2d_usb.valid,
+                    f"i_{out_prefix}_ready": s2d_usb.ready,
+                    f"o_{out_prefix}_first": s2d_usb.first,
+                    f"o_{out_prefix}_last": s2d_usb.last,
+                    f"i_{in_prefix}_payload": s2h_usb.payload.data,
+                    f"i_{in_prefix}_valid": s2h_usb.valid,
+                    f"o_{in_prefix}_ready": s2h_usb.ready,
+                    f"i_{in_prefix}_first": s2h_usb.first,
+                    f"i_{in_prefix}_last": s2h_usb.last,
+                }
+            )
 
         if not with_utmi:
             ulpi_map = {
@@ -174,8 +447,123 @@ class USBStreamer(Module):
             for name, _, _ in self.rxtmr_la.layout:
                 port_map[f"o_rxtmr_la_{name}"] = getattr(self.rxtmr_la, name)
 
+        if with_stats:
+            self.stats_events = Record([(name, 1) for name in bulk_streamer.STATS_EVENTS])
+            for name in bulk_streamer.STATS_EVENTS:
+                port_map[f"o_stats_{name}"] = getattr(self.stats_events, name)
+            self.add_stats(cd, cd_usb)
+
         self.specials += Instance("bulk_streamer", **port_map)
 
+    def add_stats(self, cd, cd_usb):
+        levels = []
+        for i, (sink_cdc, source_cdc) in enumerate(zip(self.sink_cdcs, self.source_cdcs)):
+            suffix = "" if i == 0 else str(i)
+            sink_level = StreamLevelMonitor(sink_cdc.sink, sink_cdc.source, cd_usb, cd)
+            source_level = StreamLevelMonitor(source_cdc.sink, source_cdc.source, cd, cd_usb)
+            setattr(self.submodules, f"sink_cdc_level{suffix}", sink_level)
+            setattr(self.submodules, f"source_cdc_level{suffix}", source_level)
+            levels.append((f"sink_cdc_level{suffix}", sink_level.level, cd_usb))
+            levels.append((f"source_cdc_level{suffix}", source_level.level, cd))
+        for i, packet_buffer in enumerate(self.source_packet_buffers):
+            suffix = "" if i == 0 else str(i)
+            levels.append((f"source_packet_buffer_level{suffix}", packet_buffer.level, cd_usb))
+        self.submodules.stats = USBStreamerStats(self.stats_events, levels, cd=cd, cd_usb=cd_usb)
+
+    def add_stream_pair(self, index, cd, cd_usb, cdc_fifo_depth):
+        data_width = self.data_width
+        layout = stream_layout(data_width)
+        suffix = "" if index == 0 else str(index)
+        sink_usb = stream.Endpoint([("data", 8)])
+        source_usb = stream.Endpoint([("data", 8)])
+        sink = stream.Endpoint(layout)
+        source = stream.Endpoint(layout)
+
+        # host to fpga
+        sink_path = [sink_usb]
+        # fpga to host
+        source_path = [source]
+        if data_width != 8:
+            # pack in the usb domain so the cdc moves whole words
+            packer = ClockDomainsRenamer(cd_usb)(StreamBytePacker(data_width))
+            setattr(self.submodules, f"sink_packer{suffix}", packer)
+            sink_path.append(packer)
+        if cd != cd_usb:
+            sink_cdc = stream.ClockDomainCrossing(
+                layout, cd_from=cd_usb, cd_to=cd, depth=cdc_fifo_depth
+            )
+            setattr(self.submodules, f"sink_cdc{suffix}", sink_cdc)
+            sink_path.append(sink_cdc)
+            source_cdc = stream.ClockDomainCrossing(
+                layout, cd_from=cd, cd_to=cd_usb, depth=cdc_fifo_depth
+            )
+            setattr(self.submodules, f"source_cdc{suffix}", source_cdc)
+            source_path.append(source_cdc)
+            self.sink_cdcs.append(sink_cdc)
+            self.source_cdcs.append(source_cdc)
+        if data_width != 8:
+            unpacker = ClockDomainsRenamer(cd_usb)(StreamByteUnpacker(data_width))
+            setattr(self.submodules, f"source_unpacker{suffix}", unpacker)
+            source_path.append(unpacker)
+        sink_path.append(sink)
+        source_path.append(source_usb)
+        setattr(self.submodules, f"sink_pipeline{suffix}", stream.Pipeline(*sink_path))
+        setattr(self.submodules, f"source_pipeline{suffix}", stream.Pipeline(*source_path))
+
+        self.sinks_usb.append(sink_usb)
+        self.sources_usb.append(source_usb)
+        self.sinks.append(sink)
+        self.sources.append(source)
+
+    def add_source_packet_buffer(self, index, cd, cd_usb, depth=2, timeout=None):
+        # splice a store-and-forward buffer in front of the LUNA IN endpoint
+        suffix = "" if index == 0 else str(index)
+        source_usb = self.sources_usb[index]
+        buffered_usb = stream.Endpoint([("data", 8)])
+        packet_buffer = ClockDomainsRenamer(cd_usb)(
+            StreamPacketBuffer(
+                [("data", 8)],
+                max_packet_size=bulk_streamer.USBBulkStreamerDevice.MAX_BULK_PACKET_SIZE,
+                depth=depth,
+                timeout=timeout,
+            )
+        )
+        setattr(self.submodules, f"source_packet_buffer{suffix}", packet_buffer)
+        self.comb += [
+            source_usb.connect(packet_buffer.sink),
+            packet_buffer.source.connect(buffered_usb),
+        ]
+        self.sources_usb[index] = buffered_usb
+
+        # flush is a pulse in cd
+        flush = Signal()
+        if cd != cd_usb:
+            flush_ps = PulseSynchronizer(cd, cd_usb)
+            setattr(self.submodules, f"source_flush_ps{suffix}", flush_ps)
+            self.comb += [flush_ps.i.eq(flush), packet_buffer.flush.eq(flush_ps.o)]
+        else:
+            self.comb += packet_buffer.flush.eq(flush)
+        self.source_packet_buffers.append(packet_buffer)
+        self.source_flushes.append(flush)
+
+    def add_source_framer(self, index, cd_usb, max_transfer_length=None, zlp=True, timeout=None):
+        # last in front of the LUNA IN endpoint decides where transfers end
+        suffix = "" if index == 0 else str(index)
+        source_usb = self.sources_usb[index]
+        framed_usb = stream.Endpoint([("data", 8)])
+        framer = ClockDomainsRenamer(cd_usb)(
+            StreamTransferFramer(
+                [("data", 8)],
+                max_packet_size=bulk_streamer.USBBulkStreamerDevice.MAX_BULK_PACKET_SIZE,
+                max_transfer_length=max_transfer_length,
+                zlp=zlp,
+                timeout=timeout,
+            )
+        )
+        setattr(self.submodules, f"source_framer{suffix}", framer)
+        self.comb += [source_usb.connect(framer.sink), framer.source.connect(framed_usb)]
+        self.sources_usb[index] = framed_usb
+
     def do_finalize(self):
         super().do_finalize()
         verilog_filename = os.path.join(self.platform.output_dir, "gateware", "luna_usbstreamer.v")
@@ -185,5 +573,11 @@ class USBStreamer(Module):
             with_blinky=self.with_blinky,
             with_utmi_la=self.with_utmi_la,
             data_clock=self.data_clock,
+            num_endpoints=self.num_endpoints,
+            iso_in=self.iso_in,
+            iso_packets_per_microframe=self.iso_packets_per_microframe,
+            with_stats=self.with_stats,
+            cache_dir=self.verilog_cache_dir,
+            force_regen=self.force_verilog_regen,
         )
         self.platform.add_source(verilog_filename)
@@ -1,60 +1,189 @@
 from typing import Union
 
-from litex.soc.cores import uart
-from litex.soc.cores.clock.common import ClockFrequency
+from liteeth.common import (
+    eth_etherbone_mmap_description,
+    eth_etherbone_packet_user_description,
+    etherbone_magic,
+    etherbone_packet_header,
+    etherbone_record_header,
+    etherbone_version,
+)
+from liteeth.frontend.etherbone import (
+    LiteEthEtherbonePacketDepacketizer,
+    LiteEthEtherbonePacketPacketizer,
+    LiteEthEtherboneProbe,
+    LiteEthEtherboneRecord,
+    LiteEthEtherboneWishboneMaster,
+)
+from litex.soc.interconnect import stream
+from litex.soc.interconnect.packet import Arbiter, Dispatcher
 from migen import *
 
-from liteluna.stream import USBStreamer
+from liteluna.luna_cores.bulk_streamer import USBBulkStreamerDevice
+from liteluna.stream import StreamTransferFramer, USBStreamer, stream_layout
 from liteluna.ulpi import ULPIInterface
 from liteluna.utmi import UTMIInterface
 
+USBBONE_DATA_WIDTH = 32
+# words of one record (base address plus data or read addresses) in a full bulk packet
+MAX_RECORD_WORDS = (
+    USBBulkStreamerDevice.MAX_BULK_PACKET_SIZE
+    - etherbone_packet_header.length
+    - etherbone_record_header.length
+) // 4
+
 
 def add_usbbone(
     soc,
     usb: Union[USBStreamer, ULPIInterface, UTMIInterface],
     name="usbbone",
     usb_cd="usb",
-    buffer_depth=16,
+    buffer_depth=256,
     with_blinky=False,
 ):
     soc.check_if_exists(name)
     if type(usb) in (ULPIInterface, UTMIInterface):
         usb_pads = usb
-        usb = USBStreamer(soc.platform, usb_pads, with_blinky=with_blinky)
-    usbbone = uart.UARTBone(phy=usb, clk_freq=ClockFrequency(usb_cd), cd=usb_cd)
-    setattr(soc.submodules, f"{name}_phy", usb)
+        usb = USBStreamer(
+            soc.platform,
+            usb_pads,
+            cd_usb=usb_cd,
+            data_width=USBBONE_DATA_WIDTH,
+            with_blinky=with_blinky,
+        )
+        setattr(soc.submodules, f"{name}_phy", usb)
+        soc.comb += usb.connect.eq(1)
+    elif usb.data_width != USBBONE_DATA_WIDTH:
+        raise ValueError(f"USBbone needs a USBStreamer with data_width={USBBONE_DATA_WIDTH}")
+    usbbone = LiteLUNAUSBbone(usb, buffer_depth=buffer_depth)
     setattr(soc.submodules, name, usbbone)
-    soc.bus.add_master(name=name, master=usbbone.wishbone)
+    soc.bus.add_master(name=name, master=usbbone.wishbone.bus)
+
+
+# USBbone Packet -----------------------------------------------------------------------------------
+
+
+class LiteLUNAUSBbonePacketTX(Module):
+    def __init__(self):
+        self.sink = sink = stream.Endpoint(eth_etherbone_packet_user_description(32))
+        self.source = source = stream.Endpoint(stream_layout(32))
+
+        self.submodules.packetizer = packetizer = LiteEthEtherbonePacketPacketizer()
+        # a full reply must not be followed by a ZLP, so batched replies share an IN transfer
+        self.submodules.framer = framer = StreamTransferFramer(
+            [("data", 32)],
+            max_packet_size=USBBulkStreamerDevice.MAX_BULK_PACKET_SIZE // 4,
+            zlp=False,
+        )
+        self.comb += [
+            sink.connect(packetizer.sink, keep={"valid", "last", "last_be", "ready", "data"}),
+            sink.connect(packetizer.sink, keep={"pf", "pr", "nr"}),
+            packetizer.sink.version.eq(etherbone_version),
+            packetizer.sink.magic.eq(etherbone_magic),
+            packetizer.sink.port_size.eq(32 // 8),
+            packetizer.sink.addr_size.eq(32 // 8),
+            # etherbone packets are whole words; last ends the USB packet
+            packetizer.source.connect(framer.sink, keep={"valid", "ready", "last", "data"}),
+            framer.source.connect(source, keep={"valid", "ready", "last", "data"}),
+            source.be.eq(0b1111),
+        ]
+
+
+class LiteLUNAUSBbonePacketRX(Module):
+    def __init__(self):
+        self.sink = sink = stream.Endpoint(stream_layout(32))
+        self.source = source = stream.Endpoint(eth_etherbone_packet_user_description(32))
+
+        self.submodules.depacketizer = depacketizer = LiteEthEtherbonePacketDepacketizer()
+        self.comb += sink.connect(depacketizer.sink, keep={"valid", "ready", "last", "data"})
+
+        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
+        fsm.act(
+            "IDLE",
+            If(
+                depacketizer.source.valid,
+                NextState("DROP"),
+                If(depacketizer.source.magic == etherbone_magic, NextState("RECEIVE")),
+            ),
+        )
+        self.comb += depacketizer.source.connect(
+            source, keep={"last", "last_be", "pf", "pr", "nr", "data"}
+        )
+        fsm.act(
+            "RECEIVE",
+            depacketizer.source.connect(source, keep={"valid", "ready"}),
+            If(source.valid & source.ready & source.last, NextState("IDLE")),
+        )
+        fsm.act(
+            "DROP",
+            depacketizer.source.ready.eq(1),
+            If(depacketizer.source.valid & depacketizer.source.last, NextState("IDLE")),
+        )
 
 
 class LiteLUNAUSBbonePacket(Module):
+    """Etherbone packets over the 32-bit streams of a ``USBStreamer``.
+
+    Each bulk OUT packet carries one Etherbone packet, delimited by the streamer's ``last``, and
+    each reply is sent as its own IN packet; a short reply ends the IN transfer.
+    """
+
     def __init__(self, usb):
         self.submodules.tx = tx = LiteLUNAUSBbonePacketTX()
         self.submodules.rx = rx = LiteLUNAUSBbonePacketRX()
-        udp_port = udp.crossbar.get_port(udp_port, dw=32, cd=cd)
-        self.comb += [tx.source.connect(udp_port.sink), udp_port.source.connect(rx.sink)]
+        self.comb += [tx.source.connect(usb.source), usb.sink.connect(rx.sink)]
         self.sink, self.source = self.tx.sink, self.rx.source
 
 
-# USBbone -----------------------------------------------------------------------------------------
+# USBbone ------------------------------------------------------------------------------------------
 
 
 class LiteLUNAUSBbone(Module):
-    def __init__(self, buffer_depth=4, cd="sys"):
+    """Etherbone Wishbone master behind a ``USBStreamer``, in the streamer's ``cd`` domain.
+
+    A record must fit a 512-byte bulk packet together with its headers, so bursts are limited to
+    ``MAX_RECORD_WORDS - 1`` words. ``buffer_depth`` words of records are buffered on both sides
+    of the Wishbone master, so the next records are received while one executes and a full read
+    reply waits for the host without stalling the bus.
+    """
+
+    def __init__(self, usb, buffer_depth=256):
+        assert buffer_depth > MAX_RECORD_WORDS + 1
         # Encode/encode etherbone packets
-        self.submodules.packet = packet = LiteLUNAUSBbonePacket(cd)
+        self.submodules.packet = packet = LiteLUNAUSBbonePacket(usb)
+
+        self.submodules.probe = probe = LiteEthEtherboneProbe()
+        self.submodules.record = record = LiteEthEtherboneRecord(buffer_depth=buffer_depth)
 
-        self.submodules.record = record = LiteLUNAUSBboneRecord(buffer_depth=buffer_depth)
+        # The record receiver and sender buffer records in PacketFIFOs, which queue a record's
+        # parameters twice if their payload FIFO stalls its last word, so a record only enters
+        # either of them once all of it fits.
+        room = buffer_depth - MAX_RECORD_WORDS - 1
+        admitted = stream.Endpoint(eth_etherbone_packet_user_description(32))
+        self._admit(packet.source, admitted, record.receiver.fifo.payload_fifo.level < room)
 
         # Arbitrate/dispatch probe/records packets
-        dispatcher = Dispatcher(packet.source, [probe.sink, record.sink])
-        self.comb += dispatcher.sel.eq(~packet.source.pf)
+        dispatcher = Dispatcher(admitted, [probe.sink, record.sink])
+        self.comb += dispatcher.sel.eq(~admitted.pf)
         arbiter = Arbiter([probe.source, record.source], packet.sink)
         self.submodules += dispatcher, arbiter
 
         # Create MMAP wishbone
-        self.submodules.wishbone = LiteLUNAUSBboneWishboneMaster()
+        self.submodules.wishbone = LiteEthEtherboneWishboneMaster()
+        request = stream.Endpoint(eth_etherbone_mmap_description(32))
+        reply_room = record.sender.fifo.payload_fifo.level < room
+        self._admit(record.receiver.source, request, request.we | reply_room)
         self.comb += [
-            record.receiver.source.connect(self.wishbone.sink),
+            request.connect(self.wishbone.sink),
             self.wishbone.source.connect(record.sender.sink),
         ]
+
+    def _admit(self, source, sink, room):
+        # passes source to sink, holding back the first word of a packet until room
+        in_packet = Signal()
+        self.comb += [
+            source.connect(sink, omit={"valid", "ready"}),
+            sink.valid.eq(source.valid & (in_packet | room)),
+            source.ready.eq(sink.ready & (in_packet | room)),
+        ]
+        self.sync += If(sink.valid & sink.ready, in_packet.eq(~sink.last))
@@ -50,8 +50,41 @@ class UTMIInterface(Record):
         )
 
 
+# Simulated line timing (seconds) and the USB 2.0 thresholds the device side checks them against:
+# SE0 must outlast reset detection, host chirps must outlast chirp detection and the HS idle
+# toggle must come before suspend detection.
+SIM_TIMINGS = {"bus_reset": 10e-6, "chirp": 5e-6, "toggle": 125e-6}
+SIM_THRESHOLDS = {"bus_reset": (2.5e-6, 1), "chirp": (2.5e-6, 1), "toggle": (3e-3, -1)}
+
+
+def scaled_cycles(clk_freq, seconds, time_scale=1):
+    return max(1, int(clk_freq * (seconds / time_scale)))
+
+
+def check_sim_time_scale(clk_freq, time_scale, min_cycles=4):
+    """Returns the fixup timer cycles for ``time_scale``, or raises ``ValueError`` if speed
+    negotiation would no longer work once both sides' timers are divided by it."""
+    cycles = {}
+    for name, seconds in SIM_TIMINGS.items():
+        threshold, sign = SIM_THRESHOLDS[name]
+        fixup_cycles = scaled_cycles(clk_freq, seconds, time_scale)
+        device_cycles = scaled_cycles(clk_freq, threshold, time_scale)
+        if min(fixup_cycles, device_cycles) < min_cycles:
+            raise ValueError(
+                f"time_scale {time_scale} leaves {name} with {min(fixup_cycles, device_cycles)} "
+                f"cycles at {clk_freq * 1e-6:.1f} MHz, need at least {min_cycles}"
+            )
+        if (fixup_cycles - device_cycles) * sign <= 0:
+            raise ValueError(
+                f"time_scale {time_scale} rounds {name} to {fixup_cycles} cycles against a "
+                f"{device_cycles} cycle device threshold"
+            )
+        cycles[name] = fixup_cycles
+    return cycles
+
+
 class SimUTMIStreamFixup(Module):
-    def __init__(self, usb_sim_phy, cd="sys", cd_usb="usb"):
+    def __init__(self, usb_sim_phy, cd="sys", cd_usb="usb", time_scale=1):
         self.utmi = utmi = UTMIInterface()
         self.rx_data_out = rx_data_out = Signal(8)
         self.rx_valid_out = rx_valid_out = Signal()
@@ -79,12 +112,9 @@ class SimUTMIStreamFixup(Module):
         ]
         self.comb += rx_active_out.eq(usb_sim_phy.source.valid | rx_valid_out)
 
+        self.time_scale = time_scale
         self.submodules.timer = tmr = MultiWaitTimer(
-            {
-                "bus_reset": int(ClockFrequency(cd_usb) * 10e-6),
-                "chirp": int(ClockFrequency(cd_usb) * 5e-6),
-                "toggle": int(ClockFrequency(cd_usb) * 125e-6),
-            }
+            check_sim_time_scale(ClockFrequency(cd_usb), time_scale)
         )
         self.submodules.reset_fsm = fsm = ClockDomainsRenamer(cd_usb)(FSM(reset_state="RESET"))
         fsm.act(
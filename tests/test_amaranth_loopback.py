@@ -0,0 +1,70 @@
+import pytest
+
+# the gateware tests need Amaranth and the LiteLUNA LUNA fork; without them nothing here runs
+pytest.importorskip("amaranth")
+pytest.importorskip("luna")
+
+from liteluna.luna_cores.testbench import run_simulation, select_alt_setting
+from liteluna.pattern import Pattern, PatternChecker
+from liteluna.sim.usb_host import DescriptorType, Endpoint, StallError, iter_descriptors
+
+# a hung device fails the test instead of the whole run
+MAX_CYCLES = 1_000_000
+
+
+def test_enumerate():
+    async def script(host, model):
+        await host.enumerate()
+        return host
+
+    host = run_simulation(script, max_cycles=MAX_CYCLES)
+    assert host.strings
+    assert host.endpoints[0x01].transfer_type == "bulk"
+    assert host.endpoints[0x81].transfer_type == "bulk"
+
+
+def _endpoints_by_alt_setting(configuration_descriptor):
+    endpoints = {}
+    for descriptor_type, descriptor in iter_descriptors(configuration_descriptor):
+        if descriptor_type == DescriptorType.INTERFACE:
+            alt_setting = endpoints.setdefault(descriptor[3], {})
+        elif descriptor_type == DescriptorType.ENDPOINT:
+            ep = Endpoint(descriptor)
+            alt_setting[ep.address] = ep
+    return endpoints
+
+
+def test_iso_alt_setting():
+    host, alt_setting = run_simulation(select_alt_setting, iso_in=True, max_cycles=MAX_CYCLES)
+    assert alt_setting == 1
+    endpoints = _endpoints_by_alt_setting(host.configuration_descriptor)
+    assert 0x81 not in endpoints[0]
+    assert endpoints[1][0x81].transfer_type == "isochronous"
+    assert endpoints[1][0x81].packets_per_microframe == 3
+
+
+def test_iso_alt_setting_out_of_range():
+    async def script(host, model):
+        await host.enumerate(with_strings=False)
+        with pytest.raises(StallError):
+            await host.set_interface(0, 2)
+        # the next SETUP clears the stall
+        return await host.get_interface(0)
+
+    assert run_simulation(script, iso_in=True, max_cycles=MAX_CYCLES) == 0
+
+
+@pytest.mark.parametrize("size", [1, 512, 1500])
+def test_bulk_loopback(size):
+    async def script(host, model):
+        await host.enumerate(with_strings=False)
+        pattern = Pattern("lfsr", seed=size)
+        checker = PatternChecker(Pattern("lfsr", seed=size), invert=True)
+        for _ in range(2):
+            await host.bulk_out(1, pattern.next(size))
+            checker.check(await host.bulk_in(1, size))
+        return checker
+
+    checker = run_simulation(script, max_cycles=MAX_CYCLES)
+    assert checker.ok, checker.summary()
+    assert checker.offset == 2 * size
@@ -0,0 +1,30 @@
+import pytest
+from migen import *
+
+# USBAnalyzer takes NAK_PID from the LUNA bulk streamer
+pytest.importorskip("amaranth")
+pytest.importorskip("luna")
+
+from liteluna.analyzer import USBAnalyzer
+from liteluna.utmi import UTMIInterface
+
+
+@pytest.mark.parametrize("register", [False, True])
+def test_storage_qualifier(register):
+    utmi = UTMIInterface()
+    analyzer = USBAnalyzer(
+        utmi, depth=64, clock_domain="sys", cd="sys", register=register, csr_csv=None
+    )
+    rx_active = [0, 0, 1, 1, 1, 0, 0, 0, 1, 0, 0, 0, 0]
+    valid = []
+
+    def generator():
+        for value in rx_active:
+            yield utmi.rx_active.eq(value)
+            yield
+            valid.append((yield analyzer.mux.source.valid))
+
+    run_simulation(analyzer, generator())
+    # busy cycles and the one after each packet, one cycle late when registered
+    expected = [0, 0, 0, 1, 1, 1, 1, 0, 0, 1, 1, 0, 0]
+    assert valid == (expected if register else expected[1:] + [0])
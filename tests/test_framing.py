@@ -0,0 +1,89 @@
+import random
+import socket
+
+import pytest
+
+from liteluna.sim.framing import HEADER, FrameDecoder, FrameEncoder
+
+
+def _frames(rng, count, max_size):
+    return [rng.randbytes(rng.choice([0, 1, rng.randrange(max_size)])) for _ in range(count)]
+
+
+def _feed(decoder, data):
+    while data:
+        buffer = decoder.get_buffer()
+        n = min(len(buffer), len(data))
+        buffer[:n] = data[:n]
+        decoder.buffer_updated(n)
+        data = data[n:]
+
+
+@pytest.mark.parametrize("seed", range(16))
+def test_round_trip_fuzz(seed):
+    rng = random.Random(seed)
+    # frames up to 4x the buffer size, fed in chunks that split headers and frames anywhere
+    frames = _frames(rng, 200, 1024)
+    encoder = FrameEncoder(size=64)
+    encoder.extend(frames)
+    stream = bytes(encoder.view())
+    assert len(encoder) == len(stream) == sum(HEADER.size + len(frame) for frame in frames)
+
+    decoder = FrameDecoder(size=256, min_read=16)
+    received = []
+    held = None
+    offset = 0
+    while offset < len(stream) or held is not None:
+        n = rng.choice([1, 3, 5, rng.randrange(1, 600)])
+        _feed(decoder, stream[offset : offset + n])
+        offset += n
+        # a frame stays intact until the next next_frame(), whatever is received meanwhile
+        if held is not None:
+            assert bytes(held[0]) == held[1]
+        frame = decoder.next_frame()
+        held = None if frame is None else (frame, bytes(frame))
+        if frame is not None:
+            received.append(held[1])
+    received.extend(bytes(frame) for frame in decoder.frames())
+    assert received == frames
+    assert decoder.pending == 0
+
+
+def test_byte_at_a_time():
+    frames = [b"", b"a", bytes(range(256)) * 3]
+    encoder = FrameEncoder()
+    encoder.extend(frames)
+    decoder = FrameDecoder(size=64, min_read=8)
+    received = []
+    for byte in bytes(encoder.view()):
+        _feed(decoder, bytes([byte]))
+        frame = decoder.next_frame()
+        if frame is not None:
+            received.append(bytes(frame))
+    assert received == frames
+
+
+def test_socket():
+    rng = random.Random(1)
+    frames = _frames(rng, 50, 5000)
+    a, b = socket.socketpair()
+    with a, b:
+        encoder = FrameEncoder(size=256)
+        encoder.extend(frames)
+        encoder.send(a)
+        assert len(encoder) == 0
+        a.shutdown(socket.SHUT_WR)
+        decoder = FrameDecoder(size=1024, min_read=256)
+        received = []
+        while decoder.recv_into(b):
+            received.extend(bytes(frame) for frame in decoder.frames())
+    assert received == frames
+
+
+def test_detach():
+    encoder = FrameEncoder(size=16)
+    encoder.add(b"first")
+    data = encoder.detach()
+    encoder.add(b"second")
+    assert bytes(data) == HEADER.pack(5) + b"first"
+    assert bytes(encoder.view()) == HEADER.pack(6) + b"second"
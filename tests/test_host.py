@@ -0,0 +1,100 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from liteluna.host import (
+    BulkStreamer,
+    EventThread,
+    LoopbackDevice,
+    StreamReader,
+    StreamWriter,
+)
+from liteluna.pattern import INVERT_TABLE, Pattern
+
+TRANSFER_SIZE = 4096
+
+
+def _data(size, seed=1):
+    return bytes(Pattern("lfsr", seed=seed).next(size))
+
+
+def _read(reader, size):
+    data = bytearray()
+    while len(data) < size:
+        data += reader.read()
+    return bytes(data)
+
+
+@pytest.mark.parametrize("size", [1, 512, TRANSFER_SIZE, 5 * TRANSFER_SIZE + 100])
+def test_reader_writer_round_trip(size):
+    device = LoopbackDevice(invert=False)
+    writer = StreamWriter(device, device, transfer_size=TRANSFER_SIZE, queue_depth=2)
+    reader = StreamReader(device, device, transfer_size=TRANSFER_SIZE, queue_depth=2)
+    data = _data(size)
+    writer.write(data)
+    writer.flush()
+    assert _read(reader, size) == data
+    writer.close()
+    reader.close()
+
+
+def test_bulk_streamer_inverts():
+    device = LoopbackDevice()
+    data = _data(3 * TRANSFER_SIZE)
+    with BulkStreamer(device, device, transfer_size=TRANSFER_SIZE, queue_depth=4) as streamer:
+        for offset in range(0, len(data), 1000):
+            streamer.writer.write(data[offset : offset + 1000])
+        streamer.writer.flush()
+        assert _read(streamer.reader, len(data)) == data.translate(INVERT_TABLE)
+
+
+def test_bulk_streamer_async():
+    device = LoopbackDevice()
+    data = _data(4 * TRANSFER_SIZE, seed=7)
+
+    async def run(streamer):
+        async def write():
+            await streamer.writer.awrite(data)
+            await streamer.writer.aflush()
+
+        async def read():
+            received = bytearray()
+            async for view in streamer.reader:
+                received += view
+                if len(received) >= len(data):
+                    return bytes(received)
+
+        return (await asyncio.gather(write(), read()))[1]
+
+    with EventThread(device, interval=0.01):
+        with BulkStreamer(device, device, transfer_size=TRANSFER_SIZE, queue_depth=2) as streamer:
+            assert asyncio.run(run(streamer)) == data.translate(INVERT_TABLE)
+
+
+def test_read_times_out_empty():
+    device = LoopbackDevice()
+    reader = StreamReader(device, device, transfer_size=TRANSFER_SIZE, queue_depth=2, timeout=50)
+    t0 = time.monotonic()
+    assert len(reader.read()) == 0
+    assert time.monotonic() - t0 >= 0.05
+    reader.close()
+
+
+def test_read_waits_for_late_writer():
+    # a reader submitted before any data arrives only times out after its timeout
+    device = LoopbackDevice(invert=False)
+    reader = StreamReader(device, device, transfer_size=TRANSFER_SIZE, queue_depth=2, timeout=5000)
+    writer = StreamWriter(device, device, transfer_size=TRANSFER_SIZE, queue_depth=2)
+    data = _data(100)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(bytes(reader.read())))
+    thread.start()
+    time.sleep(0.05)
+    writer.write(data)
+    writer.flush()
+    thread.join()
+    assert result == [data]
+    writer.close()
+    reader.close()
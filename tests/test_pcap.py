@@ -0,0 +1,55 @@
+import os
+
+from liteluna.sim.pcap import MICROFRAME_NS, BusClock, PcapngWriter, convert
+from liteluna.sim.replay import (
+    LINKTYPE_USB_2_0,
+    iter_pcapng,
+    open_capture,
+    parse_pcapng,
+)
+from liteluna.sim.usb_host import sof_packet
+
+CAPTURES = os.path.join(os.path.dirname(__file__), os.pardir, "captures")
+
+PACKETS = [
+    ("h2d", bytes.fromhex("698218")),
+    ("d2h", bytes.fromhex("4b0102ff")),
+    ("h2d", bytes.fromhex("d2")),
+    ("d2h", bytes(range(256)) * 2 + b"\x01"),
+]
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / "t.pcapng"
+    with PcapngWriter(path) as writer:
+        for i, (kind, data) in enumerate(PACKETS):
+            timestamp = 2**33 + 1000 * i
+            if kind == "h2d":
+                writer.rx(timestamp, data)
+            else:
+                writer.tx(timestamp, memoryview(data))
+    assert writer.packets == len(PACKETS)
+    blocks = list(iter_pcapng(path))
+    assert [data for _, _, data, _ in blocks] == [data for _, data in PACKETS]
+    assert {linktype for linktype, *_ in blocks} == {LINKTYPE_USB_2_0}
+    # nanosecond resolution, through the 64-bit timestamp split
+    assert [round(timestamp * 1e9) for _, timestamp, _, _ in blocks] == [
+        2**33 + 1000 * i for i in range(len(PACKETS))
+    ]
+    # directions come from epb_flags, not from the packet order
+    assert list(parse_pcapng(path)) == PACKETS
+
+
+def test_bus_clock():
+    clock = BusClock()
+    assert clock.stamp(sof_packet(0)) == MICROFRAME_NS
+    second = clock.stamp(b"\x69\x82\x18")
+    assert MICROFRAME_NS < second < MICROFRAME_NS + 1000
+    assert clock.stamp(sof_packet(1)) == 2 * MICROFRAME_NS
+
+
+def test_convert_text_log(tmp_path):
+    src = os.path.join(CAPTURES, "dbg-usbip", "bad1-sim.txt")
+    dst = tmp_path / "bad1.pcapng"
+    assert convert(src, str(dst)) == 17
+    assert list(open_capture(str(dst))) == list(open_capture(src))
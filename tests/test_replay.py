@@ -0,0 +1,105 @@
+import os
+from collections import Counter
+
+import pytest
+
+from liteluna.sim.replay import (
+    LINKTYPE_USB_LINUX_MMAPPED,
+    PacketDirections,
+    iter_pcapng,
+    open_capture,
+    parse_tdc_csv,
+    parse_text_log,
+)
+from liteluna.sim.trace import TraceWriter
+from liteluna.sim.usb_host import PID
+
+CAPTURES = os.path.join(os.path.dirname(__file__), os.pardir, "captures")
+
+
+def _capture(name):
+    return os.path.join(CAPTURES, name)
+
+
+def test_usbmon_bulk_out():
+    transfers = [value for kind, value in open_capture(_capture("bulk-out-aa5500ff.pcapng"))]
+    assert all(transfer.device == 11 and transfer.status == 0 for transfer in transfers)
+    get_device, get_config, get_config_full, bulk = transfers
+    assert get_device.transfer_type == "control"
+    assert get_device.setup == bytes.fromhex("8006000100001200")
+    assert get_device.expected[:2] == b"\x12\x01" and len(get_device.expected) == 18
+    assert get_config.length == 9 and get_config_full.length == 32
+    assert (bulk.endpoint, bulk.transfer_type, bulk.setup) == (0x01, "bulk", None)
+    assert bulk.data == bytes.fromhex("aa5500ff") and bulk.expected is None
+
+
+def test_usbmon_filters_devices():
+    path = _capture("loopback-short.pcapng")
+    assert {linktype for linktype, *_ in iter_pcapng(path)} == {LINKTYPE_USB_LINUX_MMAPPED}
+    devices = Counter(transfer.device for _, transfer in open_capture(path))
+    # the root hub (address 1) is dropped unless asked for
+    assert 1 not in devices and sum(devices.values()) == 104
+    assert set(transfer.device for _, transfer in open_capture(path, devices=[5])) == {5}
+
+
+def test_usbmon_error_status():
+    (transfer,) = [value for _, value in open_capture(_capture("dbg-usbip/bad1.pcapng"))]
+    assert transfer.status == -2 and transfer.expected == b""
+
+
+def test_text_log(tmp_path):
+    events = list(open_capture(_capture("dbg-usbip/bad1-sim.txt")))
+    assert Counter(kind for kind, _ in events) == {"h2d": 13, "d2h": 4}
+    assert events[0] == ("h2d", bytes.fromhex("a50010"))
+
+    path = tmp_path / "log.txt"
+    path.write_text("# comment\nh2d_raw: 2d 00 10\nd2h: 4b\nnoise\n")
+    assert list(parse_text_log(path)) == [
+        ("comment", "# comment"),
+        ("h2d", b"\x2d\x00\x10"),
+        ("d2h", b"\x4b"),
+    ]
+
+
+def test_trace(tmp_path):
+    path = tmp_path / "t.trace"
+    with TraceWriter(path) as writer:
+        writer.state(0, line_state=1)
+        writer.rx(1, b"\x69\x82\x18")
+        writer.tx(2, b"\x5a")
+    assert list(open_capture(str(path))) == [("h2d", b"\x69\x82\x18"), ("d2h", b"\x5a")]
+
+
+def test_packet_directions():
+    direction = PacketDirections()
+    sequence = [
+        (PID.SETUP, "h2d"),
+        (PID.DATA0, "h2d"),
+        (PID.ACK, "d2h"),
+        (PID.IN, "h2d"),
+        (PID.DATA1, "d2h"),
+        (PID.ACK, "h2d"),
+        (PID.OUT, "h2d"),
+        (PID.DATA0, "h2d"),
+        (PID.NAK, "d2h"),
+        (PID.SOF, "h2d"),
+    ]
+    assert [direction(bytes([pid])) for pid, _ in sequence] == [d for _, d in sequence]
+
+
+def test_tdc(tmp_path):
+    path = tmp_path / "export.csv"
+    path.write_text(
+        "Index,Record,Data\n"
+        "0,IN packet,69 82 18\n"
+        "1,DATA1 packet,4b 01 02 00 00\n"
+        "2,Bus event,\n"
+        "3,ACK packet,d2\n"
+    )
+    assert list(parse_tdc_csv(str(path))) == [
+        ("h2d", bytes.fromhex("698218")),
+        ("d2h", bytes.fromhex("4b01020000")),
+        ("h2d", bytes.fromhex("d2")),
+    ]
+    with pytest.raises(ValueError, match="CSV"):
+        open_capture(_capture("loopback-connect-test-disconnect.tdc"))
@@ -0,0 +1,64 @@
+import os
+import shutil
+import time
+
+from litex.build.generic_platform import Pins
+from litex.build.sim import SimPlatform, verilator
+from litex.build.sim.config import SimConfig
+from migen import *
+
+from liteluna.sim.build import SimBuildCache
+
+
+class _Counter(Module):
+    def __init__(self, platform, width):
+        self.clock_domains.cd_sys = ClockDomain("sys")
+        self.comb += self.cd_sys.clk.eq(platform.request("sys_clk"))
+        counter = Signal(width, name="counter")
+        self.sync += counter.eq(counter + 1)
+
+
+def _build(build_dir, width=8):
+    platform = SimPlatform("SIM", [("sys_clk", 0, Pins(1))])
+    sim_config = SimConfig()
+    sim_config.add_clocker("sys_clk", freq_hz=int(1e6))
+    platform.build(
+        _Counter(platform, width), build_dir=str(build_dir), sim_config=sim_config, run=False
+    )
+
+
+def _compile(build_dir, cache):
+    cwd = os.getcwd()
+    os.chdir(build_dir)
+    try:
+        with cache.patch():
+            verilator._compile_sim("sim", False)
+    finally:
+        os.chdir(cwd)
+
+
+def test_rebuild_reuses_model(tmp_path, monkeypatch):
+    compiles = []
+
+    def compile_sim(build_name, verbose):
+        # stands in for Verilator: a fresh obj_dir with a binary in it
+        compiles.append(build_name)
+        shutil.rmtree("obj_dir", ignore_errors=True)
+        os.makedirs("obj_dir")
+        os.makedirs("modules", exist_ok=True)
+        open(os.path.join("obj_dir", "Vsim"), "w").close()
+
+    monkeypatch.setattr(verilator, "_compile_sim", compile_sim)
+    cache = SimBuildCache(tmp_path)
+    now = time.time()
+
+    # LiteX timestamps every generated file, so the second build differs in its dates only
+    for hours in (0, 1):
+        monkeypatch.setattr(time, "time", lambda: now + 3600 * hours)
+        _build(tmp_path)
+        _compile(tmp_path, cache)
+    assert compiles == ["sim"]
+
+    _build(tmp_path, width=9)
+    _compile(tmp_path, cache)
+    assert compiles == ["sim", "sim"]
@@ -0,0 +1,84 @@
+import random
+
+import pytest
+from migen import *
+
+from liteluna.stream import StreamTransferFramer
+
+MAX_PACKET_SIZE = 4
+
+
+def _send(sink, transfers):
+    # transfers are element counts, each ending in last
+    data = 0
+    for length in transfers:
+        for i in range(length):
+            yield sink.valid.eq(1)
+            yield sink.data.eq(data & 0xFF)
+            yield sink.last.eq(i == length - 1)
+            yield
+            while not (yield sink.ready):
+                yield
+            data += 1
+        yield sink.valid.eq(0)
+        yield
+
+
+@passive
+def _receive(source, received, ready_rate):
+    rng = random.Random(ready_rate)
+    while True:
+        if (yield source.valid) and (yield source.ready):
+            received.append(((yield source.data), (yield source.last)))
+        yield source.ready.eq(rng.random() < ready_rate)
+        yield
+
+
+def _frame(transfers, ready_rate=1.0, **kwargs):
+    """Returns the indices of the elements that leave with ``last``."""
+    dut = StreamTransferFramer([("data", 8)], max_packet_size=MAX_PACKET_SIZE, **kwargs)
+    received = []
+    run_simulation(dut, [_send(dut.sink, transfers), _receive(dut.source, received, ready_rate)])
+    assert [data for data, _ in received] == [i & 0xFF for i in range(sum(transfers))]
+    return [i for i, (_, last) in enumerate(received) if last]
+
+
+@pytest.mark.parametrize("ready_rate", [1.0, 0.3])
+def test_zlp(ready_rate):
+    # last on a full packet stays, so the endpoint follows it with a ZLP
+    assert _frame([8, 6, 4], ready_rate) == [7, 13, 17]
+
+
+@pytest.mark.parametrize("ready_rate", [1.0, 0.3])
+def test_no_zlp(ready_rate):
+    # last on a full packet is dropped and the transfer continues into the next one
+    assert _frame([8, 6, 4], ready_rate, zlp=False) == [13]
+
+
+@pytest.mark.parametrize("ready_rate", [1.0, 0.3])
+def test_max_transfer_length(ready_rate):
+    # the host's 8-element read completes by itself, so last at its end is dropped; the
+    # transfers after it count from there
+    transfers = [8, 12, 5, 16]
+    assert _frame(transfers, ready_rate, max_transfer_length=8) == [19, 24]
+
+
+@pytest.mark.parametrize("ready_rate", [1.0, 0.3])
+def test_timeout(ready_rate):
+    # no last at all: the flusher ends the partial packet once the stream goes idle
+    dut = StreamTransferFramer([("data", 8)], max_packet_size=MAX_PACKET_SIZE, timeout=16)
+    received = []
+
+    def send():
+        for data in range(6):
+            yield dut.sink.valid.eq(1)
+            yield dut.sink.data.eq(data)
+            yield
+            while not (yield dut.sink.ready):
+                yield
+        yield dut.sink.valid.eq(0)
+        for _ in range(64):
+            yield
+
+    run_simulation(dut, [send(), _receive(dut.source, received, ready_rate)])
+    assert received == [(data, int(data == 5)) for data in range(6)]
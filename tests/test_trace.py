@@ -0,0 +1,107 @@
+import asyncio
+import io
+
+import pytest
+
+from liteluna.sim.trace import (
+    FILE_HEADER,
+    RX_ACTIVE,
+    TX_READY,
+    RecordingLink,
+    RecordKind,
+    TraceReader,
+    TraceWriter,
+    dump,
+)
+
+
+def _records(path):
+    with TraceReader(path) as reader:
+        records = [(r.kind, r.flags, r.timestamp, bytes(r.data)) for r in reader]
+    return reader.timebase, records
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / "t.trace"
+    with TraceWriter(path, timebase=60e6) as writer:
+        writer.state(0, line_state=1, rx_active=1, tx_ready=1)
+        writer.rx(10, b"\x69\x82\x18")
+        writer.tx(20, bytearray(b"\xd2"))
+        writer.rx(2**40, bytes(range(256)) * 4)
+        writer.tx(2**40 + 1, b"")
+    assert writer.records == 5
+    timebase, records = _records(path)
+    assert timebase == 60e6
+    assert records == [
+        (RecordKind.STATE, 1 | RX_ACTIVE | TX_READY, 0, b""),
+        (RecordKind.RX, 0, 10, b"\x69\x82\x18"),
+        (RecordKind.TX, 0, 20, b"\xd2"),
+        (RecordKind.RX, 0, 2**40, bytes(range(256)) * 4),
+        (RecordKind.TX, 0, 2**40 + 1, b""),
+    ]
+
+
+def test_append_keeps_timebase(tmp_path):
+    path = tmp_path / "t.trace"
+    with TraceWriter(path, timebase=1e3) as writer:
+        writer.rx(1, b"a")
+    with TraceWriter(path, timebase=1e9) as writer:
+        assert writer.timebase == 1e3
+        writer.tx(2, b"b")
+    assert _records(path) == (1e3, [(RecordKind.RX, 0, 1, b"a"), (RecordKind.TX, 0, 2, b"b")])
+
+
+def test_truncated_record_ends_iteration(tmp_path):
+    path = tmp_path / "t.trace"
+    with TraceWriter(path) as writer:
+        writer.rx(1, b"complete")
+        writer.rx(2, b"cut short")
+    with open(path, "r+b") as f:
+        f.truncate(path.stat().st_size - 3)
+    assert _records(path)[1] == [(RecordKind.RX, 0, 1, b"complete")]
+
+
+def test_bad_header(tmp_path):
+    path = tmp_path / "t.trace"
+    path.write_bytes(b"\0" * FILE_HEADER.size)
+    with pytest.raises(ValueError, match="not a liteluna trace"):
+        TraceReader(path)
+    path.write_bytes(b"LLTRACE")
+    with pytest.raises(ValueError, match="truncated"):
+        TraceReader(path)
+
+
+def test_oversized_record(tmp_path):
+    with TraceWriter(tmp_path / "t.trace") as writer:
+        with pytest.raises(ValueError):
+            writer.rx(0, bytes(0x10000))
+
+
+def test_recording_link(tmp_path):
+    class Link:
+        def __init__(self):
+            self.written = []
+
+        def write(self, frames):
+            self.written.extend(frames)
+
+        async def read(self):
+            return b"\x4b"
+
+    path = tmp_path / "t.trace"
+    link = Link()
+    clock = iter(range(100, 200))
+    with TraceWriter(path) as writer:
+        recording = RecordingLink(link, writer, clock=lambda: next(clock))
+        recording.write([b"\xe1\x01", b"\xc3"])
+        assert asyncio.run(recording.read()) == b"\x4b"
+    assert link.written == [b"\xe1\x01", b"\xc3"]
+    assert _records(path)[1] == [
+        (RecordKind.RX, 0, 100, b"\xe1\x01"),
+        (RecordKind.RX, 0, 100, b"\xc3"),
+        (RecordKind.TX, 0, 101, b"\x4b"),
+    ]
+
+    out = io.StringIO()
+    dump(path, out)
+    assert out.getvalue() == "h2d_raw: e1 01\nh2d_raw: c3\nd2h_raw: 4b\n"
@@ -0,0 +1,96 @@
+import random
+
+import pytest
+
+from liteluna.host import (
+    MAX_PACKET_SIZE,
+    USBBONE_MAX_BURST,
+    TransferError,
+    USBboneClient,
+    USBboneDevice,
+)
+
+MEMORY_SIZE = 64 * 1024
+
+
+class _RecordingDevice(USBboneDevice):
+    # keeps the length of every OUT transfer, one entry per batch
+    def __init__(self, size):
+        super().__init__(size)
+        self.batches = []
+
+    def _submit(self, transfer):
+        if not transfer.getEndpoint() & 0x80:
+            self.batches.append(len(transfer.getBuffer()))
+        super()._submit(transfer)
+
+
+class _ShortReplyDevice(USBboneDevice):
+    # loses the last word of every read reply
+    def _execute(self, packet):
+        replies = len(self._replies)
+        super()._execute(packet)
+        if len(self._replies) > replies:
+            self._replies[-1] = self._replies[-1][:-4]
+
+
+def _client(device):
+    return USBboneClient(device, device, batch_packets=4, queue_depth=2)
+
+
+def test_random_blocks():
+    rng = random.Random(0)
+    device = USBboneDevice(size=MEMORY_SIZE)
+    memory = bytearray(MEMORY_SIZE)
+    with _client(device) as bus:
+        for _ in range(30):
+            size = 4 * rng.randrange(1, 2 * USBBONE_MAX_BURST * 4)
+            addr = 4 * rng.randrange((MEMORY_SIZE - size) // 4)
+            data = rng.randbytes(size)
+            bus.write_block(addr, data)
+            memory[addr : addr + size] = data
+            size = 4 * rng.randrange(1, 2 * USBBONE_MAX_BURST * 4)
+            addr = 4 * rng.randrange((MEMORY_SIZE - size) // 4)
+            assert bus.read_block(addr, size) == memory[addr : addr + size]
+    assert device.memory == memory
+
+
+def test_words_and_probe():
+    device = USBboneDevice(size=MEMORY_SIZE)
+    with _client(device) as bus:
+        assert bus.probe()
+        bus.write(0x100, [0x11223344, 0x55667788])
+        assert bus.read(0x100) == 0x11223344
+        assert bus.read(0x100, 2) == [0x11223344, 0x55667788]
+        assert bus.read(0x104, 300, burst="fixed") == [0x55667788] * 300
+        assert bus.read_words([0x104, 0x100]) == [0x55667788, 0x11223344]
+    # Etherbone words are stored little-endian, like the SoC bus
+    assert device.memory[0x100:0x104] == bytes([0x44, 0x33, 0x22, 0x11])
+
+
+def test_multi_batch():
+    device = _RecordingDevice(MEMORY_SIZE)
+    size = 4 * USBBONE_MAX_BURST * 10
+    data = bytes(range(256)) * (size // 256) + bytes(size % 256)
+    with _client(device) as bus:
+        bus.write_block(0, data)
+        assert bus.read_block(0, size) == data
+    # 10 full packets each way, at most 4 per transfer
+    assert max(device.batches) <= 4 * MAX_PACKET_SIZE
+    assert len(device.batches) >= 6
+
+
+def test_short_reply():
+    device = _ShortReplyDevice(MEMORY_SIZE)
+    with _client(device) as bus:
+        with pytest.raises(TransferError):
+            bus.read(0, 4)
+
+
+def test_unaligned_block():
+    device = USBboneDevice(size=MEMORY_SIZE)
+    with _client(device) as bus:
+        with pytest.raises(ValueError):
+            bus.read_block(2, 8)
+        with pytest.raises(ValueError):
+            bus.write_block(0, bytes(6))